@@ -0,0 +1,1204 @@
+import math
+import time
+import numpy as np
+
+from pairwise.pairwise_kernels import (
+    get_acceleration_symmetric, precision_dtype
+    )
+from simulation import instrumentation
+
+
+"""
+Barnes-Hut Flat Quadtree
+
+The same quadtree as barnes_hut_quadtree, stored as a structure of arrays
+instead of one Python object per node.
+
+Every node is an integer id indexing into contiguous NumPy arrays:
+
+child: node ids of the 4 subnodes (-1 where a quadrant is empty)
+mass: mass of every body inside the node
+com: center of mass of the node
+corner: lower left corner of the node's square
+side: side length of the node's square
+body: body index held by a leaf node (-1 for internal nodes)
+
+The bodies themselves are plain arrays as well:
+
+position: N x 2 array of positions
+momentum: N x 2 array of momentums
+mass: N masses
+
+A node costs around 70 bytes in these arrays, against several hundred
+for a node object holding its own small NumPy arrays and subnode list,
+so trees of 100,000+ bodies fit comfortably in memory.
+
+The tree can be built in two ways:
+
+build_tree
+    - Computes the Morton (Z-curve) key of every body in one vectorized
+      pass and sorts the bodies by it
+    - Every node then covers a contiguous run of the sorted bodies, so
+      the nodes of each level, their masses and centers of mass come
+      straight from the runs without any recursion or per body insertion
+
+build_tree_by_insertion
+    - Inserts the bodies one at a time with add_body
+
+build_tree can also stop splitting nodes once they hold leaf_capacity
+bodies or fewer. These bucket leaves are summed directly with a small
+NumPy kernel, which cuts the number of nodes, the depth of the tree
+and the Python work of every walk. tune_leaf_capacity times a step for
+several capacities and picks the fastest for a given set of bodies.
+
+refit_tree keeps the tree of the previous timestep instead of building
+a new one. Bodies that have left their leaf are moved into the leaf
+now containing them, then the masses, centers of mass (and
+quadrupoles) are recomputed from the leaves up in O(N). The tree is
+only rebuilt from scratch when too many bodies have moved, a body has
+moved into an empty quadrant or out of the root square, or a leaf has
+filled up well past its capacity.
+
+build_tree(..., multipole_order=2) also stores the quadrupole moment
+of every node about its center of mass. Far away nodes then pull with
+their monopole and quadrupole terms, which is accurate enough to open
+far fewer nodes: with 2000 random bodies the per body walk is more
+accurate at theta = 0.8 than the monopole walk at 0.5, and the group
+walk at theta = 1.0 (see barnes_hut_multipole_error).
+
+Every walk uses Barnes' offset opening criterion: a node acts through
+its center of mass when
+
+    distance > side / theta + offset
+
+where distance is measured from the center of mass and offset is the
+distance between the center of mass and the center of the node's
+square. A node whose square holds the body being walked for is then
+never used through its center of mass for theta below sqrt(2), so the
+quadrupole terms are never asked to stand in for a pull from inside
+the node.
+
+The group walk can evaluate its interaction lists in float32 with
+precision="float32", halving the size of its temporaries. The tree is
+still built, and the forces summed, in float64.
+"""
+
+# THE QUADTREE USED HERE IS INSPIRED BY THE WORK OF LEWIS COLE
+# https://lewiscoleblog.com/barnes-hut
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Nodes smaller than this are not split any further
+# Bodies that fall into the same node below this size share a leaf
+min_quad_size = 1.e-5
+
+
+class FlatQuadtree:
+    def __init__(self, number_of_bodies, origin=(0.0, 0.0), size=1.0):
+        """
+        number_of_bodies: number of bodies the tree will hold
+        origin: lower left corner of the root square
+        size: side length of the root square
+        root: node id of the root node (-1 while the tree is empty)
+        count: number of nodes in use
+        next_body: links the bodies sharing a leaf below min_quad_size,
+        -1 ends the list
+        order: body indices sorted by Morton key (build_tree only)
+        body_start, body_count: the run of order covered by every node
+        (build_tree only)
+        leaf_capacity: most bodies a leaf is allowed to hold
+        quadrupole: traceless quadrupole moment Qxx, Qxy, Qyy of every
+        node about its center of mass (None unless built with
+        multipole_order=2)
+        refits: number of times refit_tree has updated the tree since
+        it was built
+        """
+        # A tree of N bodies has roughly 2N nodes, grown on demand
+        capacity = max(2 * number_of_bodies, 4)
+        self.child = np.full((capacity, 4), -1, dtype=np.int32)
+        self.mass = np.zeros(capacity)
+        self.com = np.zeros((capacity, 2))
+        self.corner = np.zeros((capacity, 2))
+        self.side = np.zeros(capacity)
+        self.body = np.full(capacity, -1, dtype=np.int32)
+        self.next_body = np.full(number_of_bodies, -1, dtype=np.int32)
+
+        self.order = None
+        self.body_start = None
+        self.body_count = None
+        self.leaf_capacity = 1
+        self.quadrupole = None
+        self.refits = 0
+
+        self.origin = np.asarray(origin, dtype=float)
+        self.size = float(size)
+        self.root = -1
+        self.count = 0
+
+    # Double the size of every node array
+    def grow(self):
+        capacity = 2 * self.child.shape[0]
+        child = np.full((capacity, 4), -1, dtype=np.int32)
+        child[:self.count] = self.child[:self.count]
+        body = np.full(capacity, -1, dtype=np.int32)
+        body[:self.count] = self.body[:self.count]
+        self.child = child
+        self.body = body
+        self.mass = np.resize(self.mass, capacity)
+        self.com = np.resize(self.com, (capacity, 2))
+        self.corner = np.resize(self.corner, (capacity, 2))
+        self.side = np.resize(self.side, capacity)
+        if self.body_start is not None:
+            self.body_start = np.resize(self.body_start, capacity)
+            self.body_count = np.resize(self.body_count, capacity)
+        if self.quadrupole is not None:
+            self.quadrupole = np.resize(self.quadrupole, (capacity, 3))
+
+    # Create a leaf node holding a single body and return its id
+    def new_leaf(self, corner_x, corner_y, side, body, x, y, mass):
+        if self.count == self.child.shape[0]:
+            self.grow()
+        leaf = self.count
+        self.count += 1
+        self.child[leaf] = -1
+        self.mass[leaf] = mass
+        self.com[leaf, 0] = x
+        self.com[leaf, 1] = y
+        self.corner[leaf, 0] = corner_x
+        self.corner[leaf, 1] = corner_y
+        self.side[leaf] = side
+        self.body[leaf] = body
+        return leaf
+
+    # Quadrant of a node containing the point x, y and that quadrant's corner
+    # Numbered the same way as node.quadrant_next_node
+    def quadrant(self, node, x, y):
+        half = 0.5 * self.side[node]
+        corner_x = self.corner[node, 0]
+        corner_y = self.corner[node, 1]
+        right = x >= corner_x + half
+        upper = y >= corner_y + half
+        return (
+            int(upper) + 2 * int(right),
+            corner_x + half * right,
+            corner_y + half * upper
+            )
+
+    # Number of bytes used by the node arrays of the tree
+    def nbytes(self):
+        return sum(
+            array[:self.count].nbytes
+            for array in (
+                self.child, self.mass, self.com,
+                self.corner, self.side, self.body
+                )
+            )
+
+
+# Adds body to the quadtree
+# Walks down from the root, adding the body's mass to every node it
+# passes, until it finds an empty quadrant or a leaf to split
+def add_body(tree, body, position, mass):
+    x = float(position[body, 0])
+    y = float(position[body, 1])
+    m = float(mass[body])
+
+    if tree.root < 0:
+        tree.root = tree.new_leaf(
+            tree.origin[0], tree.origin[1], tree.size, body, x, y, m
+            )
+        return
+
+    node = tree.root
+    while True:
+        # The center of mass is the mass weighted mean of the positions
+        node_mass = tree.mass[node]
+        total = node_mass + m
+        tree.com[node, 0] = (tree.com[node, 0] * node_mass + x * m) / total
+        tree.com[node, 1] = (tree.com[node, 1] * node_mass + y * m) / total
+        tree.mass[node] = total
+
+        if tree.body[node] >= 0:
+            # Too small to split, the body shares this leaf
+            if tree.side[node] <= min_quad_size:
+                tree.next_body[body] = tree.next_body[tree.body[node]]
+                tree.next_body[tree.body[node]] = body
+                return
+
+            # Turn the leaf into an internal node
+            # and move its body one level down
+            old = tree.body[node]
+            old_x = float(position[old, 0])
+            old_y = float(position[old, 1])
+            quad, corner_x, corner_y = tree.quadrant(node, old_x, old_y)
+            tree.body[node] = -1
+            tree.child[node, quad] = tree.new_leaf(
+                corner_x, corner_y, 0.5 * tree.side[node],
+                old, old_x, old_y, float(mass[old])
+                )
+
+        quad, corner_x, corner_y = tree.quadrant(node, x, y)
+        subnode = tree.child[node, quad]
+        if subnode < 0:
+            tree.child[node, quad] = tree.new_leaf(
+                corner_x, corner_y, 0.5 * tree.side[node], body, x, y, m
+                )
+            return
+        node = subnode
+
+
+# Smallest square containing every body, as its corner and side length
+# margin: extra room left on every side, as a fraction of the side
+def root_square(position, margin=0.0):
+    if position.shape[0] == 0:
+        return np.zeros(2), 1.0
+    origin = position.min(axis=0)
+    size = (position.max(axis=0) - origin).max()
+    # Grow the square slightly so the furthest bodies fall inside it
+    size = size * (1.0 + 1.e-9) if size > 0 else 1.0
+    return origin - margin * size, size * (1.0 + 2 * margin)
+
+
+# Build the quadtree by inserting the bodies one at a time
+def build_tree_by_insertion(position, mass):
+    N = position.shape[0]
+    origin, size = root_square(position)
+    tree = FlatQuadtree(N, origin, size)
+    for body in range(N):
+        add_body(tree, body, position, mass)
+    return tree
+
+
+# Number of levels resolved by the Morton keys
+# Bodies closer together than size / 2**morton_levels share a leaf,
+# which also bounds the depth of the tree
+morton_levels = 30
+
+
+# Spread the bits of integers below 2**32 onto the even bits of 64 bits
+def spread_bits(n):
+    n = n.astype(np.uint64)
+    for shift, bits in (
+            (16, 0x0000FFFF0000FFFF),
+            (8, 0x00FF00FF00FF00FF),
+            (4, 0x0F0F0F0F0F0F0F0F),
+            (2, 0x3333333333333333),
+            (1, 0x5555555555555555)):
+        n = (n | (n << np.uint64(shift))) & np.uint64(bits)
+    return n
+
+
+# Morton key of every body inside the square at origin with side size
+# Every 2 bits of a key, from the top, are the quadrant the body is in
+# at the next level, numbered the same way as node.quadrant_next_node
+def morton_keys(position, origin, size, levels=morton_levels):
+    cells = 2**levels
+    grid = np.floor((position - origin) / size * cells)
+    grid = np.clip(grid, 0, cells - 1).astype(np.uint64)
+    return (spread_bits(grid[:, 0]) << np.uint64(1)) | spread_bits(grid[:, 1])
+
+
+# Multipole orders a tree can be built with
+# 0: monopole (mass and center of mass) only, 2: monopole and quadrupole
+multipole_orders = (0, 2)
+
+
+# Traceless quadrupole terms Qxx, Qxy, Qyy of bodies at offset from a
+# center of mass, one row per body, for gravity falling off as 1 / r²
+def quadrupole_moment(mass, offset):
+    x = offset[:, 0]
+    y = offset[:, 1]
+    return mass[:, np.newaxis] * np.column_stack((
+        2 * x * x - y * y,
+        3 * x * y,
+        2 * y * y - x * x
+        ))
+
+
+# Build the quadtree from the bodies sorted by Morton key
+# Level by level, the nodes are the runs of sorted bodies sharing a key
+# prefix, found with one vectorized pass over the bodies still inside
+# internal nodes. Runs of leaf_capacity bodies or fewer become leaves.
+def build_tree(
+        position, mass, levels=morton_levels, leaf_capacity=1,
+        multipole_order=0, margin=0.0):
+    N = position.shape[0]
+    mass = np.reshape(mass, -1)
+    if leaf_capacity < 1:
+        raise ValueError(
+            "leaf_capacity must be at least 1, got %d" % leaf_capacity
+            )
+    if multipole_order not in multipole_orders:
+        raise ValueError(
+            "multipole_order must be one of %s, got %r"
+            % (multipole_orders, multipole_order)
+            )
+    quadrupole = multipole_order == 2
+    origin, size = root_square(position, margin)
+    tree = FlatQuadtree(N, origin, size)
+    tree.leaf_capacity = leaf_capacity
+    if N == 0:
+        return tree
+
+    keys = morton_keys(position, origin, size, levels)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    sorted_mass = mass[order]
+    sorted_position = position[order]
+
+    # Per level arrays of the new nodes, starting with the root
+    parents = [np.array([-1])]
+    quadrants = [np.array([0])]
+    starts = [np.array([0])]
+    counts = [np.array([N])]
+    masses = [np.array([sorted_mass.sum()])]
+    coms = [(sorted_mass @ sorted_position)[np.newaxis] / masses[0]]
+    corners = [origin[np.newaxis].astype(float)]
+    sides = [np.array([size])]
+    leaves = [np.array([N <= leaf_capacity])]
+    quadrupoles = []
+    if quadrupole:
+        quadrupoles.append(quadrupole_moment(
+            sorted_mass, sorted_position - coms[0]
+            ).sum(axis=0)[np.newaxis])
+
+    # Bodies still inside an internal node, as indices into the
+    # sorted order, and the id of that node
+    active = np.arange(N) if N > leaf_capacity else np.arange(0)
+    active_parent = np.zeros(active.size, dtype=int)
+    next_id = 1
+
+    for level in range(1, levels + 1):
+        if active.size == 0:
+            break
+        prefix = keys[active] >> np.uint64(2 * (levels - level))
+
+        # A new run starts wherever the key prefix changes
+        new_run = np.empty(active.size, dtype=bool)
+        new_run[0] = True
+        new_run[1:] = prefix[1:] != prefix[:-1]
+        run = np.flatnonzero(new_run)
+        run_count = np.diff(np.append(run, active.size))
+        ids = next_id + np.arange(run.size)
+
+        quadrant = (prefix[run] & np.uint64(3)).astype(int)
+        parent = active_parent[run]
+        side = size / 2**level
+        offset = np.column_stack((quadrant >> 1, quadrant & 1)) * side
+
+        active_mass = sorted_mass[active]
+        run_mass = np.add.reduceat(active_mass, run)
+        run_com = np.add.reduceat(
+            active_mass[:, np.newaxis] * sorted_position[active], run
+            ) / run_mass[:, np.newaxis]
+
+        # Parent corners, looked up in the previous level
+        parent_corner = corners[-1][parent - (next_id - corners[-1].shape[0])]
+
+        if quadrupole:
+            offset_from_com = sorted_position[active] - np.repeat(
+                run_com, run_count, axis=0
+                )
+            quadrupoles.append(np.add.reduceat(
+                quadrupole_moment(active_mass, offset_from_com), run
+                ))
+
+        leaf = (run_count <= leaf_capacity) | (level == levels)
+        parents.append(parent)
+        quadrants.append(quadrant)
+        starts.append(active[run])
+        counts.append(run_count)
+        masses.append(run_mass)
+        coms.append(run_com)
+        corners.append(parent_corner + offset)
+        sides.append(np.full(run.size, side))
+        leaves.append(leaf)
+
+        # Only the bodies of internal nodes carry on to the next level
+        keep = np.repeat(~leaf, run_count)
+        active_parent = np.repeat(ids, run_count)[keep]
+        active = active[keep]
+        next_id += run.size
+
+    # Fill in the tree's arrays
+    count = next_id
+    parent = np.concatenate(parents)
+    quadrant = np.concatenate(quadrants)
+    tree.child = np.full((count, 4), -1, dtype=np.int32)
+    tree.child[parent[1:], quadrant[1:]] = np.arange(1, count)
+    tree.mass = np.concatenate(masses)
+    tree.com = np.concatenate(coms)
+    tree.corner = np.concatenate(corners)
+    tree.side = np.concatenate(sides)
+    tree.body_start = np.concatenate(starts)
+    tree.body_count = np.concatenate(counts)
+    tree.order = order
+    if quadrupole:
+        tree.quadrupole = np.concatenate(quadrupoles)
+    tree.root = 0
+    tree.count = count
+
+    tree.body = np.full(count, -1, dtype=np.int32)
+    link_leaf_bodies(tree, np.flatnonzero(np.concatenate(leaves)))
+    instrumentation.gauge("tree nodes", count)
+    instrumentation.gauge("tree depth", len(sides) - 1)
+    return tree
+
+
+# Point every leaf at its first body and link the bodies sharing a leaf
+# leaves: node ids of every leaf
+def link_leaf_bodies(tree, leaves):
+    order = tree.order
+    tree.body[leaves] = order[tree.body_start[leaves]]
+    tree.next_body[:] = -1
+
+    shared = leaves[tree.body_count[leaves] > 1]
+    links = tree.body_count[shared] - 1
+    if links.size:
+        first = tree.body_start[shared]
+        index = np.arange(links.sum()) + np.repeat(
+            first - np.cumsum(links) + links, links
+            )
+        tree.next_body[order[index]] = order[index + 1]
+
+
+# Rebuild the tree instead of refitting it once more than this share of
+# the bodies have left their leaves
+refit_escape_fraction = 0.05
+
+# ... or once a leaf holds more than this many times leaf_capacity bodies
+refit_overfill = 2
+
+# Room left around the bodies by trees built to be refitted, as a
+# fraction of the root square, so bodies near the edge can move
+# outwards without forcing a rebuild
+refit_margin = 0.05
+
+
+# Nodes reachable from the root, one level at a time
+# Returns the internal nodes of every level, root first, and the leaves
+def tree_levels(tree):
+    levels = []
+    leaves = []
+    frontier = np.array([tree.root])
+    while frontier.size:
+        leaf = tree.body[frontier] >= 0
+        leaves.append(frontier[leaf])
+        levels.append(frontier[~leaf])
+        child = tree.child[frontier[~leaf]]
+        frontier = child[child >= 0]
+    return levels, np.concatenate(leaves)
+
+
+# Walk every position down the quadrants as far as the tree goes
+# Returns the node each walk stopped at and the empty quadrant of that
+# node the position is in (-1 when it stopped at a leaf)
+# The node is -1 for positions outside the root square
+def locate_leaves(tree, position):
+    low = tree.corner[tree.root]
+    high = low + tree.side[tree.root]
+    inside = ((position >= low) & (position < high)).all(axis=1)
+    node = np.where(inside, tree.root, -1)
+    empty = np.full(position.shape[0], -1)
+
+    walking = np.flatnonzero(inside & (tree.body[tree.root] < 0))
+    while walking.size:
+        current = node[walking]
+        middle = tree.corner[current] + tree.side[current, np.newaxis] / 2
+        upper = position[walking] >= middle
+        quadrant = 2 * upper[:, 0] + upper[:, 1]
+        subnode = tree.child[current, quadrant]
+
+        missing = subnode < 0
+        empty[walking[missing]] = quadrant[missing]
+        walking = walking[~missing]
+        node[walking] = subnode[~missing]
+        walking = walking[tree.body[node[walking]] < 0]
+    return node, empty
+
+
+# New leaves in the empty quadrant of each parent node
+# Returns their node ids
+def add_leaves(tree, parent, quadrant):
+    while tree.count + parent.size > tree.child.shape[0]:
+        tree.grow()
+    leaves = tree.count + np.arange(parent.size)
+    tree.count += parent.size
+
+    side = tree.side[parent] / 2
+    offset = np.column_stack((quadrant >> 1, quadrant & 1))
+    tree.child[leaves] = -1
+    tree.child[parent, quadrant] = leaves
+    tree.corner[leaves] = tree.corner[parent] + offset * side[:, np.newaxis]
+    tree.side[leaves] = side
+    # Marks the nodes as leaves until link_leaf_bodies fills them in
+    tree.body[leaves] = 0
+    return leaves
+
+
+# Body counts and starts of every node after bodies moved between leaves
+# leaves: every leaf, in the order of their runs, holding leaf_count
+def recount_nodes(tree, leaves, leaf_count, levels):
+    tree.body_count[leaves] = leaf_count
+    for nodes in reversed(levels):
+        child = tree.child[nodes]
+        tree.body_count[nodes] = np.where(
+            child >= 0, tree.body_count[child], 0
+            ).sum(axis=1)
+
+    # Subnodes follow each other in quadrant order inside their parent
+    tree.body_start[tree.root] = 0
+    for nodes in levels:
+        child = tree.child[nodes]
+        present = child >= 0
+        count = np.where(present, tree.body_count[child], 0)
+        start = tree.body_start[nodes, np.newaxis] + np.cumsum(count, axis=1)
+        tree.body_start[child[present]] = (start - count)[present]
+
+
+# Masses, centers of mass and quadrupoles of every node for the current
+# positions, summed over the leaves and then up the tree level by level
+def update_moments(tree, position, mass, leaves, levels):
+    sorted_mass = mass[tree.order]
+    sorted_position = position[tree.order]
+    start = tree.body_start[leaves]
+    tree.mass[leaves] = np.add.reduceat(sorted_mass, start)
+    tree.com[leaves] = np.add.reduceat(
+        sorted_mass[:, np.newaxis] * sorted_position, start
+        ) / tree.mass[leaves, np.newaxis]
+    if tree.quadrupole is not None:
+        com = np.repeat(tree.com[leaves], tree.body_count[leaves], axis=0)
+        tree.quadrupole[leaves] = np.add.reduceat(
+            quadrupole_moment(sorted_mass, sorted_position - com), start
+            )
+
+    for nodes in reversed(levels):
+        child = tree.child[nodes]
+        present = child >= 0
+        child = np.where(present, child, nodes[:, np.newaxis])
+        child_mass = np.where(present, tree.mass[child], 0.0)
+        tree.mass[nodes] = child_mass.sum(axis=1)
+        tree.com[nodes] = np.einsum(
+            "ij,ijk->ik", child_mass, tree.com[child]
+            ) / tree.mass[nodes, np.newaxis]
+        if tree.quadrupole is not None:
+            # Subnode quadrupoles moved to the node's center of mass
+            offset = tree.com[child] - tree.com[nodes, np.newaxis]
+            shifted = tree.quadrupole[child] + quadrupole_moment(
+                child_mass.ravel(), offset.reshape(-1, 2)
+                ).reshape(child.shape + (3,))
+            tree.quadrupole[nodes] = np.where(
+                present[:, :, np.newaxis], shifted, 0.0
+                ).sum(axis=1)
+
+
+# Update a tree made by build_tree for the bodies' new positions
+# The tree is changed in place and must be replaced by the tree returned,
+# which is a new tree when it had to be rebuilt
+def refit_tree(
+        tree, position, mass, escape_fraction=refit_escape_fraction,
+        overfill=refit_overfill):
+    N = position.shape[0]
+    mass = np.reshape(mass, -1)
+    multipole_order = 0 if tree.quadrupole is None else 2
+
+    def rebuild():
+        return build_tree(
+            position, mass, leaf_capacity=tree.leaf_capacity,
+            multipole_order=multipole_order, margin=refit_margin
+            )
+
+    if tree.order is None or tree.root < 0 or tree.order.size != N:
+        return rebuild()
+
+    levels, leaves = tree_levels(tree)
+    leaves = leaves[np.argsort(tree.body_start[leaves])]
+    leaf_of_body = np.repeat(leaves, tree.body_count[leaves])
+
+    # Bodies in Morton order that have left the square of their leaf
+    sorted_position = position[tree.order]
+    low = tree.corner[leaf_of_body]
+    high = low + tree.side[leaf_of_body, np.newaxis]
+    escaped = np.flatnonzero(
+        ((sorted_position < low) | (sorted_position >= high)).any(axis=1)
+        )
+    if escaped.size > escape_fraction * N:
+        return rebuild()
+
+    if escaped.size:
+        node, empty = locate_leaves(tree, sorted_position[escaped])
+        if (node < 0).any():
+            return rebuild()
+
+        # Bodies in empty quadrants get new leaves, one per quadrant
+        new = empty >= 0
+        if new.any():
+            quadrants, first = np.unique(
+                node[new] * 4 + empty[new], return_inverse=True
+                )
+            added = add_leaves(tree, quadrants // 4, quadrants % 4)
+            node[new] = added[first]
+        leaf_of_body[escaped] = node
+
+        previous_count = np.zeros(tree.count, dtype=int)
+        previous_count[leaves] = tree.body_count[leaves]
+        leaf_count = np.bincount(leaf_of_body, minlength=tree.count)
+
+        # Leaves left empty are cut from the tree
+        emptied = leaves[leaf_count[leaves] == 0]
+        if emptied.size:
+            parent, quadrant = np.nonzero(
+                np.isin(tree.child[:tree.count], emptied)
+                )
+            tree.child[parent, quadrant] = -1
+
+        levels, leaves = tree_levels(tree)
+        too_full = leaf_count[leaves] > np.maximum(
+            previous_count[leaves], overfill * tree.leaf_capacity
+            )
+        childless = ~(tree.child[np.concatenate(levels)] >= 0).any(axis=1)
+        if too_full.any() or childless.any():
+            return rebuild()
+
+        # Leaves in Morton order of their centers, so the escaped bodies
+        # move into the runs of their new leaves
+        center = tree.corner[leaves] + tree.side[leaves, np.newaxis] / 2
+        leaves = leaves[np.argsort(
+            morton_keys(center, tree.origin, tree.size)
+            )]
+        rank = np.zeros(tree.count, dtype=int)
+        rank[leaves] = np.arange(leaves.size)
+        tree.order = tree.order[
+            np.argsort(rank[leaf_of_body], kind="stable")
+            ]
+        recount_nodes(tree, leaves, leaf_count[leaves], levels)
+        link_leaf_bodies(tree, leaves)
+
+    update_moments(tree, position, mass, leaves, levels)
+    tree.refits += 1
+    instrumentation.gauge("tree nodes", tree.count)
+    instrumentation.gauge("tree depth", len(levels) - 1)
+    return tree
+
+
+# Distance between the center of mass and the center of the square of
+# every node, for the offset opening criterion
+def node_offsets(tree):
+    count = tree.count
+    center = tree.corner[:count] + tree.side[:count, np.newaxis] / 2
+    return np.linalg.norm(tree.com[:count] - center, axis=1)
+
+
+# Force applied to a body by a node
+# Far away internal nodes act through their center of mass,
+# otherwise the subnodes are visited
+# offset: node_offsets of the tree, worked out here unless given
+def force_on(tree, body, node, theta, position, mass, offset=None):
+    if tree.body[node] >= 0:
+        # A leaf - pull of every body in it except the body itself
+        force = np.zeros(2)
+        other = tree.body[node]
+        while other >= 0:
+            d = position[other] - position[body]
+            # Skips the body itself and any body at exactly the same place
+            if d @ d > 0:
+                force += d * (mass[other] * mass[body] / np.sqrt(d @ d)**3)
+            other = tree.next_body[other]
+        return force
+
+    if offset is None:
+        offset = node_offsets(tree)
+    dx = tree.com[node, 0] - position[body, 0]
+    dy = tree.com[node, 1] - position[body, 1]
+    distance = math.sqrt(dx * dx + dy * dy)
+    if tree.side[node] < (distance - offset[node]) * theta:
+        scale = tree.mass[node] * mass[body] / distance**3
+        return np.array((dx * scale, dy * scale))
+
+    return sum(
+        force_on(tree, body, c, theta, position, mass, offset)
+        for c in tree.child[node].tolist() if c >= 0
+    )
+
+
+# Force applied to a body by the whole tree, without recursion
+# Nodes still to visit are kept on an explicit stack, and the force is
+# accumulated into row body of the preallocated force array.
+# Uses the same opening criterion as force_on, and pushes the subnodes
+# in reverse so they are visited in the same order.
+# nodes is the tree as plain lists, see TreeLists
+def force_on_iterative(nodes, body, theta, position, mass, force, stack):
+    child = nodes.child
+    node_mass = nodes.mass
+    com_x = nodes.com_x
+    com_y = nodes.com_y
+    side = nodes.side
+    offset = nodes.offset
+    leaf_body = nodes.body
+    next_body = nodes.next_body
+    body_count = nodes.body_count
+    quadrupole = nodes.quadrupole
+    x, y = position[body]
+    body_mass = mass[body]
+    fx = 0.0
+    fy = 0.0
+    buckets = []
+
+    stack.append(nodes.root)
+    while stack:
+        node = stack.pop()
+        dx = com_x[node] - x
+        dy = com_y[node] - y
+        distance = math.sqrt(dx * dx + dy * dy)
+        if side[node] < (distance - offset[node]) * theta:
+            scale = node_mass[node] * body_mass / distance**3
+            fx += dx * scale
+            fy += dy * scale
+            if quadrupole is not None:
+                # Quadrupole term, with d pointing from the body to the
+                # center of mass: (2.5 (d.Q.d) d / r² - Q.d) / r^5
+                qxx, qxy, qyy = quadrupole[node]
+                qd_x = qxx * dx + qxy * dy
+                qd_y = qxy * dx + qyy * dy
+                dqd = (dx * qd_x + dy * qd_y) * 2.5 / (distance * distance)
+                scale = body_mass / distance**5
+                fx += (dqd * dx - qd_x) * scale
+                fy += (dqd * dy - qd_y) * scale
+            continue
+
+        other = leaf_body[node]
+        if other >= 0:
+            # Nearby bucket leaves are summed together with NumPy at the end
+            if body_count is not None and body_count[node] > 1:
+                buckets.append(node)
+                continue
+
+            # A leaf - pull of every body in it except the body itself
+            while other >= 0:
+                dx = position[other][0] - x
+                dy = position[other][1] - y
+                r2 = dx * dx + dy * dy
+                if r2 > 0:
+                    scale = mass[other] * body_mass / (r2 * math.sqrt(r2))
+                    fx += dx * scale
+                    fy += dy * scale
+                other = next_body[other]
+            continue
+
+        for c in reversed(child[node]):
+            if c >= 0:
+                stack.append(c)
+
+    if buckets:
+        bucket_x, bucket_y = nodes.bucket_force(buckets, x, y, body_mass)
+        fx += bucket_x
+        fy += bucket_y
+
+    force[body, 0] = fx
+    force[body, 1] = fy
+
+
+# The node arrays of a tree as plain Python lists
+# Indexing a list from Python is much faster than indexing an array,
+# so the iterative walk reads the tree through these
+class TreeLists:
+    def __init__(self, tree, position=None, mass=None):
+        """
+        root: node id of the root node
+        child, mass, com_x, com_y, side, body, next_body:
+        the tree's arrays of the same names as lists
+        offset: node_offsets of the tree as a list
+        body_start, body_count: the run of sorted bodies in every node,
+        only kept when the tree has bucket leaves and position and mass
+        are given (None otherwise)
+        sorted_position, sorted_mass: the bodies in Morton order, so the
+        bodies of a bucket leaf are one slice
+        quadrupole: the tree's quadrupole moments as lists (None when
+        the tree has none)
+        """
+        count = tree.count
+        self.root = tree.root
+        self.child = tree.child[:count].tolist()
+        self.mass = tree.mass[:count].tolist()
+        self.com_x = tree.com[:count, 0].tolist()
+        self.com_y = tree.com[:count, 1].tolist()
+        self.side = tree.side[:count].tolist()
+        self.offset = node_offsets(tree).tolist()
+        self.body = tree.body[:count].tolist()
+        self.next_body = tree.next_body.tolist()
+        self.quadrupole = None
+        if tree.quadrupole is not None:
+            self.quadrupole = tree.quadrupole[:count].tolist()
+
+        self.body_start = None
+        self.body_count = None
+        if tree.leaf_capacity > 1 and position is not None:
+            self.body_start = tree.body_start.tolist()
+            self.body_count = tree.body_count.tolist()
+            self.sorted_position = position[tree.order]
+            self.sorted_mass = np.reshape(mass, -1)[tree.order]
+
+    # Direct sum kernel for bucket leaves
+    # Pull of every body in the leaves on a body of mass body_mass at x, y
+    def bucket_force(self, leaves, x, y, body_mass):
+        runs = [
+            slice(self.body_start[leaf],
+                  self.body_start[leaf] + self.body_count[leaf])
+            for leaf in leaves
+        ]
+        source = np.concatenate([self.sorted_position[run] for run in runs])
+        source_mass = np.concatenate([self.sorted_mass[run] for run in runs])
+
+        dx = source[:, 0] - x
+        dy = source[:, 1] - y
+        r2 = dx * dx + dy * dy
+        # Drops the body itself and any body at the same place
+        with np.errstate(divide="ignore"):
+            scale = np.where(r2 > 0, r2 ** -1.5, 0.0) * source_mass
+        return body_mass * (dx @ scale), body_mass * (dy @ scale)
+
+
+# Forces on every body with the iterative walk, written into force
+# bodies: only walk for these bodies (all bodies by default)
+# nodes: the tree's TreeLists, made with position and mass, made here
+# unless given (see walk_forces_grouped)
+def walk_forces(
+        tree, position, mass, theta, force=None, bodies=None, nodes=None):
+    N = position.shape[0]
+    if force is None:
+        force = np.zeros((N, 2))
+    if tree.root < 0:
+        return force
+
+    if nodes is None:
+        nodes = TreeLists(tree, position, mass)
+    body_position = position.tolist()
+    body_mass = np.reshape(mass, -1).tolist()
+    stack = []
+    order = walk_order(tree, N)
+    if bodies is not None:
+        # Still in Morton order, so close bodies are walked together
+        walking = np.zeros(N, dtype=bool)
+        walking[bodies] = True
+        walking = walking.tolist()
+        order = [body for body in order if walking[body]]
+    for body in order:
+        force_on_iterative(
+            nodes, body, theta, body_position, body_mass, force, stack
+            )
+    return force
+
+
+# Default number of bodies sharing one interaction list in the group walk
+group_size = 32
+
+
+# Groups of the group walk
+# The largest nodes holding at most max_bodies bodies, as the run of
+# tree.order each one covers
+def find_groups(tree, max_bodies):
+    if tree.order is None:
+        raise ValueError(
+            "The group walk needs a tree made by build_tree, "
+            "which keeps the bodies sorted"
+            )
+    starts = []
+    counts = []
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        if tree.body_count[node] <= max_bodies or tree.body[node] >= 0:
+            starts.append(tree.body_start[node])
+            counts.append(tree.body_count[node])
+        else:
+            stack.extend(c for c in tree.child[node].tolist() if c >= 0)
+    return starts, counts
+
+
+# Interaction list shared by every body inside the box low - high
+# A node is only used through its center of mass when the opening
+# criterion holds for every point of the box, using the distance from
+# the center of mass to the nearest point of the box. This is at least
+# as strict as walking for each body in the box separately.
+# Returns the node ids used through their center of mass and the
+# leaf bodies that interact directly
+def interaction_list(nodes, low_x, low_y, high_x, high_y, theta):
+    child = nodes.child
+    side = nodes.side
+    offset = nodes.offset
+    com_x = nodes.com_x
+    com_y = nodes.com_y
+    leaf_body = nodes.body
+    next_body = nodes.next_body
+
+    far = []
+    near = []
+    stack = [nodes.root]
+    while stack:
+        node = stack.pop()
+        x = com_x[node]
+        y = com_y[node]
+        dx = low_x - x if x < low_x else (x - high_x if x > high_x else 0.0)
+        dy = low_y - y if y < low_y else (y - high_y if y > high_y else 0.0)
+        distance = math.sqrt(dx * dx + dy * dy)
+        if side[node] < (distance - offset[node]) * theta:
+            far.append(node)
+            continue
+
+        other = leaf_body[node]
+        if other >= 0:
+            while other >= 0:
+                near.append(other)
+                other = next_body[other]
+            continue
+
+        for c in reversed(child[node]):
+            if c >= 0:
+                stack.append(c)
+    return far, near
+
+
+# Forces on every body with the group walk, written into force
+# Bodies in the same small node share one interaction list, which is
+# then evaluated for all of them at once with NumPy broadcasting
+# groups: the (starts, counts) of find_groups to walk, all by default
+# precision: floating point type the interaction lists are evaluated in
+# nodes: the tree's TreeLists, made here unless given, so callers
+# walking the same tree in several calls only make them once
+def walk_forces_grouped(
+        tree, position, mass, theta, max_bodies=None, force=None,
+        groups=None, precision="float64", nodes=None):
+    N = position.shape[0]
+    mass = np.reshape(mass, -1)
+    dtype = precision_dtype(precision)
+    if max_bodies is None:
+        max_bodies = group_size
+    if force is None:
+        force = np.zeros((N, 2))
+    if tree.root < 0:
+        return force
+
+    if groups is None:
+        groups = find_groups(tree, max_bodies)
+
+    if nodes is None:
+        nodes = TreeLists(tree)
+    # Masses and quadrupoles in the precision asked for
+    compute_mass = mass.astype(dtype, copy=False)
+    node_mass = tree.mass.astype(dtype, copy=False)
+    quadrupole = tree.quadrupole
+    if quadrupole is not None:
+        quadrupole = quadrupole.astype(dtype, copy=False)
+    interactions = 0
+    for start, count in zip(*groups):
+        members = tree.order[start:start + count]
+        member_position = position[members]
+        low = member_position.min(axis=0)
+        high = member_position.max(axis=0)
+        far, near = interaction_list(
+            nodes, low[0], low[1], high[0], high[1], theta
+            )
+
+        # Every source of the list, centers of mass and bodies together
+        # Positions are taken relative to the group's corner before they
+        # are rounded to the precision asked for, so close pairs keep
+        # the digits of their separation
+        source_position = (np.concatenate(
+            (tree.com[far], position[near])
+            ) - low).astype(dtype, copy=False)
+        member_position = (member_position - low).astype(dtype, copy=False)
+        source_mass = np.concatenate((node_mass[far], compute_mass[near]))
+        interactions += count * source_mass.size
+
+        # Displacements of every member to every source
+        d = source_position[np.newaxis, :, :] - member_position[:, np.newaxis]
+        r2 = (d**2).sum(axis=2)
+        # Drops the bodies themselves and any body at the same place
+        with np.errstate(divide="ignore"):
+            inverse = np.where(r2 > 0, r2 ** -1.5, 0.0)
+        # Summed over the sources in float64, whatever the precision
+        acceleration = np.einsum(
+            "ijk,ij->ik", d, inverse * source_mass, dtype=np.float64
+            )
+
+        # Quadrupole terms of the far nodes, as in force_on_iterative
+        if quadrupole is not None and far:
+            d = d[:, :len(far)]
+            q = quadrupole[far]
+            qd_x = q[:, 0] * d[:, :, 0] + q[:, 1] * d[:, :, 1]
+            qd_y = q[:, 1] * d[:, :, 0] + q[:, 2] * d[:, :, 1]
+            r2 = r2[:, :len(far)]
+            dqd = (d[:, :, 0] * qd_x + d[:, :, 1] * qd_y) * 2.5 / r2
+            inverse_r5 = r2 ** -2.5
+            acceleration[:, 0] += (
+                (dqd * d[:, :, 0] - qd_x) * inverse_r5
+                ).sum(axis=1, dtype=np.float64)
+            acceleration[:, 1] += (
+                (dqd * d[:, :, 1] - qd_y) * inverse_r5
+                ).sum(axis=1, dtype=np.float64)
+
+        force[members] = mass[members, np.newaxis] * acceleration
+    instrumentation.count("interactions", interactions)
+    instrumentation.count("bodies walked", sum(groups[1]))
+    return force
+
+
+# Order to walk the bodies in
+def walk_order(tree, number_of_bodies):
+    if tree.order is not None:
+        return tree.order.tolist()
+    return range(number_of_bodies)
+
+
+# Forces on every body, walking for each body or for each group
+# grouped: share interaction lists between bodies of the same small node
+# precision: "float32" evaluates the group walk's interaction lists in
+# float32, the per body walk works on Python floats and only allows
+# "float64"
+def tree_forces(
+        tree, position, mass, theta, grouped=False, precision="float64"):
+    if grouped:
+        return walk_forces_grouped(
+            tree, position, mass, theta, precision=precision
+            )
+    if precision_dtype(precision) is not np.float64:
+        raise ValueError(
+            "precision '%s' needs the group walk (grouped=True)" % precision
+            )
+    return walk_forces(tree, position, mass, theta)
+
+
+# Verlet algorithm
+# Every force is calculated from the same tree before any body moves
+# Bodies are walked in Morton order when the tree has one, so bodies
+# close together in space are walked one after another
+def verlet(
+        tree, position, momentum, mass, theta, G, timestep, grouped=False,
+        precision="float64"):
+    with instrumentation.timer("force walk"):
+        force = G * tree_forces(
+            tree, position, mass, theta, grouped, precision
+            )
+    with instrumentation.timer("integration"):
+        momentum += timestep * force
+        position += timestep * momentum / mass[:, np.newaxis]
+
+
+# Leaf capacities tried by tune_leaf_capacity
+leaf_capacity_candidates = (1, 2, 4, 8, 16, 32)
+
+# Best leaf capacity found for every
+# (number of bodies, theta, grouped, multipole order)
+tuned_leaf_capacity = {}
+
+
+# Time a tree build and force walk for each leaf capacity and return the
+# fastest one. The result is remembered for the number of bodies.
+def tune_leaf_capacity(
+        position, mass, theta, grouped=False,
+        candidates=leaf_capacity_candidates, multipole_order=0):
+    key = (position.shape[0], theta, grouped, multipole_order)
+    if key not in tuned_leaf_capacity:
+        timings = {}
+        for capacity in candidates:
+            start = time.perf_counter()
+            tree = build_tree(
+                position, mass, leaf_capacity=capacity,
+                multipole_order=multipole_order
+                )
+            tree_forces(tree, position, mass, theta, grouped)
+            timings[capacity] = time.perf_counter() - start
+        tuned_leaf_capacity[key] = min(timings, key=timings.get)
+    return tuned_leaf_capacity[key]
+
+
+# Leaf capacity to build with, tuning it first if asked to with "auto"
+def resolve_leaf_capacity(
+        position, mass, theta, grouped, leaf_capacity, multipole_order=0):
+    if leaf_capacity == "auto":
+        return tune_leaf_capacity(
+            position, mass, theta, grouped,
+            multipole_order=multipole_order
+            )
+    return leaf_capacity
+
+
+# One simulation cycle
+# leaf_capacity: most bodies per leaf, or "auto" to tune it
+# multipole_order: 0 for monopoles only, 2 to add quadrupoles
+# refit: keep the tree between cycles, refitting it to the new positions
+# tree: the tree returned by the previous cycle, refitted when refit is
+# on (a new tree is built otherwise)
+# precision: floating point type of the group walk's force arithmetic
+# Returns the tree used, so it can be passed to the next cycle
+def single_timestep_cycle(
+        position, momentum, mass, theta, g, step,
+        grouped=False, leaf_capacity=1, multipole_order=0,
+        refit=False, tree=None, precision="float64"):
+    if refit and tree is not None:
+        with instrumentation.timer("tree build"):
+            tree = refit_tree(tree, position, mass)
+    else:
+        leaf_capacity = resolve_leaf_capacity(
+            position, mass, theta, grouped, leaf_capacity, multipole_order
+            )
+        with instrumentation.timer("tree build"):
+            tree = build_tree(
+                position, mass, leaf_capacity=leaf_capacity,
+                multipole_order=multipole_order,
+                margin=refit_margin if refit else 0.0
+                )
+    verlet(
+        tree, position, momentum, mass, theta, g, step, grouped, precision
+        )
+    instrumentation.end_step()
+    return tree
+
+
+# Calculate the acceleration of every body with the flat quadtree
+# Same call as barnes_hut_quadtree.get_acceleration
+def get_acceleration(
+        position, mass, G, theta, grouped=False, leaf_capacity=1,
+        multipole_order=0, precision="float64"):
+    mass = np.reshape(mass, -1)
+    leaf_capacity = resolve_leaf_capacity(
+        position, mass, theta, grouped, leaf_capacity, multipole_order
+        )
+    with instrumentation.timer("tree build"):
+        tree = build_tree(
+            position, mass, leaf_capacity=leaf_capacity,
+            multipole_order=multipole_order
+            )
+    with instrumentation.timer("force walk"):
+        force = tree_forces(tree, position, mass, theta, grouped, precision)
+    return G * force / mass[:, np.newaxis]
+
+
+# Accelerations of the active bodies only, due to every body
+# Used by the block timestep integrator: the tree holds every body but
+# is only walked for the bodies whose timestep ends
+def get_acceleration_active(
+        active, position, mass, G, theta, leaf_capacity=1,
+        multipole_order=0):
+    mass = np.reshape(mass, -1)
+    with instrumentation.timer("tree build"):
+        tree = build_tree(
+            position, mass, leaf_capacity=leaf_capacity,
+            multipole_order=multipole_order
+            )
+    with instrumentation.timer("force walk"):
+        force = walk_forces(tree, position, mass, theta, bodies=active)
+    return G * force[active] / mass[active, np.newaxis]
+
+
+# Accelerations by direct summation with no softening, the reference
+# the tree's accelerations are measured against
+# The pairwise kernels work in 3D, so the bodies are placed at z = 0
+def direct_acceleration(position, mass, G):
+    N = position.shape[0]
+    position_3d = np.column_stack((position, np.zeros(N)))
+    return get_acceleration_symmetric(
+        position_3d, np.reshape(mass, (-1, 1)), G, 0.0
+        )[:, :2]
@@ -0,0 +1,361 @@
+import numpy as np
+
+from barnes_hut.barnes_hut_flat_tree import build_tree
+from simulation import instrumentation
+
+
+"""
+Fast Multipole Method (dual tree walk)
+
+An O(N) alternative to the Barnes-Hut walk, built on the same Morton
+ordered flat quadtree (barnes_hut_flat_tree.build_tree).
+
+Barnes-Hut walks the tree once for every body. The fast multipole
+method walks it once for pairs of nodes instead:
+
+1. Dual tree walk
+    - Starts from the pair (root, root)
+    - Two nodes far enough apart for their sizes interact cell to cell
+      (a multipole to local translation), otherwise the larger node is
+      opened and its subnodes are paired with the other node
+    - Two leaves that are too close are summed directly
+    - Every pair is only visited once and acts on both of its nodes
+
+2. Multipole to local (M2L)
+    - The pull of a far node is expanded about the center of mass of
+      the node it acts on as a local Taylor expansion:
+      acceleration, its gradient and its second derivatives
+    - The monopole and (when the tree has them) quadrupole moments of
+      the far node feed the expansion
+
+3. Local to local (L2L)
+    - Every node passes its expansion down to its subnodes, shifted to
+      their centers of mass, level by level from the root
+
+4. Local to particle (L2P)
+    - Every leaf evaluates its expansion at each of its bodies
+
+Only the walk itself is a Python loop. Every translation and the
+direct sums between close leaves are batched NumPy operations.
+
+Two nodes interact cell to cell when
+
+    radius_a + radius_b < theta * distance
+
+where radius is the furthest a body of the node can be from its
+center of mass and distance is the distance between the centers of
+mass.
+
+get_acceleration takes the same arguments as the pairwise kernels and
+the Barnes-Hut get_acceleration, so the engines can be compared head
+to head.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Default bodies per leaf for the fast multipole tree
+# Leaves are summed directly against their close neighbours in one
+# batched kernel, so the FMM prefers larger leaves than Barnes-Hut
+fmm_leaf_capacity = 8
+
+# Most body pairs handled by one batch of the direct sum kernel, and
+# most node pairs by one batch of the multipole to local translation
+pairs_per_batch = 1 << 20
+
+# Columns of a local expansion
+# ax, ay: acceleration at the node's center of mass
+# jxx, jxy, jyy: its gradient
+# hxxx, hxxy, hxyy, hyyy: its second derivatives
+local_terms = 9
+
+# Sign of every local expansion column when the direction between two
+# nodes is reversed, used to apply a node pair to both of its nodes
+reversed_sign = np.array([-1, -1, 1, 1, 1, -1, -1, -1, -1])
+
+
+# Largest distance of a body of every node from its center of mass,
+# bounded by the furthest corner of the node's square
+def node_radius(tree):
+    count = tree.count
+    corner = tree.corner[:count]
+    side = tree.side[:count, np.newaxis]
+    com = tree.com[:count]
+    furthest = np.maximum(com - corner, corner + side - com)
+    return np.sqrt((furthest * furthest).sum(axis=1))
+
+
+# Walk the tree in pairs of nodes
+# Returns the node pairs interacting cell to cell, the leaf pairs
+# summed directly and the leaves summed directly with themselves
+def dual_tree_walk(tree, theta):
+    count = tree.count
+    child = [
+        [node for node in row if node >= 0]
+        for row in tree.child[:count].tolist()
+    ]
+    leaf = (tree.body[:count] >= 0).tolist()
+    com_x = tree.com[:count, 0].tolist()
+    com_y = tree.com[:count, 1].tolist()
+    radius = node_radius(tree).tolist()
+    theta2 = theta * theta
+
+    far_sink, far_source = [], []
+    near_sink, near_source = [], []
+    self_leaves = []
+
+    stack = [(tree.root, tree.root)]
+    while stack:
+        a, b = stack.pop()
+
+        if a == b:
+            # A node with itself - pair up its subnodes
+            if leaf[a]:
+                self_leaves.append(a)
+                continue
+            subnodes = child[a]
+            for i, node in enumerate(subnodes):
+                stack.append((node, node))
+                for other in subnodes[i + 1:]:
+                    stack.append((node, other))
+            continue
+
+        dx = com_x[b] - com_x[a]
+        dy = com_y[b] - com_y[a]
+        size = radius[a] + radius[b]
+        if size * size < theta2 * (dx * dx + dy * dy):
+            far_sink.append(a)
+            far_source.append(b)
+        elif leaf[a] and leaf[b]:
+            near_sink.append(a)
+            near_source.append(b)
+        elif leaf[b] or (not leaf[a] and radius[a] >= radius[b]):
+            for node in child[a]:
+                stack.append((node, b))
+        else:
+            for node in child[b]:
+                stack.append((a, node))
+
+    return (
+        np.array(far_sink, dtype=int), np.array(far_source, dtype=int),
+        np.array(near_sink, dtype=int), np.array(near_source, dtype=int),
+        np.array(self_leaves, dtype=int)
+        )
+
+
+# Add values into the rows index of array, repeated indices included
+def accumulate(array, index, values):
+    for column in range(array.shape[1]):
+        array[:, column] += np.bincount(
+            index, weights=values[:, column], minlength=array.shape[0]
+            )
+
+
+# Local expansion of a unit mass at offset d from the expansion center
+def unit_local_expansion(d):
+    x = d[:, 0]
+    y = d[:, 1]
+    inverse_r2 = 1 / (x * x + y * y)
+    a = inverse_r2 * np.sqrt(inverse_r2)
+    b = a * inverse_r2
+    x_r = x * inverse_r2
+    y_r = y * inverse_r2
+    return np.column_stack((
+        a * x,
+        a * y,
+        a * (3 * x * x_r - 1),
+        a * 3 * x * y_r,
+        a * (3 * y * y_r - 1),
+        b * (15 * x * x * x_r - 9 * x),
+        b * (15 * x * x * y_r - 3 * y),
+        b * (15 * x * y * y_r - 3 * x),
+        b * (15 * y * y * y_r - 9 * y)
+        ))
+
+
+# Quadrupole part of the acceleration due to a node at offset d,
+# as in barnes_hut_flat_tree.force_on_iterative
+def quadrupole_acceleration(quadrupole, d):
+    x = d[:, 0]
+    y = d[:, 1]
+    r2 = x * x + y * y
+    qd_x = quadrupole[:, 0] * x + quadrupole[:, 1] * y
+    qd_y = quadrupole[:, 1] * x + quadrupole[:, 2] * y
+    dqd = (x * qd_x + y * qd_y) * 2.5 / r2
+    inverse_r5 = r2 ** -2.5
+    return np.column_stack((
+        (dqd * x - qd_x) * inverse_r5,
+        (dqd * y - qd_y) * inverse_r5
+        ))
+
+
+# Multipole to local translations of every far node pair, applied to
+# both nodes of the pair
+def multipole_to_local(tree, sink, source, local):
+    for start in range(0, sink.size, pairs_per_batch):
+        a = sink[start:start + pairs_per_batch]
+        b = source[start:start + pairs_per_batch]
+        d = tree.com[b] - tree.com[a]
+        unit = unit_local_expansion(d)
+
+        pull_on_a = unit * tree.mass[b, np.newaxis]
+        pull_on_b = unit * (reversed_sign * tree.mass[a, np.newaxis])
+        if tree.quadrupole is not None:
+            pull_on_a[:, :2] += quadrupole_acceleration(
+                tree.quadrupole[b], d
+                )
+            pull_on_b[:, :2] -= quadrupole_acceleration(
+                tree.quadrupole[a], d
+                )
+
+        accumulate(local, a, pull_on_a)
+        accumulate(local, b, pull_on_b)
+
+
+# Local expansions moved by offset s
+# Only the acceleration columns are needed when evaluating at bodies
+def shift_local(local, s, acceleration_only=False):
+    sx = s[:, 0]
+    sy = s[:, 1]
+    ax, ay, jxx, jxy, jyy, hxxx, hxxy, hxyy, hyyy = local.T
+    shifted_x = (
+        ax + jxx * sx + jxy * sy
+        + 0.5 * (hxxx * sx * sx + 2 * hxxy * sx * sy + hxyy * sy * sy)
+        )
+    shifted_y = (
+        ay + jxy * sx + jyy * sy
+        + 0.5 * (hxxy * sx * sx + 2 * hxyy * sx * sy + hyyy * sy * sy)
+        )
+    if acceleration_only:
+        return np.column_stack((shifted_x, shifted_y))
+    return np.column_stack((
+        shifted_x, shifted_y,
+        jxx + hxxx * sx + hxxy * sy,
+        jxy + hxxy * sx + hxyy * sy,
+        jyy + hxyy * sx + hyyy * sy,
+        hxxx, hxxy, hxyy, hyyy
+        ))
+
+
+# Local to local translations, from the root down one level at a time
+def local_to_local(tree, local):
+    frontier = np.array([tree.root])
+    while frontier.size:
+        subnodes = tree.child[frontier]
+        present = subnodes >= 0
+        parent = np.repeat(frontier, present.sum(axis=1))
+        subnodes = subnodes[present]
+        local[subnodes] += shift_local(
+            local[parent], tree.com[subnodes] - tree.com[parent]
+            )
+        frontier = subnodes
+
+
+# Sorted body indices of every leaf, padded with the index N
+def leaf_bodies(tree, leaves, width, N):
+    offsets = np.arange(width)
+    index = tree.body_start[leaves, np.newaxis] + offsets
+    index[offsets >= tree.body_count[leaves, np.newaxis]] = N
+    return index
+
+
+# Direct sums between close leaves and within every leaf
+# Written into acceleration, indexed by sorted body (plus one padding
+# row at the end)
+def direct_sums(
+        tree, sorted_position, sorted_mass, near_sink, near_source,
+        self_leaves, acceleration):
+    N = sorted_mass.size - 1
+    x = sorted_position[:, 0]
+    y = sorted_position[:, 1]
+    width = int(tree.body_count[self_leaves].max())
+    batch = max(1, pairs_per_batch // (width * width))
+
+    for sink, source, mutual in (
+            (near_sink, near_source, True),
+            (self_leaves, self_leaves, False)):
+        for start in range(0, sink.size, batch):
+            a = leaf_bodies(tree, sink[start:start + batch], width, N)
+            b = leaf_bodies(tree, source[start:start + batch], width, N)
+
+            # dx, dy[p, i, j]: from body i of leaf a to body j of leaf b
+            dx = x[b][:, np.newaxis, :] - x[a][:, :, np.newaxis]
+            dy = y[b][:, np.newaxis, :] - y[a][:, :, np.newaxis]
+            r3 = dx * dx + dy * dy
+            r3 *= np.sqrt(r3)
+            # Drops a body with itself, coincident bodies and padding
+            inverse = np.divide(
+                1.0, r3, out=np.zeros(r3.shape), where=r3 > 0
+                )
+
+            scale = inverse * sorted_mass[b][:, np.newaxis, :]
+            accumulate(acceleration, a.ravel(), np.column_stack((
+                (dx * scale).sum(axis=2).ravel(),
+                (dy * scale).sum(axis=2).ravel()
+                )))
+            if mutual:
+                scale = inverse * sorted_mass[a][:, :, np.newaxis]
+                accumulate(acceleration, b.ravel(), -np.column_stack((
+                    (dx * scale).sum(axis=1).ravel(),
+                    (dy * scale).sum(axis=1).ravel()
+                    )))
+
+
+# Accelerations of every body from an already built tree
+def tree_acceleration(tree, position, mass, theta):
+    N = position.shape[0]
+    mass = np.reshape(mass, -1)
+    if N == 0:
+        return np.zeros((0, 2))
+
+    far_sink, far_source, near_sink, near_source, self_leaves = (
+        dual_tree_walk(tree, theta)
+        )
+
+    # Cell to cell interactions, passed down the tree
+    local = np.zeros((tree.count, local_terms))
+    multipole_to_local(tree, far_sink, far_source, local)
+    local_to_local(tree, local)
+
+    # Bodies in Morton order, with one massless padding body at the end
+    order = tree.order
+    sorted_position = np.zeros((N + 1, 2))
+    sorted_position[:N] = position[order]
+    sorted_mass = np.zeros(N + 1)
+    sorted_mass[:N] = mass[order]
+
+    # Local to particle: the leaves hold every body exactly once, so
+    # repeating each leaf over its run gives the leaf of every body
+    leaves = np.flatnonzero(tree.body[:tree.count] >= 0)
+    leaves = leaves[np.argsort(tree.body_start[leaves])]
+    leaf_of_body = np.repeat(leaves, tree.body_count[leaves])
+    acceleration = np.zeros((N + 1, 2))
+    acceleration[:N] = shift_local(
+        local[leaf_of_body], sorted_position[:N] - tree.com[leaf_of_body],
+        acceleration_only=True
+        )
+
+    direct_sums(
+        tree, sorted_position, sorted_mass, near_sink, near_source,
+        self_leaves, acceleration
+        )
+
+    result = np.empty((N, 2))
+    result[order] = acceleration[:N]
+    return result
+
+
+# Calculate the acceleration of every body with the fast multipole method
+# Same call as barnes_hut_flat_tree.get_acceleration
+# multipole_order: 0 for monopole nodes, 2 to add their quadrupoles
+def get_acceleration(
+        position, mass, G, theta=0.5, leaf_capacity=fmm_leaf_capacity,
+        multipole_order=2):
+    with instrumentation.timer("tree build"):
+        tree = build_tree(
+            position, mass, leaf_capacity=leaf_capacity,
+            multipole_order=multipole_order
+            )
+    with instrumentation.timer("force walk"):
+        return G * tree_acceleration(tree, position, mass, theta)
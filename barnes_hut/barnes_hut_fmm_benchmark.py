@@ -0,0 +1,91 @@
+import numpy as np
+import time
+import os
+import sys
+
+
+"""
+Force Engine Comparison
+
+Times one calculation of every body's acceleration with the direct
+sum, the Barnes-Hut flat quadtree (per body and grouped walks) and the
+fast multipole method, all through their get_acceleration calls.
+
+The direct sum is the reference for the error of the other engines.
+It is skipped above max_direct_bodies, where the fast multipole
+method at theta = 0.2 is used as the reference instead.
+
+Usage:
+    python barnes_hut_fmm_benchmark.py [number of bodies] [theta]
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+# Allow the shared modules to be imported when this script is
+# launched directly
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+from barnes_hut import barnes_hut_flat_tree, barnes_hut_fmm  # noqa: E402
+from barnes_hut.barnes_hut_flat_tree import (  # noqa: E402
+    direct_acceleration
+    )
+
+
+# Largest number of bodies the direct sum reference is run for
+max_direct_bodies = 20000
+
+
+def compare_engines(number_of_bodies, theta):
+    np.random.seed(50)
+    mass = np.random.random(number_of_bodies) * 10
+    position = np.random.random((number_of_bodies, 2))
+    G = 1.0
+
+    engines = [
+        ("Barnes-Hut", lambda: barnes_hut_flat_tree.get_acceleration(
+            position, mass, G, theta)),
+        ("Barnes-Hut grouped", lambda: barnes_hut_flat_tree.get_acceleration(
+            position, mass, G, theta, grouped=True, leaf_capacity=8)),
+        ("Fast multipole", lambda: barnes_hut_fmm.get_acceleration(
+            position, mass, G, theta)),
+    ]
+
+    results = {}
+    if number_of_bodies <= max_direct_bodies:
+        engines.insert(
+            0, ("Direct sum", lambda: direct_acceleration(position, mass, G))
+            )
+    else:
+        results["reference"] = barnes_hut_fmm.get_acceleration(
+            position, mass, G, 0.2
+            )
+
+    for name, engine in engines:
+        start = time.perf_counter()
+        acceleration = engine()
+        elapsed = time.perf_counter() - start
+        if "reference" not in results:
+            results["reference"] = acceleration
+        error = (
+            np.linalg.norm(acceleration - results["reference"], axis=1)
+            / np.linalg.norm(results["reference"], axis=1)
+            )
+        results[name] = (elapsed, np.median(error))
+    del results["reference"]
+    return results
+
+
+if __name__ == "__main__":
+    number_of_bodies = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    theta = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+
+    print(
+        "Accelerations of", number_of_bodies, "bodies, theta =", theta
+        )
+    print("%-20s %10s %14s" % ("engine", "time (s)", "median error"))
+    for name, (elapsed, error) in compare_engines(
+            number_of_bodies, theta).items():
+        print("%-20s %10.3f %14.2e" % (name, elapsed, error))
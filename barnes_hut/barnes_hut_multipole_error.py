@@ -0,0 +1,92 @@
+import numpy as np
+import time
+import os
+import sys
+
+
+"""
+Barnes-Hut Multipole Error Report
+
+Compares the flat quadtree's accelerations against the direct sum for
+a range of opening angles, with monopole only (multipole order 0) and
+with quadrupole (multipole order 2) nodes.
+
+For every theta and order the report prints the median and 99th
+percentile of the relative acceleration error per body, and the time
+taken for the tree build and force walk.
+
+Usage:
+    python barnes_hut_multipole_error.py [number of bodies] [grouped]
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+# Allow the shared modules to be imported when this script is
+# launched directly
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+from barnes_hut.barnes_hut_flat_tree import (  # noqa: E402
+    direct_acceleration, get_acceleration, multipole_orders
+    )
+
+
+# Relative acceleration error of every body against the direct sum
+def force_error(
+        position, mass, theta, multipole_order=0, grouped=False,
+        reference=None, G=1.0):
+    if reference is None:
+        reference = direct_acceleration(position, mass, G)
+    start = time.perf_counter()
+    acceleration = get_acceleration(
+        position, mass, G, theta, grouped=grouped,
+        multipole_order=multipole_order
+        )
+    elapsed = time.perf_counter() - start
+    error = (
+        np.linalg.norm(acceleration - reference, axis=1)
+        / np.linalg.norm(reference, axis=1)
+        )
+    return error, elapsed
+
+
+def error_report(
+        number_of_bodies, thetas=(0.3, 0.5, 0.7, 0.8, 1.0), grouped=False):
+    np.random.seed(50)
+    mass = np.random.random(number_of_bodies) * 10
+    position = np.random.random((number_of_bodies, 2))
+    reference = direct_acceleration(position, mass, 1.0)
+
+    results = []
+    for theta in thetas:
+        for order in multipole_orders:
+            error, elapsed = force_error(
+                position, mass, theta, order, grouped, reference
+                )
+            results.append({
+                "theta": theta,
+                "multipole order": order,
+                "median error": np.median(error),
+                "99th percentile error": np.percentile(error, 99),
+                "time": elapsed,
+                })
+    return results
+
+
+if __name__ == "__main__":
+    number_of_bodies = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    grouped = len(sys.argv) > 2 and sys.argv[2] == "grouped"
+
+    print(
+        "Acceleration error against the direct sum with",
+        number_of_bodies, "bodies", "(grouped walk)" if grouped else ""
+        )
+    print("theta  order  median error  99th percentile  time (s)")
+    for result in error_report(number_of_bodies, grouped=grouped):
+        print("%5.2f  %5d  %12.2e  %15.2e  %8.3f" % (
+            result["theta"], result["multipole order"],
+            result["median error"], result["99th percentile error"],
+            result["time"]
+            ))
@@ -0,0 +1,316 @@
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+import os
+import time
+import numpy as np
+
+from barnes_hut.barnes_hut_flat_tree import (
+    FlatQuadtree, TreeLists, build_tree, find_groups, group_size,
+    refit_margin, refit_tree, resolve_leaf_capacity, walk_forces,
+    walk_forces_grouped, walk_order
+    )
+from simulation import instrumentation
+
+
+"""
+MULTI-CORE BARNES-HUT ENGINE
+
+Threads cannot speed up the force walk because the GIL only lets one
+of them run Python code at a time, and running whole timesteps in
+threads at once lets them move the same bodies concurrently. This
+engine keeps every timestep in order and only splits its force walk
+across a persistent pool of worker processes.
+
+Every timestep has three phases, timed separately:
+
+1. build
+    - The main process builds (or refits) the flat quadtree
+    - The tree's arrays and the bodies are copied into shared memory
+      blocks, which every worker only reads
+
+2. walk
+    - The bodies are dealt out to the workers in chunks of the tree's
+      Morton order, several per worker so faster workers pick up more
+    - Every worker walks its bodies with the same walk as
+      barnes_hut_flat_tree.single_timestep_cycle (walk_forces, or
+      walk_forces_grouped for whole groups with grouped=True) and
+      writes their forces straight into a shared force array. The
+      chunks hold separate bodies, so no two workers write the same row
+
+3. update
+    - The main process applies the forces to the momentums and
+      positions once every worker is done
+
+Only the names of the shared memory blocks and the group bounds are
+sent to the workers, the arrays themselves are never copied. A block
+is replaced by a larger one when the tree outgrows it, and the
+workers attach to the new block the first time they see its name.
+Every walk is numbered, and a worker turns the shared tree into the
+lists the walk reads (TreeLists) once per walk, for its first chunk,
+and reuses them for the rest of its chunks.
+
+The walk, leaf capacity and multipole order default to those of
+single_timestep_cycle, so the engine gives the same forces as the
+single process quadtree, whatever the number of workers.
+"""
+
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Tree arrays shared with the workers
+TREE_ARRAYS = (
+    "child", "mass", "com", "corner", "side", "body", "next_body", "order",
+    "body_start", "body_count", "quadrupole"
+)
+
+# Chunks of groups handed out per worker every timestep
+CHUNKS_PER_WORKER = 4
+
+# Shared memory blocks a worker has attached to, by array, and the
+# tree of the walk it is working on
+_worker = {}
+
+
+# Array of a shared memory block, attaching to the block the first time
+# its name is seen
+def _attach(key, name, dtype, shape):
+    attached = _worker.get(key)
+    if attached is None or attached[0] != name:
+        if attached is not None:
+            attached[1].close()
+        block = shared_memory.SharedMemory(name=name)
+        _worker[key] = attached = (name, block)
+    return np.ndarray(shape, dtype=dtype, buffer=attached[1].buf)
+
+
+# Walks one chunk of bodies in a worker process
+# walk: number of the walk the chunk belongs to
+# leaf_capacity: most bodies per leaf of the shared tree
+# bodies: the bodies to walk for, one by one, or None
+# groups: the (starts, counts) of the groups to walk, when bodies is None
+def _walk_chunk(task):
+    layout, walk, root, count, leaf_capacity, theta, bodies, groups = task
+    arrays = {
+        key: _attach(key, *spec) for key, spec in layout.items()
+    }
+    position = arrays["position"]
+    mass = arrays["body_mass"]
+
+    # A tree made of views into the shared arrays, and its lists, made
+    # for the first chunk of every walk this worker is given
+    cached = _worker.get("tree")
+    if cached is None or cached[0] != walk:
+        tree = FlatQuadtree(0)
+        for key in TREE_ARRAYS:
+            setattr(tree, key, arrays.get(key))
+        tree.root = root
+        tree.count = count
+        tree.leaf_capacity = leaf_capacity
+        if bodies is None:
+            nodes = TreeLists(tree)
+        else:
+            nodes = TreeLists(tree, position, mass)
+        _worker["tree"] = cached = (walk, tree, nodes)
+    _, tree, nodes = cached
+
+    if bodies is None:
+        walk_forces_grouped(
+            tree, position, mass, theta, force=arrays["force"],
+            groups=groups, nodes=nodes
+            )
+    else:
+        walk_forces(
+            tree, position, mass, theta, force=arrays["force"],
+            bodies=bodies, nodes=nodes
+            )
+
+
+class SharedMemoryTreeEngine:
+    def __init__(
+            self, number_of_bodies, workers=None, grouped=False,
+            leaf_capacity=1, multipole_order=0, refit=False,
+            max_bodies=group_size):
+        """
+        number_of_bodies: number of bodies in the simulation
+        workers: number of worker processes (default: number of CPUs)
+        grouped: walk with the group walk instead of body by body
+        leaf_capacity: most bodies per leaf of the tree, or "auto" to
+        tune it
+        multipole_order: 0 for monopoles only, 2 to add quadrupoles
+        refit: refit the tree between timesteps instead of rebuilding it
+        max_bodies: most bodies sharing one interaction list in the
+        group walk
+        tree: tree of the latest force calculation
+        timings: total wall time spent in each phase of a timestep
+        steps: number of timesteps taken
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError("workers must be at least 1, got %d" % workers)
+
+        self.number_of_bodies = number_of_bodies
+        self.workers = workers
+        self.grouped = grouped
+        self.leaf_capacity = leaf_capacity
+        self.multipole_order = multipole_order
+        self.refit = refit
+        self.max_bodies = max_bodies
+        self.tree = None
+        self.timings = {"build": 0.0, "walk": 0.0, "update": 0.0}
+        self.steps = 0
+        # Walks handed to the workers so far, numbering every walk
+        self._walks = 0
+
+        # Shared memory block of every array, replaced when outgrown
+        # The workers must share the engine's resource tracker, otherwise
+        # each one would unlink the blocks it attached to when it exits
+        self._blocks = {}
+        resource_tracker.ensure_running()
+        self._pool = multiprocessing.Pool(workers)
+
+    # Copy an array into its shared memory block
+    # Returns what a worker needs to find the array again
+    def _share(self, key, array):
+        array = np.ascontiguousarray(array)
+        block = self._blocks.get(key)
+        if block is None or block.size < array.nbytes:
+            if block is not None:
+                block.close()
+                block.unlink()
+            # Room to grow, so refitted trees rarely need a new block
+            block = shared_memory.SharedMemory(
+                create=True, size=max(1, 2 * array.nbytes)
+                )
+            self._blocks[key] = block
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+        return block.name, array.dtype.str, array.shape
+
+    # Build or refit the tree for the current positions
+    def build(self, position, mass, theta):
+        if self.refit and self.tree is not None:
+            self.tree = refit_tree(self.tree, position, mass)
+        else:
+            leaf_capacity = resolve_leaf_capacity(
+                position, mass, theta, self.grouped, self.leaf_capacity,
+                self.multipole_order
+                )
+            self.tree = build_tree(
+                position, mass, leaf_capacity=leaf_capacity,
+                multipole_order=self.multipole_order,
+                margin=refit_margin if self.refit else 0.0
+                )
+        return self.tree
+
+    # Forces on every body, with the walk split across the workers
+    def forces(self, position, mass, theta):
+        with instrumentation.timer("tree build"):
+            start = time.perf_counter()
+            tree, layout = self._share_tree(position, mass, theta)
+            self.timings["build"] += time.perf_counter() - start
+
+        with instrumentation.timer("force walk"):
+            start = time.perf_counter()
+            force = self._walk(tree, layout, position.shape[0], theta)
+            self.timings["walk"] += time.perf_counter() - start
+        return force
+
+    # Build the tree and copy it and the bodies into shared memory
+    # Returns the tree and the layout of the shared arrays
+    def _share_tree(self, position, mass, theta):
+        N = position.shape[0]
+        mass = np.reshape(mass, -1)
+        tree = self.build(position, mass, theta)
+        count = tree.count
+        layout = {
+            key: self._share(key, getattr(tree, key)[:count])
+            for key in ("child", "mass", "com", "corner", "side", "body",
+                        "body_start", "body_count")
+        }
+        if tree.quadrupole is not None:
+            layout["quadrupole"] = self._share(
+                "quadrupole", tree.quadrupole[:count]
+                )
+        layout["next_body"] = self._share("next_body", tree.next_body)
+        layout["order"] = self._share("order", tree.order)
+        layout["position"] = self._share("position", position)
+        layout["body_mass"] = self._share("body_mass", mass)
+        layout["force"] = self._share("force", np.zeros((N, 2)))
+        return tree, layout
+
+    # Walk the shared tree with the workers
+    def _walk(self, tree, layout, N, theta):
+        self._walks += 1
+        task = (
+            layout, self._walks, tree.root, tree.count, tree.leaf_capacity,
+            theta
+            )
+        if self.grouped:
+            # Groups in walk order, split into chunks of similar body
+            # counts
+            starts, counts = find_groups(tree, self.max_bodies)
+            chunks = min(len(starts), self.workers * CHUNKS_PER_WORKER)
+            bounds = np.searchsorted(
+                np.cumsum(counts), np.linspace(0, N, chunks + 1)[1:-1]
+                )
+            tasks = [
+                task + (None, (chunk_starts.tolist(), chunk_counts.tolist()))
+                for chunk_starts, chunk_counts in zip(
+                    np.split(np.array(starts), bounds),
+                    np.split(np.array(counts), bounds))
+                if chunk_starts.size
+            ]
+        else:
+            # Bodies in walk order, split into chunks of equal size
+            order = np.array(walk_order(tree, N), dtype=int)
+            chunks = min(N, self.workers * CHUNKS_PER_WORKER)
+            tasks = [
+                task + (chunk.tolist(), None)
+                for chunk in np.array_split(order, max(chunks, 1))
+                if chunk.size
+            ]
+        self._pool.map(_walk_chunk, tasks, chunksize=1)
+
+        block = self._blocks["force"]
+        return np.ndarray((N, 2), buffer=block.buf).copy()
+
+    # Calculate the acceleration of every body
+    # Same call as barnes_hut_flat_tree.get_acceleration
+    def get_acceleration(self, position, mass, G, theta):
+        mass = np.reshape(mass, -1)
+        return G * self.forces(position, mass, theta) / mass[:, np.newaxis]
+
+    __call__ = get_acceleration
+
+    # One simulation cycle, the same update as barnes_hut_flat_tree.verlet
+    def step(self, position, momentum, mass, theta, G, timestep):
+        force = G * self.forces(position, mass, theta)
+
+        with instrumentation.timer("integration"):
+            start = time.perf_counter()
+            momentum += timestep * force
+            position += timestep * momentum / mass[:, np.newaxis]
+            self.timings["update"] += time.perf_counter() - start
+        self.steps += 1
+        instrumentation.end_step()
+
+    # Stop the workers and release the shared memory
+    def close(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+        for block in self._blocks.values():
+            block.close()
+            block.unlink()
+        self._blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
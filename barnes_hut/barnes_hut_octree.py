@@ -0,0 +1,543 @@
+import math
+import numpy as np
+
+from simulation import instrumentation
+
+
+"""
+Barnes-Hut Flat Octree
+
+The 3D counterpart of barnes_hut_flat_tree, working on the same N x 3
+position, velocity and mass arrays as the pairwise simulation, so the
+two engines can be timed on exactly the same workload.
+
+Every node is an integer id indexing into contiguous NumPy arrays:
+
+child: node ids of the 8 subnodes (-1 where an octant is empty)
+mass: mass of every body inside the node
+com: center of mass of the node
+corner: lowest corner of the node's cube
+side: side length of the node's cube
+leaf: True for nodes holding bodies instead of subnodes
+body_start, body_count: the run of the Morton sorted bodies inside
+the node
+
+The tree is built the same way as barnes_hut_flat_tree.build_tree:
+the bodies are sorted by their 3D Morton key (3 bits per level, 21
+levels in a 64 bit key), after which every node of a level is one run
+of the sorted bodies and its mass and center of mass come straight from
+np.add.reduceat. Nodes holding leaf_capacity bodies or fewer become
+bucket leaves.
+
+Forces are found with the same opening criterion as the quadtree: a
+node far enough away (side < distance * theta) acts through its center
+of mass, otherwise its subnodes are visited. The softening length of
+the pairwise kernels is applied to every interaction.
+
+walk_accelerations walks the tree once per body.
+walk_accelerations_grouped lets the bodies of a small node share one
+interaction list, found for every group at once by walking the tree a
+level at a time in NumPy, and evaluates each list for all of its
+bodies at once. It is the default.
+
+get_acceleration takes the same arguments as the pairwise kernels:
+
+    get_acceleration(position, mass, G, softening)
+"""
+
+# THE QUADTREE USED HERE IS INSPIRED BY THE WORK OF LEWIS COLE
+# https://lewiscoleblog.com/barnes-hut
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+class FlatOctree:
+    def __init__(self, number_of_bodies, origin=(0.0, 0.0, 0.0), size=1.0):
+        """
+        number_of_bodies: number of bodies the tree is built over
+        origin: lowest corner of the root cube
+        size: side length of the root cube
+        child, mass, com, corner, side, leaf, body_start, body_count:
+        node arrays, filled in by build_octree
+        order: body indices sorted by Morton key
+        leaf_capacity: most bodies a leaf is allowed to hold
+        root: node id of the root node (-1 while the tree is empty)
+        count: number of nodes in use
+        """
+        self.number_of_bodies = number_of_bodies
+        self.origin = np.asarray(origin, dtype=float)
+        self.size = size
+        self.child = np.full((0, 8), -1, dtype=np.int32)
+        self.mass = np.zeros(0)
+        self.com = np.zeros((0, 3))
+        self.corner = np.zeros((0, 3))
+        self.side = np.zeros(0)
+        self.leaf = np.zeros(0, dtype=bool)
+        self.body_start = np.zeros(0, dtype=int)
+        self.body_count = np.zeros(0, dtype=int)
+        self.order = np.arange(number_of_bodies)
+        self.leaf_capacity = 1
+        self.root = -1
+        self.count = 0
+
+    # Memory used by the node arrays in bytes
+    def nbytes(self):
+        return sum(
+            array.nbytes for array in (
+                self.child, self.mass, self.com, self.corner, self.side,
+                self.leaf, self.body_start, self.body_count, self.order
+                )
+            )
+
+
+# Levels of the 3D Morton keys (3 bits per level in a 64 bit key)
+octree_levels = 21
+
+# Default bodies per bucket leaf
+octree_leaf_capacity = 8
+
+# Default number of bodies sharing one interaction list in the group walk
+octree_group_size = 32
+
+
+# Spread the lower 21 bits of every value so two zero bits separate them
+def spread_bits_3d(n):
+    n = n.astype(np.uint64)
+    for shift, bits in (
+            (32, 0x001F00000000FFFF),
+            (16, 0x001F0000FF0000FF),
+            (8, 0x100F00F00F00F00F),
+            (4, 0x10C30C30C30C30C3),
+            (2, 0x1249249249249249)):
+        n = (n | (n << np.uint64(shift))) & np.uint64(bits)
+    return n
+
+
+# Morton key of every body inside the cube at origin with side size
+# Every 3 bits of a key, from the top, are the octant the body is in at
+# the next level: 4 * x bit + 2 * y bit + z bit
+def morton_keys_3d(position, origin, size, levels=octree_levels):
+    cells = 2**levels
+    grid = np.floor((position - origin) / size * cells)
+    grid = np.clip(grid, 0, cells - 1).astype(np.uint64)
+    return (
+        (spread_bits_3d(grid[:, 0]) << np.uint64(2))
+        | (spread_bits_3d(grid[:, 1]) << np.uint64(1))
+        | spread_bits_3d(grid[:, 2])
+        )
+
+
+# Smallest cube containing every body
+def root_cube(position):
+    if position.shape[0] == 0:
+        return np.zeros(3), 1.0
+    origin = position.min(axis=0)
+    size = (position.max(axis=0) - origin).max()
+    # Grow the cube slightly so the furthest bodies fall inside it
+    size = size * (1.0 + 1.e-9) if size > 0 else 1.0
+    return origin, size
+
+
+# Build the octree from the bodies sorted by Morton key
+# One level of nodes at a time, as in barnes_hut_flat_tree.build_tree
+def build_octree(
+        position, mass, levels=octree_levels,
+        leaf_capacity=octree_leaf_capacity):
+    N = position.shape[0]
+    mass = np.reshape(mass, -1)
+    if leaf_capacity < 1:
+        raise ValueError(
+            "leaf_capacity must be at least 1, got %d" % leaf_capacity
+            )
+    origin, size = root_cube(position)
+    tree = FlatOctree(N, origin, size)
+    tree.leaf_capacity = leaf_capacity
+    if N == 0:
+        return tree
+
+    keys = morton_keys_3d(position, origin, size, levels)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    sorted_mass = mass[order]
+    sorted_position = position[order]
+
+    # Per level arrays of the new nodes, starting with the root
+    parents = [np.array([-1])]
+    octants = [np.array([0])]
+    starts = [np.array([0])]
+    counts = [np.array([N])]
+    masses = [np.array([sorted_mass.sum()])]
+    coms = [(sorted_mass @ sorted_position)[np.newaxis] / masses[0]]
+    corners = [origin[np.newaxis].astype(float)]
+    sides = [np.array([size])]
+    leaves = [np.array([N <= leaf_capacity])]
+
+    # Bodies still inside an internal node, as indices into the
+    # sorted order, and the id of that node
+    active = np.arange(N) if N > leaf_capacity else np.arange(0)
+    active_parent = np.zeros(active.size, dtype=int)
+    next_id = 1
+
+    for level in range(1, levels + 1):
+        if active.size == 0:
+            break
+        prefix = keys[active] >> np.uint64(3 * (levels - level))
+
+        # A new run starts wherever the key prefix changes
+        new_run = np.empty(active.size, dtype=bool)
+        new_run[0] = True
+        new_run[1:] = prefix[1:] != prefix[:-1]
+        run = np.flatnonzero(new_run)
+        run_count = np.diff(np.append(run, active.size))
+        ids = next_id + np.arange(run.size)
+
+        octant = (prefix[run] & np.uint64(7)).astype(int)
+        parent = active_parent[run]
+        side = size / 2**level
+        offset = np.column_stack(
+            (octant >> 2, (octant >> 1) & 1, octant & 1)
+            ) * side
+
+        active_mass = sorted_mass[active]
+        run_mass = np.add.reduceat(active_mass, run)
+        run_com = np.add.reduceat(
+            active_mass[:, np.newaxis] * sorted_position[active], run
+            ) / run_mass[:, np.newaxis]
+
+        # Parent corners, looked up in the previous level
+        parent_corner = corners[-1][parent - (next_id - corners[-1].shape[0])]
+
+        leaf = (run_count <= leaf_capacity) | (level == levels)
+        parents.append(parent)
+        octants.append(octant)
+        starts.append(active[run])
+        counts.append(run_count)
+        masses.append(run_mass)
+        coms.append(run_com)
+        corners.append(parent_corner + offset)
+        sides.append(np.full(run.size, side))
+        leaves.append(leaf)
+
+        # Only the bodies of internal nodes carry on to the next level
+        keep = np.repeat(~leaf, run_count)
+        active_parent = np.repeat(ids, run_count)[keep]
+        active = active[keep]
+        next_id += run.size
+
+    # Fill in the tree's arrays
+    count = next_id
+    parent = np.concatenate(parents)
+    octant = np.concatenate(octants)
+    tree.child = np.full((count, 8), -1, dtype=np.int32)
+    tree.child[parent[1:], octant[1:]] = np.arange(1, count)
+    tree.mass = np.concatenate(masses)
+    tree.com = np.concatenate(coms)
+    tree.corner = np.concatenate(corners)
+    tree.side = np.concatenate(sides)
+    tree.leaf = np.concatenate(leaves)
+    tree.body_start = np.concatenate(starts)
+    tree.body_count = np.concatenate(counts)
+    tree.order = order
+    tree.root = 0
+    tree.count = count
+    instrumentation.gauge("tree nodes", count)
+    instrumentation.gauge("tree depth", len(sides) - 1)
+    return tree
+
+
+class OctreeLists:
+    def __init__(self, tree):
+        """
+        root: node id of the root node
+        child: subnode ids of every node, empty octants left out
+        mass, com_x, com_y, com_z, side, leaf, body_start, body_count:
+        the tree's arrays of the same names as lists
+        """
+        count = tree.count
+        self.root = tree.root
+        self.child = [
+            [node for node in row if node >= 0]
+            for row in tree.child[:count].tolist()
+        ]
+        self.mass = tree.mass[:count].tolist()
+        self.com_x = tree.com[:count, 0].tolist()
+        self.com_y = tree.com[:count, 1].tolist()
+        self.com_z = tree.com[:count, 2].tolist()
+        self.side = tree.side[:count].tolist()
+        self.leaf = tree.leaf[:count].tolist()
+        self.body_start = tree.body_start[:count].tolist()
+        self.body_count = tree.body_count[:count].tolist()
+
+
+# Acceleration of a body due to the whole tree, per unit G
+# The node far enough away is used through its center of mass,
+# otherwise its subnodes are visited. Leaves are summed directly.
+# sorted_position, sorted_mass: the bodies in Morton order
+def acceleration_on(
+        nodes, x, y, z, theta, softening, sorted_position, sorted_mass,
+        stack):
+    child = nodes.child
+    node_mass = nodes.mass
+    com_x = nodes.com_x
+    com_y = nodes.com_y
+    com_z = nodes.com_z
+    side = nodes.side
+    leaf = nodes.leaf
+    softening2 = softening * softening
+
+    ax = ay = az = 0.0
+    leaves = []
+    stack.append(nodes.root)
+    while stack:
+        node = stack.pop()
+        dx = com_x[node] - x
+        dy = com_y[node] - y
+        dz = com_z[node] - z
+        r2 = dx * dx + dy * dy + dz * dz
+        if side[node] < math.sqrt(r2) * theta:
+            scale = node_mass[node] / (r2 + softening2)**1.5
+            ax += dx * scale
+            ay += dy * scale
+            az += dz * scale
+        elif leaf[node]:
+            leaves.append(node)
+        else:
+            stack.extend(child[node])
+
+    # Bodies of the leaves that were too close, in one direct sum
+    if leaves:
+        index = np.concatenate([
+            np.arange(
+                nodes.body_start[node],
+                nodes.body_start[node] + nodes.body_count[node]
+                )
+            for node in leaves
+        ])
+        d = sorted_position[index] - (x, y, z)
+        s2 = (d * d).sum(axis=1) + softening2
+        # Drops the body itself when there is no softening
+        with np.errstate(divide="ignore"):
+            scale = np.where(s2 > 0, s2 ** -1.5, 0.0) * sorted_mass[index]
+        ax, ay, az = (ax, ay, az) + scale @ d
+    return ax, ay, az
+
+
+# Accelerations of every body, walking the tree once per body
+# bodies: only walk for these bodies (all bodies by default)
+def walk_accelerations(
+        tree, position, mass, theta, softening, bodies=None):
+    N = position.shape[0]
+    acceleration = np.zeros((N, 3))
+    if tree.root < 0:
+        return acceleration
+
+    nodes = OctreeLists(tree)
+    sorted_position = position[tree.order]
+    sorted_mass = np.reshape(mass, -1)[tree.order]
+    order = tree.order
+    if bodies is not None:
+        # Still in Morton order, so close bodies are walked together
+        walking = np.zeros(N, dtype=bool)
+        walking[bodies] = True
+        order = order[walking[order]]
+    stack = []
+    for body, (x, y, z) in zip(order.tolist(), position[order].tolist()):
+        acceleration[body] = acceleration_on(
+            nodes, x, y, z, theta, softening, sorted_position,
+            sorted_mass, stack
+            )
+    return acceleration
+
+
+# Groups of the group walk
+# The largest nodes holding at most max_bodies bodies, as the run of
+# tree.order each one covers
+def find_groups(tree, max_bodies):
+    starts = []
+    counts = []
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        if tree.body_count[node] <= max_bodies or tree.leaf[node]:
+            starts.append(tree.body_start[node])
+            counts.append(tree.body_count[node])
+        else:
+            stack.extend(c for c in tree.child[node].tolist() if c >= 0)
+    return starts, counts
+
+
+# Concatenated runs of sorted bodies, starting at start, count long
+def body_runs(start, count):
+    first = np.cumsum(count) - count
+    return np.repeat(start - first, count) + np.arange(count.sum())
+
+
+# Interaction lists of every group, found for all groups at once
+# The tree is walked one level at a time with a frontier of
+# (group, node) pairs. A node is only used through its center of mass
+# when the opening criterion holds for the nearest point of the
+# group's box low - high, so it holds for every body in the group.
+# Returns the far nodes and the near leaves of every pair, sorted by
+# group, and where the pairs of each group start
+# cutoff: leave out every node whose cube is further than cutoff from
+# the group's box, with everything inside it
+def interaction_lists(tree, low, high, theta, cutoff=None):
+    groups = low.shape[0]
+    group = np.arange(groups)
+    node = np.full(groups, tree.root)
+    far_group, far_node = [], []
+    near_group, near_node = [], []
+    theta2 = theta * theta
+
+    while group.size:
+        if cutoff is not None:
+            corner = tree.corner[node]
+            side = tree.side[node]
+            gap = (
+                np.maximum(low[group] - corner - side[:, np.newaxis], 0.0)
+                + np.maximum(corner - high[group], 0.0)
+                )
+            within = (gap * gap).sum(axis=1) <= cutoff * cutoff
+            group = group[within]
+            node = node[within]
+
+        com = tree.com[node]
+        gap = (
+            np.maximum(low[group] - com, 0.0)
+            + np.maximum(com - high[group], 0.0)
+            )
+        side = tree.side[node]
+        far = side * side < (gap * gap).sum(axis=1) * theta2
+        near = ~far & tree.leaf[node]
+        far_group.append(group[far])
+        far_node.append(node[far])
+        near_group.append(group[near])
+        near_node.append(node[near])
+
+        # Open every other node
+        opened = ~(far | near)
+        instrumentation.count("nodes opened", np.count_nonzero(opened))
+        subnodes = tree.child[node[opened]]
+        present = subnodes >= 0
+        group = np.repeat(group[opened], present.sum(axis=1))
+        node = subnodes[present]
+
+    lists = []
+    for group, node in ((far_group, far_node), (near_group, near_node)):
+        group = np.concatenate(group)
+        node = np.concatenate(node)
+        by_group = np.argsort(group, kind="stable")
+        pointer = np.searchsorted(group[by_group], np.arange(groups + 1))
+        lists.append((node[by_group], pointer))
+    return lists
+
+
+# Accelerations of every body with the group walk
+# Bodies in the same small node share one interaction list, which is
+# then evaluated for all of them at once with NumPy broadcasting
+# cutoff: leave out the nodes further than cutoff (see
+# interaction_lists)
+# force_factor: function scaling the force of every interaction, given
+# the squared softened distances (1 / r² forces when None); with a
+# cutoff it is only worked out for the pairs closer than the cutoff,
+# the others are left out
+def walk_accelerations_grouped(
+        tree, position, mass, theta, softening, max_bodies=None,
+        cutoff=None, force_factor=None):
+    N = position.shape[0]
+    mass = np.reshape(mass, -1)
+    if max_bodies is None:
+        max_bodies = octree_group_size
+    acceleration = np.zeros((N, 3))
+    if tree.root < 0:
+        return acceleration
+
+    sorted_position = position[tree.order]
+    sorted_mass = mass[tree.order]
+    softening2 = softening * softening
+
+    starts, counts = find_groups(tree, max_bodies)
+    low = np.array([
+        sorted_position[start:start + count].min(axis=0)
+        for start, count in zip(starts, counts)
+    ])
+    high = np.array([
+        sorted_position[start:start + count].max(axis=0)
+        for start, count in zip(starts, counts)
+    ])
+    (far, far_pointer), (near, near_pointer) = interaction_lists(
+        tree, low, high, theta, cutoff
+        )
+    interactions = 0
+
+    for group, (start, count) in enumerate(zip(starts, counts)):
+        member_position = sorted_position[start:start + count]
+        far_nodes = far[far_pointer[group]:far_pointer[group + 1]]
+        near_leaves = near[near_pointer[group]:near_pointer[group + 1]]
+        near_bodies = body_runs(
+            tree.body_start[near_leaves], tree.body_count[near_leaves]
+            )
+
+        # Every source of the list, centers of mass and bodies together
+        source_position = np.concatenate(
+            (tree.com[far_nodes], sorted_position[near_bodies])
+            )
+        source_mass = np.concatenate(
+            (tree.mass[far_nodes], sorted_mass[near_bodies])
+            )
+        interactions += count * source_mass.size
+
+        # Displacements of every member to every source
+        d = source_position[np.newaxis, :, :] - member_position[:, np.newaxis]
+        s2 = (d * d).sum(axis=2) + softening2
+        # Drops the bodies themselves when there is no softening
+        with np.errstate(divide="ignore"):
+            inverse = np.where(s2 > 0, s2 ** -1.5, 0.0)
+        if cutoff is not None:
+            inside = s2 < cutoff * cutoff
+            inverse[~inside] = 0.0
+            if force_factor is not None:
+                inverse[inside] *= force_factor(s2[inside])
+        elif force_factor is not None:
+            inverse *= force_factor(s2)
+        acceleration[tree.order[start:start + count]] = np.einsum(
+            "ijk,ij->ik", d, inverse * source_mass
+            )
+    instrumentation.count("interactions", interactions)
+    instrumentation.count("bodies walked", N)
+    return acceleration
+
+
+# Calculate the acceleration of every body with the octree
+# Same call as the pairwise kernels, so the octree can stand in for them
+# grouped: share interaction lists between bodies of the same small node
+def get_acceleration(
+        position, mass, G, softening, theta=0.5,
+        leaf_capacity=octree_leaf_capacity, grouped=True):
+    with instrumentation.timer("tree build"):
+        tree = build_octree(position, mass, leaf_capacity=leaf_capacity)
+    with instrumentation.timer("force walk"):
+        if grouped:
+            acceleration = walk_accelerations_grouped(
+                tree, position, mass, theta, softening
+                )
+        else:
+            acceleration = walk_accelerations(
+                tree, position, mass, theta, softening
+                )
+    return G * acceleration
+
+
+# Accelerations of the active bodies only, due to every body
+# Same call as pairwise_kernels.get_acceleration_active
+def get_acceleration_active(
+        active, position, mass, G, softening, theta=0.5,
+        leaf_capacity=octree_leaf_capacity):
+    with instrumentation.timer("tree build"):
+        tree = build_octree(position, mass, leaf_capacity=leaf_capacity)
+    with instrumentation.timer("force walk"):
+        acceleration = walk_accelerations(
+            tree, position, mass, theta, softening, bodies=active
+            )
+    return G * acceleration[active]
@@ -0,0 +1,185 @@
+import numpy as np
+
+
+"""
+Barnes-Hut Quadtree
+
+The quadtree shared by the Barnes-Hut simulations.
+
+1. add_body builds the quadtree one body at a time.
+
+2. force_on traverses the quadtree to a sufficient depth for one body,
+   using the center of mass of any cell that is far enough away.
+
+3. verlet and single_timestep_cycle numerically integrate the bodies.
+
+get_acceleration wraps all of this into the same call as the pairwise
+kernels: it takes an array of positions and masses and returns the
+acceleration of every body, so the Barnes-Hut engine can be driven by
+the integrators in the simulation package.
+"""
+
+# THE QUADTREE USED HERE IS INSPIRED BY THE WORK OF LEWIS COLE
+# https://lewiscoleblog.com/barnes-hut
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Quadtree node constructor - A class for a node within the quadtree.
+# We use the terminology "subnode" for nodes in the next quadtree depth level
+# If a node is contains no subnodes (children), then it represents a body
+class node:
+    def __init__(self, x, y, x_momentum, y_momentum, mass):
+        """
+        mass: Mass of node
+        x: x-coordinate for each node's centre of mass
+        y: y-coordinate for each node's centre of mass
+        x_momentum: x-coordinate of momentum, acceleration along x-coordinate
+        y_momentum: y-coordinate of momentum, acceleration along y-coordinate
+        com_array: array containing center of masses
+        momentum: array of momentums of all bodies.
+        (Momentum is a measurement of mass in motion)
+        subnode: child node
+        side: side-length (depth=0 side=1)
+        relative_position: relative position
+        """
+        self.mass = mass
+        self.com_array = np.array([x, y])
+        self.momentum = np.array([x_momentum, y_momentum])
+        self.subnode = None
+
+    # Internal node to take the place of this leaf when it is split
+    # Only the mass, center of mass and side length are carried over;
+    # the new node gets its own arrays, so nothing else has to be copied
+    def split_node(self):
+        internal = node(
+            self.com_array[0], self.com_array[1], 0.0, 0.0, self.mass
+            )
+        internal.side = self.side
+        internal.subnode = [None for i in range(4)]
+        return internal
+
+    # Place node in next level quadrant and recalculates relative position
+    def quadrant_division(self, i):
+        self.relative_position[i] *= 2.0
+        if self.relative_position[i] < 1.0:
+            quadrant = 0
+        else:
+            quadrant = 1
+            self.relative_position[i] -= 1.0
+        return quadrant
+
+    # Places node in next quadrant and returns quadrant number
+    def quadrant_next_node(self):
+        self.side = 0.5*self.side
+        return self.quadrant_division(1) + 2*self.quadrant_division(0)
+
+    # Repositions to the root depth quadrant
+    # (Goes back to full space / whole area)
+    # By default the whole area is the unit square, origin and size
+    # describe any other square containing every body
+    def quadrant_reposition(self, origin=0.0, size=1.0):
+        self.side = size
+        self.relative_position = (self.com_array - origin) / size
+
+    # Calculates distance between node and another node
+    def node_distance(self, other):
+        return np.linalg.norm(self.com_array - other.com_array)
+
+    # Force applied from current node to other node
+    # This is the center of mass of the
+    # entire cluster of bodies within the node
+    def applied_force_current_node(self, other):
+        d = self.node_distance(other)
+        return (
+            self.com_array - other.com_array
+            ) * (
+            self.mass * other.mass / d**3
+            )
+
+
+# Adds body to a node of quadtree
+# A minimum quadrant size is imposed to limit recursion depth
+# IE: How much/how far the quadtree can recurse/call itself
+# If this is not implementation, a maximum recutrsion depth warning will appear
+# Play with this by removing the "min_quad_size" variable
+def add_body(body, node):
+    # Assign body to node??
+    new_node = body if node is None else None
+    min_quad_size = 1.e-5
+    if node is not None and node.side > min_quad_size:
+        if node.subnode is None:
+            # The leaf becomes a subnode of a new internal node
+            new_node = node.split_node()
+            quad = node.quadrant_next_node()
+            new_node.subnode[quad] = node
+        else:
+            new_node = node
+
+        # The center of mass is the mass weighted mean of the positions
+        new_node.com_array = (
+            new_node.com_array * new_node.mass + body.com_array * body.mass
+            ) / (new_node.mass + body.mass)
+        new_node.mass += body.mass
+        quad = body.quadrant_next_node()
+        new_node.subnode[quad] = add_body(body, new_node.subnode[quad])
+    return new_node
+
+
+def force_on(body, node, theta):
+    # A body does not pull on itself
+    if node is body:
+        return np.zeros(2)
+    if node.subnode is None:
+        return node.applied_force_current_node(body)
+    if node.side < node.node_distance(body) * theta:
+        return node.applied_force_current_node(body)
+
+    return sum(force_on(body, c, theta) for c in node.subnode if c is not None)
+
+
+# Verlet algorithm
+# More efficient method of calculating velocity
+def verlet(bodies, root, theta, G, timestep):
+    for body in bodies:
+        force = G * force_on(body, root, theta)
+        body.momentum += timestep * force
+        body.com_array += timestep * body.momentum / body.mass
+
+
+# One simulation cycle
+def single_timestep_cycle(bodies, theta, g, step):
+    root = None
+    for body in bodies:
+        body.quadrant_reposition()
+        root = add_body(body, root)
+    verlet(bodies, root, theta, g, step)
+
+
+# Calculate the acceleration of every body with the quadtree
+# Takes arrays in the same way as the pairwise kernels:
+# position: N x 2 array of body positions
+# mass: N masses (N or N x 1)
+# The quadtree covers the smallest square containing every body,
+# so the positions do not have to lie in the unit square
+def get_acceleration(position, mass, G, theta):
+    mass = np.reshape(mass, -1)
+    bodies = [
+        node(x, y, 0.0, 0.0, m)
+        for (x, y), m in zip(position, mass)
+    ]
+
+    origin = position.min(axis=0)
+    size = (position.max(axis=0) - origin).max()
+    # Grow the square slightly so the furthest bodies fall inside it
+    size = size * (1.0 + 1.e-9) if size > 0 else 1.0
+
+    root = None
+    for body in bodies:
+        body.quadrant_reposition(origin, size)
+        root = add_body(body, root)
+
+    return np.array([
+        G * force_on(body, root, theta) / body.mass for body in bodies
+    ])
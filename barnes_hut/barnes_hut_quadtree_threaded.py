@@ -1,10 +1,7 @@
-from copy import deepcopy
 import numpy as np
 import timeit
-import psutil
-import cProfile
-import threading
-import time
+import os
+import sys
 
 
 """
@@ -20,6 +17,11 @@ Barnes-Hut Algorithm
 
 3. Numerically integrate using your algorithm of choice.
    (Velocity Verlet, Euler etc)
+
+Every timestep runs in order. The tree is built once per timestep in
+this process, then the force walk is split across a persistent pool
+of worker processes reading the tree from shared memory
+(barnes_hut_multiprocess.SharedMemoryTreeEngine).
 """
 
 # THE QUADTREE USED HERE IS INSPIRED BY THE WORK OF LEWIS COLE
@@ -28,276 +30,197 @@ Barnes-Hut Algorithm
 # THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
 # https://peps.python.org/pep-0008/
 
+# Allow the shared quadtree module to be imported when this script
+# is launched directly from its .bat file
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
 
-# Quadtree node constructor - A class for a node within the quadtree.
-# We use the terminology "subnode" for nodes in the next quadtree depth level
-# If a node is contains no subnodes (children), then it represents a body
-class node:
-    def __init__(self, x, y, x_momentum, y_momentum, mass):
-        """
-        mass: Mass of node
-        x: x-coordinate for each node's centre of mass
-        y: y-coordinate for each node's centre of mass
-        x_momentum: x-coordinate of momentum, acceleration along x-coordinate
-        y_momentum: y-coordinate of momentum, acceleration along y-coordinate
-        com_array: array containing center of masses
-        momentum: array of momentums of all bodies.
-        (Momentum is a measurement of mass in motion)
-        subnode: child node
-        side: side-length (depth=0 side=1)
-        relative_position: relative position
-        """
-        self.mass = mass
-        self.com_array = np.array([x, y])
-        self.momentum = np.array([x_momentum, y_momentum])
-        self.subnode = None
-
-    # Place node in next level quadrant and recalculates relative position
-    def quadrant_division(self, i):
-        self.relative_position[i] *= 2.0
-        if self.relative_position[i] < 1.0:
-            quadrant = 0
-        else:
-            quadrant = 1
-            self.relative_position[i] -= 1.0
-        return quadrant
-
-    # Places node in next quadrant and returns quadrant number
-    def quadrant_next_node(self):
-        self.side = 0.5*self.side
-        return self.quadrant_division(1) + 2*self.quadrant_division(0)
-
-    # Repositions to the root depth quadrant
-    # (Goes back to full space / whole area)
-    def quadrant_reposition(self):
-        self.side = 1.0
-        self.relative_position = self.com_array.copy()
-
-    # Calculates distance between node and another node
-    def node_distance(self, other):
-        return np.linalg.norm(self.com_array - other.com_array)
-
-    # Force applied from current node to other node
-    # This is the center of mass of the
-    # entire cluster of bodies within the node
-    def applied_force_current_node(self, other):
-        d = self.node_distance(other)
-        return (
-            self.com_array - other.com_array
-            ) * (
-            self.mass * other.mass / d**3
-            )
-
-
-# Adds body to a node of quadtree
-# A minimum quadrant size is imposed to limit recursion depth
-# IE: How much/how far the quadtree can recurse/call itself
-# If this is not implementation, a maximum recutrsion depth warning will appear
-# Play with this by removing the "min_quad_size" variable
-def add_body(body, node):
-    # Assign body to node??
-    new_node = body if node is None else None
-    min_quad_size = 1.e-5
-    if node is not None and node.side > min_quad_size:
-        if node.subnode is None:
-            # Deep copy is a process in which the
-            # copying process occurs recursively.
-            # It means first constructing a new collection object
-            # and then recursively populating it with copies of the
-            # child objects found in the original
-            new_node = deepcopy(node)
-            new_node.subnode = [None for i in range(4)]
-            quad = node.quadrant_next_node()
-            new_node.subnode[quad] = node
-        else:
-            new_node = node
-
-        new_node.mass += body.mass
-        new_node.com_array += body.com_array
-        quad = body.quadrant_next_node()
-        new_node.subnode[quad] = add_body(body, new_node.subnode[quad])
-    return new_node
-
-
-def force_on(body, node, theta):
-    if node.subnode is None:
-        return node.applied_force_current_node(body)
-    if node.side < node.node_distance(body) * theta:
-        return node.applied_force_current_node(body)
-
-    return sum(force_on(body, c, theta) for c in node.subnode if c is not None)
-
-
-# Verlet algorithm
-# More efficient method of calculating velocity
-def verlet(bodies, root, theta, G, timestep):
-    for body in bodies:
-        force = G * force_on(body, root, theta)
-        body.momentum += timestep * force
-        body.com_array += timestep * body.momentum / body.mass
-
-
-# One simulation cycle
-def single_timestep_cycle(bodies, theta, g, step):
-    root = None
-    for body in bodies:
-        body.quadrant_reposition()
-        root = add_body(body, root)
-    verlet(bodies, root, theta, g, step)
+from barnes_hut.barnes_hut_multiprocess import (  # noqa: E402
+    SharedMemoryTreeEngine
+    )
+from simulation import instrumentation  # noqa: E402
 
 
 # ********************************************************************************************
 # MAIN CODE
 
-# SIMULATION PARAMETERS
-
-print("********************************************************")
-print(" ____  _                        ____            _       ")
-print("|  _ \(_)                      |  _ \          | |      ")
-print("| |_) |_ _ __   __ _ _ __ _   _| |_) | ___   __| |_   _ ")
-print("|  _ <| | '_ \ / _` | '__| | | |  _ < / _ \ / _` | | | |")
-print("| |_) | | | | | (_| | |  | |_| | |_) | (_) | (_| | |_| |")
-print("|____/|_|_| |_|\__,_|_|   \__, |____/ \___/ \__,_|\__, |")
-print("                           __/ |                   __/ |")
-print("                          |___/                   |___/ ")
-print("********************************************************\n")
-
-print("********************************************************")
-print("THREADED Barnes-Hut Quadtree")
-print("********************************************************\n")
-
-# Number of bodies
-print("*****************")
-print("Simulation bodies")
-print("*****************")
-print("Choose the number of bodies to populate the simulation with.")
-number_of_bodies = int(input("\nEnter the number of bodies: "))
-
-# Number of timesteps
-# Fixed amount of time by which the simulation advances/progresses.
-print("\n*******************")
-print("Timestep definition")
-print("*******************")
-print("This is the fixed amount of time by which the simulation advances")
-number_of_timesteps = int(input("\nEnter the number of timesteps: "))
-
-print("\nSimulating body movements...")
-print("Please wait...")
-
-# Theta parameter
-# This determines what is considered short and long range
-# We consider both the distance to the center
-# of a quadtree cell and that cell’s width.
-# If the ratio width / distance falls below a chosen threshold,
-# then we treat the quadtree cell as a source of long-range
-# gravitational forces and use its center of mass.
-# Otherwise, we will recursively visit the child cells in the quadtree.
-# 0.5 is commonly used in practice
-Theta = 0.5
-
-# Newton'side Gravitational Constant
-G = 6.67 / 1e11
-
-# Change in time between frames/simulation cycles (Delta time)
-# Delta time describes the time difference between
-# the previous frame that was drawn and the current frame
-Timestep = 0.01
-
-# Random seed
-np.random.seed(50)
-
-# *******************
-# Initial Conditions
-# *******************
-# BODY PROPERTIES TO BE INSERTED INTO THE ARRAY
-# Bodies all have mass of 100, like in Pairwise Algorithm
-# Keeps things fair
-# Mass property of body, multiplied by number of bodies specified by user
-# mass = 100 * np.ones((number_of_bodies, 1)) / number_of_bodies
-mass = np.random.random(number_of_bodies) * 10
-
-# Random x coordinate, multiply random x cooridinates
-# by number of bodies specified by user
-random_x = np.random.random(number_of_bodies)
-
-# Random y coordinate, multiply random x cooridinates
-# by number of bodies specified by user
-random_y = np.random.random(number_of_bodies)
-
-# Random x momentum coordinate
-random_x_momentum = np.random.random(number_of_bodies) - 0.5
-
-# Random y momentum coordinate
-random_y_momentum = np.random.random(number_of_bodies) - 0.5
-
-# Create array/list of bodies
-# An array of bodies which have a positional x coordinate, y coordinate,
-# momentum on x coordiate, momentum on y coordinate, and mass
-Bodies = [
-    node(x0, y0, pX0, pY0, mass)
-    # Zip functions are used to iterate through a tuple;
-    # an unchangable ordered list
-    # List of iterables which are collected into a tuple, and returned
-    # This will be multiplied by the number of bodies,
-    # as specified when defining the properties of each body
-    for (
-        x0, y0, pX0, pY0, mass
-        )
-    in zip(
-        random_x, random_y, random_x_momentum, random_y_momentum, mass
-        )
-]
-
-
-def barnes_hut_simulation_loop(n):
-    # MAIN SIMULATION LOOP
-    # Loop the function for one simulation cycle,
-    # multiplied number of timesteps
-
-    # Create a number of threads equal to the number of timesteps.
-    # Threads will be stored in this list to avoid starting and joining
-    # every thread manually.
-    # If threads were not stored in this way, problems could occur
-    # with larger simulations that contain more bodies.
-    threads = []
-
-    # Simulation Main Loop
-    for i in range(n):
-        # Create and Start Thread
-        t1 = threading.Thread(
-            target=single_timestep_cycle,
-            args=(Bodies, Theta, G, Timestep)
-            )
+# The worker processes import this module, so the simulation only runs
+# when it is launched directly
+if __name__ == "__main__":
+    # SIMULATION PARAMETERS
+
+    print("********************************************************")
+    print(" ____  _                        ____            _       ")
+    print("|  _ \(_)                      |  _ \          | |      ")
+    print("| |_) |_ _ __   __ _ _ __ _   _| |_) | ___   __| |_   _ ")
+    print("|  _ <| | '_ \ / _` | '__| | | |  _ < / _ \ / _` | | | |")
+    print("| |_) | | | | | (_| | |  | |_| | |_) | (_) | (_| | |_| |")
+    print("|____/|_|_| |_|\__,_|_|   \__, |____/ \___/ \__,_|\__, |")
+    print("                           __/ |                   __/ |")
+    print("                          |___/                   |___/ ")
+    print("********************************************************\n")
+
+    print("********************************************************")
+    print("THREADED Barnes-Hut Quadtree")
+    print("********************************************************\n")
+
+    # Number of bodies
+    print("*****************")
+    print("Simulation bodies")
+    print("*****************")
+    print("Choose the number of bodies to populate the simulation with.")
+    number_of_bodies = int(input("\nEnter the number of bodies: "))
+
+    # Number of timesteps
+    # Fixed amount of time by which the simulation advances/progresses.
+    print("\n*******************")
+    print("Timestep definition")
+    print("*******************")
+    print("This is the fixed amount of time by which the simulation advances")
+    number_of_timesteps = int(input("\nEnter the number of timesteps: "))
+
+    # Number of worker processes
+    # The force walk of every timestep is split across a pool of worker
+    # processes, each one walking the tree for its own share of the bodies
+    print("\n*****************")
+    print("Worker processes")
+    print("*****************")
+    print("Choose the number of processes to calculate the forces with.")
+    number_of_workers = input(
+        "\nEnter the number of workers (default: %d): " % os.cpu_count()
+        ).strip()
+    number_of_workers = int(number_of_workers) if number_of_workers else None
+
+    print("\nSimulating body movements...")
+    print("Please wait...")
 
-        threads.append(t1)
-        t1.start()
+    # Theta parameter
+    # This determines what is considered short and long range
+    # We consider both the distance to the center
+    # of a quadtree cell and that cell’s width.
+    # If the ratio width / distance falls below a chosen threshold,
+    # then we treat the quadtree cell as a source of long-range
+    # gravitational forces and use its center of mass.
+    # Otherwise, we will recursively visit the child cells in the quadtree.
+    # 0.5 is commonly used in practice
+    Theta = 0.5
+
+    # Newton'side Gravitational Constant
+    G = 6.67 / 1e11
+
+    # Change in time between frames/simulation cycles (Delta time)
+    # Delta time describes the time difference between
+    # the previous frame that was drawn and the current frame
+    Timestep = 0.01
+
+    # Refit the tree between timesteps instead of rebuilding it
+    # Off by default, as with these initial conditions the refit always
+    # falls back to a rebuild (see barnes_hut_quadtree_unthreaded.py)
+    Refit = False
+
+    # Walk of the force calculation, the same as in the UNTHREADED
+    # script, so one worker runs exactly what it runs
+    Grouped = False
+    Leaf_capacity = 1
+
+    # Random seed
+    np.random.seed(50)
+
+    # *******************
+    # Initial Conditions
+    # *******************
+    # BODY PROPERTIES TO BE INSERTED INTO THE ARRAY
+    # Bodies all have mass of 100, like in Pairwise Algorithm
+    # Keeps things fair
+    # Mass property of body, multiplied by number of bodies specified by user
+    # mass = 100 * np.ones((number_of_bodies, 1)) / number_of_bodies
+    mass = np.random.random(number_of_bodies) * 10
+
+    # Random x coordinate, multiply random x cooridinates
+    # by number of bodies specified by user
+    random_x = np.random.random(number_of_bodies)
+
+    # Random y coordinate, multiply random x cooridinates
+    # by number of bodies specified by user
+    random_y = np.random.random(number_of_bodies)
+
+    # Random x momentum coordinate
+    random_x_momentum = np.random.random(number_of_bodies) - 0.5
+
+    # Random y momentum coordinate
+    random_y_momentum = np.random.random(number_of_bodies) - 0.5
+
+    # Arrays of bodies
+    # Every body has a positional x coordinate, y coordinate,
+    # momentum on x coordiate, momentum on y coordinate, and mass
+    # Row i of each array belongs to body i
+    position = np.column_stack((random_x, random_y))
+    momentum = np.column_stack((random_x_momentum, random_y_momentum))
+
+    # Start the worker pool once; it is reused by every timestep
+    engine = SharedMemoryTreeEngine(
+        number_of_bodies, workers=number_of_workers, grouped=Grouped,
+        leaf_capacity=Leaf_capacity, refit=Refit
+        )
 
-    # Active threads
-    print(f'Active Threads: {threading.active_count()}')
+    def barnes_hut_simulation_loop(n):
+        # MAIN SIMULATION LOOP
+        # Loop the function for one simulation cycle,
+        # multiplied number of timesteps
+        # Every timestep finishes before the next one starts; only the
+        # force walk inside a timestep runs in parallel
+        for _ in range(n):
+            engine.step(position, momentum, mass, Theta, G, Timestep)
+
+    # Record the timers and counters of every phase while the
+    # simulation runs
+    probe = instrumentation.enable()
+    cpu_start = instrumentation.cpu_time()
+
+    # Time the simulation
+    result = timeit.timeit(
+        lambda: barnes_hut_simulation_loop(number_of_timesteps),
+        number=1)
+    cpu_used = instrumentation.cpu_time() - cpu_start
+    instrumentation.disable()
+
+    # Active worker processes
+    print(f'Active worker processes: {engine.workers}')
     print("Please wait...")
 
-    for t in threads:
-        t1.join()
+    print("\nCalculations complete...")
+    print("\nPlease wait...")
+    print("\n")
 
+    print(
+        "The execution time of the THREADED BH Quadtree simulation with",
+        number_of_bodies, "bodies is: ", result, "s"
+        )
 
-print("\nCalculations complete...")
-print("\nPlease wait...")
-print("\n")
-
-# Time the simulation
-result = timeit.timeit(
-    lambda: barnes_hut_simulation_loop(number_of_timesteps),
-    number=1)
+    # Wall time of every phase of the timesteps
+    for phase, seconds in engine.timings.items():
+        print(
+            "Time spent in the", phase, "phase:", seconds, "s",
+            "(" + str(seconds / max(engine.steps, 1)), "s per timestep)"
+            )
 
-print(
-    "The execution time of the THREADED BH Quadtree simulation with",
-    number_of_bodies, "bodies is: ", result, "s"
-    )
+    # Time spent in every phase of the timesteps
+    print("\n")
+    probe.print_summary()
+    profile_file = "barnes_hut_threaded_profile.prof"
+    probe.write_pstats(profile_file)
+    print(
+        "\nPhase timings written to", profile_file,
+        "- open them with: snakeviz", profile_file
+        )
 
-# Record function calls
-print("\n\n")
-cProfile.run("barnes_hut_simulation_loop(number_of_timesteps)")
+    # Stop the worker pool and release the shared memory
+    engine.close()
 
-# System CPU usage
-print("The overall system CPU usage is : ", psutil.cpu_percent())
-input("Press ENTER to exit")
+    # CPU usage of the simulation and its worker processes
+    print(
+        "CPU usage during the simulation:",
+        100 * cpu_used / max(result, 1e-9), "% of one CPU"
+        )
+    input("Press ENTER to exit")
@@ -1,9 +1,7 @@
-from copy import deepcopy
 import numpy as np
 import timeit
-import psutil
-import cProfile
-import time
+import os
+import sys
 
 
 """
@@ -27,122 +25,17 @@ Barnes-Hut Algorithm
 # THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
 # https://peps.python.org/pep-0008/
 
+# Allow the shared quadtree module to be imported when this script
+# is launched directly from its .bat file
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
 
-# Quadtree node constructor - A class for a node within the quadtree.
-# We use the terminology "subnode" for nodes in the next quadtree depth level
-# If a node is contains no subnodes (children), then it represents a body
-class node:
-    def __init__(self, x, y, x_momentum, y_momentum, mass):
-        """
-        mass: Mass of node
-        x: x-coordinate for each node's centre of mass
-        y: y-coordinate for each node's centre of mass
-        x_momentum: x-coordinate of momentum, acceleration along x-coordinate
-        y_momentum: y-coordinate of momentum, acceleration along y-coordinate
-        com_array: array containing center of masses
-        momentum: array of momentums of all bodies.
-        (Momentum is a measurement of mass in motion)
-        subnode: child node
-        side: side-length (depth=0 side=1)
-        relative_position: relative position
-        """
-        self.mass = mass
-        self.com_array = np.array([x, y])
-        self.momentum = np.array([x_momentum, y_momentum])
-        self.subnode = None
-
-    # Place node in next level quadrant and recalculates relative position
-    def quadrant_division(self, i):
-        self.relative_position[i] *= 2.0
-        if self.relative_position[i] < 1.0:
-            quadrant = 0
-        else:
-            quadrant = 1
-            self.relative_position[i] -= 1.0
-        return quadrant
-
-    # Places node in next quadrant and returns quadrant number
-    def quadrant_next_node(self):
-        self.side = 0.5*self.side
-        return self.quadrant_division(1) + 2*self.quadrant_division(0)
-
-    # Repositions to the root depth quadrant
-    # (Goes back to full space / whole area)
-    def quadrant_reposition(self):
-        self.side = 1.0
-        self.relative_position = self.com_array.copy()
-
-    # Calculates distance between node and another node
-    def node_distance(self, other):
-        return np.linalg.norm(self.com_array - other.com_array)
-
-    # Force applied from current node to other node
-    # This is the center of mass of the
-    # entire cluster of bodies within the node
-    def applied_force_current_node(self, other):
-        d = self.node_distance(other)
-        return (
-            self.com_array - other.com_array
-            ) * (
-            self.mass * other.mass / d**3
-            )
-
+from barnes_hut.barnes_hut_flat_tree import (  # noqa: E402
+    single_timestep_cycle
+    )
+from simulation import instrumentation  # noqa: E402
 
-# Adds body to a node of quadtree
-# A minimum quadrant size is imposed to limit recursion depth
-# IE: How much/how far the quadtree can recurse/call itself
-# If this is not implementation, a maximum recutrsion depth warning will appear
-# Play with this by removing the "min_quad_size" variable
-def add_body(body, node):
-    # Assign body to node??
-    new_node = body if node is None else None
-    min_quad_size = 1.e-5
-    if node is not None and node.side > min_quad_size:
-        if node.subnode is None:
-            # Deep copy is a process in which the
-            # copying process occurs recursively.
-            # It means first constructing a new collection object
-            # and then recursively populating it with copies of the
-            # child objects found in the original
-            new_node = deepcopy(node)
-            new_node.subnode = [None for i in range(4)]
-            quad = node.quadrant_next_node()
-            new_node.subnode[quad] = node
-        else:
-            new_node = node
-
-        new_node.mass += body.mass
-        new_node.com_array += body.com_array
-        quad = body.quadrant_next_node()
-        new_node.subnode[quad] = add_body(body, new_node.subnode[quad])
-    return new_node
-
-
-def force_on(body, node, theta):
-    if node.subnode is None:
-        return node.applied_force_current_node(body)
-    if node.side < node.node_distance(body) * theta:
-        return node.applied_force_current_node(body)
-
-    return sum(force_on(body, c, theta) for c in node.subnode if c is not None)
-
-
-# Verlet algorithm
-# More efficient method of calculating velocity
-def verlet(bodies, root, theta, G, timestep):
-    for body in bodies:
-        force = G * force_on(body, root, theta)
-        body.momentum += timestep * force
-        body.com_array += timestep * body.momentum / body.mass
-
-
-# One simulation cycle
-def single_timestep_cycle(bodies, theta, g, step):
-    root = None
-    for body in bodies:
-        body.quadrant_reposition()
-        root = add_body(body, root)
-    verlet(bodies, root, theta, g, step)
 
 # ********************************************************************************************
 # MAIN CODE
@@ -193,6 +86,18 @@ print("Please wait...")
 # 0.5 is commonly used in practice
 Theta = 0.5
 
+# Refit the tree between timesteps instead of rebuilding it
+# Off by default: with these initial conditions over a third of the
+# bodies leave their leaf every timestep, so the refit always falls
+# back to a rebuild and only adds the cost of checking
+Refit = False
+
+# Walk of the force calculation, the same in the THREADED script
+# Grouped shares one interaction list between the bodies of a small
+# node, Leaf_capacity is the most bodies a leaf of the tree may hold
+Grouped = False
+Leaf_capacity = 1
+
 # Newton'side Gravitational Constant
 G = 6.67 / 1e11
 
@@ -228,51 +133,61 @@ random_x_momentum = np.random.random(number_of_bodies) - 0.5
 # Random y momentum coordinate
 random_y_momentum = np.random.random(number_of_bodies) - 0.5
 
-# Create array/list of bodies
-# An array of bodies which have a positional x coordinate, y coordinate,
+# Arrays of bodies
+# Every body has a positional x coordinate, y coordinate,
 # momentum on x coordiate, momentum on y coordinate, and mass
-Bodies = [
-    node(x0, y0, pX0, pY0, mass)
-    # Zip functions are used to iterate through a tuple;
-    # an unchangable ordered list
-    # List of iterables which are collected into a tuple, and returned
-    # This will be multiplied by the number of bodies,
-    # as specified when defining the properties of each body
-    for (
-        x0, y0, pX0, pY0, mass
-        )
-    in zip(
-        random_x, random_y, random_x_momentum, random_y_momentum, mass
-        )
-]
+# Row i of each array belongs to body i
+position = np.column_stack((random_x, random_y))
+momentum = np.column_stack((random_x_momentum, random_y_momentum))
 
 
 def barnes_hut_simulation_loop(n):
     # MAIN SIMULATION LOOP
     # Loop the function for one simulation cycle,
     # multiplied number of timesteps
+    tree = None
     for _ in range(n):
-        single_timestep_cycle(Bodies, Theta, G, Timestep)
+        tree = single_timestep_cycle(
+            position, momentum, mass, Theta, G, Timestep,
+            grouped=Grouped, leaf_capacity=Leaf_capacity,
+            refit=Refit, tree=tree
+            )
 
 
 print("\nCalculations complete...")
 print("\nPlease wait...")
 print("\n")
 
+# Record the timers and counters of every phase while the
+# simulation runs
+probe = instrumentation.enable()
+cpu_start = instrumentation.cpu_time()
+
 # Time the simulation
 result = timeit.timeit(
     lambda: barnes_hut_simulation_loop(number_of_timesteps),
     number=1)
+cpu_used = instrumentation.cpu_time() - cpu_start
+instrumentation.disable()
 
 print(
     "The execution time of the UNTHREADED BH Quadtree simulation with",
     number_of_bodies, "bodies is: ", result, "s"
     )
 
-# Record function calls
-print("\n\n")
-cProfile.run("barnes_hut_simulation_loop(number_of_timesteps)")
+# Time spent in every phase of the timesteps
+print("\n")
+probe.print_summary()
+profile_file = "barnes_hut_profile.prof"
+probe.write_pstats(profile_file)
+print(
+    "\nPhase timings written to", profile_file,
+    "- open them with: snakeviz", profile_file
+    )
 
-# System CPU usage
-print("The overall system CPU usage is : ", psutil.cpu_percent())
+# CPU usage of the simulation and its worker processes
+print(
+    "CPU usage during the simulation:",
+    100 * cpu_used / max(result, 1e-9), "% of one CPU"
+    )
 input("Press ENTER to exit")
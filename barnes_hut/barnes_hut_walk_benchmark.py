@@ -0,0 +1,83 @@
+import numpy as np
+import timeit
+import os
+import sys
+
+
+"""
+Barnes-Hut Force Walk Benchmark
+
+Times the force walk of the flat quadtree per body, comparing the
+recursive force_on against the iterative, stack based
+force_on_iterative on the same tree.
+
+Usage:
+    python barnes_hut_walk_benchmark.py [number of bodies] [theta]
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+# Allow the shared quadtree module to be imported when this script
+# is launched directly
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+from barnes_hut.barnes_hut_flat_tree import (  # noqa: E402
+    build_tree, force_on, node_offsets, walk_forces
+    )
+
+
+def recursive_walk(tree, position, mass, theta):
+    force = np.zeros(position.shape)
+    offset = node_offsets(tree)
+    for body in range(position.shape[0]):
+        force[body] = force_on(
+            tree, body, tree.root, theta, position, mass, offset
+            )
+    return force
+
+
+def benchmark_walk(number_of_bodies, theta, repeats=3):
+    np.random.seed(50)
+    mass = np.random.random(number_of_bodies) * 10
+    position = np.random.random((number_of_bodies, 2))
+    tree = build_tree(position, mass)
+
+    results = {}
+    for name, walk in (
+            ("recursive", recursive_walk),
+            ("iterative", walk_forces)):
+        best = min(timeit.repeat(
+            lambda: walk(tree, position, mass, theta),
+            number=1, repeat=repeats
+            ))
+        results[name] = best / number_of_bodies
+
+    # Both walks must agree before their times mean anything
+    recursive = recursive_walk(tree, position, mass, theta)
+    iterative = walk_forces(tree, position, mass, theta)
+    results["max relative difference"] = (
+        np.abs(recursive - iterative).max() / np.abs(recursive).max()
+        )
+    return results
+
+
+if __name__ == "__main__":
+    number_of_bodies = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    theta = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+
+    results = benchmark_walk(number_of_bodies, theta)
+    print(
+        "Force walk with", number_of_bodies, "bodies, theta =", theta
+        )
+    print("Recursive walk per body: ", results["recursive"], "s")
+    print("Iterative walk per body: ", results["iterative"], "s")
+    print(
+        "Speed-up: ", results["recursive"] / results["iterative"]
+        )
+    print(
+        "Max relative difference in force: ",
+        results["max relative difference"]
+        )
@@ -1,5 +1,6 @@
 from subprocess import call, Popen
 import os
+import sys
 import time
 
 
@@ -14,6 +15,13 @@ def clear():
         _ = os.system("clear")
 
 
+# With command line arguments the chosen engine is run straight away,
+# without the menu or any other input, and its timings are printed as
+# JSON (see simulation/runner.py for the options)
+if len(sys.argv) > 1:
+    from simulation.runner import main
+    sys.exit(main())
+
 print("********************************************************")
 print(" ____  _                        ____            _       ")
 print("|  _ \(_)                      |  _ \          | |      ")
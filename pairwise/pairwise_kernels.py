@@ -0,0 +1,330 @@
+import math
+import numpy as np
+import psutil
+
+
+"""
+PAIRWISE FORCE KERNELS
+
+Every kernel in this module takes the same arguments and returns the
+same N x 3 acceleration array, so they can be swapped freely:
+
+position: N x 3 array of body positions
+mass: N x 1 array of body masses
+G: Newton's Gravitational Constant
+softening: softening length added to avoid infinite accelerations
+
+loop
+    - The original non-vectorized double loop over every pair
+    - Kept as the reference the other kernels are compared against
+
+vectorized
+    - Builds the N x N displacement matrices in one broadcast and
+      evaluates (r² + ε²)^-1.5 once for the whole matrix
+
+tiled
+    - Same arithmetic as the vectorized kernel, but the bodies are
+      processed in square target/source blocks so peak memory stays
+      bounded by the block size rather than N x N
+    - The block size is picked from the available memory unless given
+
+symmetric
+    - Uses Newton's third law: each unordered pair i, j is evaluated once
+      over the upper triangle of blocks, and the equal and opposite
+      contributions are applied to both bodies, halving the work
+    - The self-term i == i is removed explicitly rather than relying on
+      the softening length
+    - Blocks are always visited in the same order, so for a given block
+      size the output is bit-for-bit reproducible
+
+mixed
+    - The tiled kernel in mixed precision: positions and masses are
+      stored and every pair is evaluated in float32, while the sums
+      over the sources are worked out in float64 (weighted_sum)
+    - Every temporary is half the size, so a block can hold twice the
+      pairs in the same memory, at the cost of a median relative force
+      error around 5e-8, 3e-7 at most (see simulation/precision_report.py)
+
+The tiled, symmetric and active kernels take precision="float32" to
+work the same way; the integrators keep their positions, velocities
+and accelerations in float64 whatever the precision of the forces.
+"""
+
+
+# THE PAIRWISE ALGORITHM USED HERE IS INSPIRED BY THE WORK OF PHILIP MOCZ
+# https://github.com/pmocz/nbody-python
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Reference kernel - the original nested loop over every pair of bodies
+def get_acceleration_loop(position, mass, G, softening):
+    # Give dimensions of the array
+    # The array will represent the matrix
+    N = position.shape[0]
+
+    # Return an array of the given size, filled with zeroes
+    # Filled with zeroes for now
+    # The accelerations for each body will be inserted into this array
+    # and it will be updated
+    acceleration = np.zeros((N, 3))
+
+    # Loop through 2D Array for every body
+    for i in range(N):
+        for j in range(N):
+
+            # Particle in question's x,y and z axis
+            x = position[j, 0] - position[i, 0]
+            y = position[j, 1] - position[i, 1]
+            z = position[j, 2] - position[i, 2]
+
+            # Inverse square law
+            # Softening is the number added to avoid issues when two bodies
+            # are close to one another
+            # If not added, the acceleration can go to infinity
+            inverse = math.pow(
+                math.pow(x, 2) +
+                math.pow(y, 2) +
+                math.pow(z, 2) +
+                math.pow(softening, 2), -1.5
+                )
+
+            acceleration[i, 0] += G * (x * inverse) * mass[j]
+            acceleration[i, 1] += G * (y * inverse) * mass[j]
+            acceleration[i, 2] += G * (z * inverse) * mass[j]
+
+    return acceleration
+
+
+# Vectorized kernel - every pair is evaluated at once with NumPy broadcasting
+def get_acceleration_vectorized(position, mass, G, softening):
+    # Column vectors of every body's x, y and z axis
+    x = position[:, 0:1]
+    y = position[:, 1:2]
+    z = position[:, 2:3]
+
+    # Displacement matrices, dx[i, j] = x[j] - x[i]
+    # Same sign convention as the loop kernel
+    dx = x.T - x
+    dy = y.T - y
+    dz = z.T - z
+
+    # Inverse cube of the softened distance for every pair, in one pass
+    inverse = (dx**2 + dy**2 + dz**2 + softening**2) ** (-1.5)
+
+    # Matrix-vector product with the masses sums the
+    # contribution of every body j onto body i
+    mass = np.reshape(mass, (-1, 1))
+    ax = G * (dx * inverse) @ mass
+    ay = G * (dy * inverse) @ mass
+    az = G * (dz * inverse) @ mass
+
+    return np.hstack((ax, ay, az))
+
+
+# Share of the currently available memory the tiled kernel may use
+# for the temporary arrays of one block
+TILE_MEMORY_FRACTION = 0.25
+
+# Number of N x N sized temporaries alive at once inside a block
+# (dx, dy, dz, inverse and one weighted displacement)
+TILE_TEMPORARIES = 5
+
+# Floating point types the pairwise arithmetic can be done in
+PRECISIONS = {
+    "float64": np.float64,
+    "float32": np.float32,
+}
+
+
+# Floating point type of a precision given by name
+def precision_dtype(precision):
+    if precision not in PRECISIONS:
+        raise ValueError(
+            "Unknown precision '%s', choose from: %s"
+            % (precision, ", ".join(PRECISIONS))
+            )
+    return PRECISIONS[precision]
+
+
+# Pick the largest block size whose temporaries fit in the memory budget
+def auto_tile_size(N, available_memory=None, precision="float64"):
+    if available_memory is None:
+        available_memory = psutil.virtual_memory().available
+    budget = available_memory * TILE_MEMORY_FRACTION
+    bytes_per_pair = (
+        TILE_TEMPORARIES * np.dtype(precision_dtype(precision)).itemsize
+        )
+    tile_size = int(math.sqrt(budget / bytes_per_pair))
+    return max(1, min(N, tile_size))
+
+
+# Pull of the sources on every target of a block, weighted times
+# source_mass, always summed in float64
+# In float32 the pairs are multiplied in float64 as they are summed,
+# without a float64 copy of the block, so the sum over the sources is
+# never rounded to float32
+def weighted_sum(weighted, source_mass):
+    if weighted.dtype == np.float64:
+        return weighted @ source_mass
+    return np.einsum("ij,jk->ik", weighted, source_mass, dtype=np.float64)
+
+
+# Accelerations of the target bodies due to every body in position
+# Targets and sources are both split into blocks of tile_size, so at most
+# tile_size x tile_size pairs are in memory at a time
+# The targets may be any subset of the bodies, which lets a worker
+# calculate only its own share of the rows
+# precision: floating point type of the pair arithmetic, the sums over
+# the sources are always worked out in float64 (see weighted_sum)
+def get_acceleration_on(
+        target, position, mass, G, softening, tile_size,
+        precision="float64"):
+    dtype = precision_dtype(precision)
+    N = position.shape[0]
+    target = target.astype(dtype, copy=False)
+    position = position.astype(dtype, copy=False)
+    mass = np.reshape(mass, (-1, 1)).astype(dtype, copy=False)
+    acceleration = np.zeros((target.shape[0], 3))
+
+    for target_start in range(0, target.shape[0], tile_size):
+        target_stop = min(target_start + tile_size, target.shape[0])
+        target_block = target[target_start:target_stop]
+
+        for source_start in range(0, N, tile_size):
+            source_stop = min(source_start + tile_size, N)
+            source = position[source_start:source_stop]
+            source_mass = mass[source_start:source_stop]
+
+            # Displacement matrices for this block only
+            dx = source[:, 0] - target_block[:, 0:1]
+            dy = source[:, 1] - target_block[:, 1:2]
+            dz = source[:, 2] - target_block[:, 2:3]
+
+            inverse = (dx**2 + dy**2 + dz**2 + softening**2) ** (-1.5)
+
+            block = acceleration[target_start:target_stop]
+            block[:, 0:1] += G * weighted_sum(dx * inverse, source_mass)
+            block[:, 1:2] += G * weighted_sum(dy * inverse, source_mass)
+            block[:, 2:3] += G * weighted_sum(dz * inverse, source_mass)
+
+    return acceleration
+
+
+# Tiled kernel - the vectorized kernel applied block by block
+def get_acceleration_tiled(
+        position, mass, G, softening, tile_size=None, precision="float64"):
+    if tile_size is None:
+        tile_size = auto_tile_size(position.shape[0], precision=precision)
+    if tile_size < 1:
+        raise ValueError("tile_size must be at least 1, got %d" % tile_size)
+
+    return get_acceleration_on(
+        position, position, mass, G, softening, tile_size, precision
+        )
+
+
+# Mixed precision kernel - the tiled kernel with float32 pair arithmetic
+def get_acceleration_mixed(position, mass, G, softening, tile_size=None):
+    return get_acceleration_tiled(
+        position, mass, G, softening, tile_size, precision="float32"
+        )
+
+
+# Accelerations of the active bodies only, due to every body
+# Used by the block timestep integrator, which only recalculates the
+# bodies whose timestep ends
+def get_acceleration_active(
+        active, position, mass, G, softening, tile_size=None,
+        precision="float64"):
+    if tile_size is None:
+        tile_size = auto_tile_size(position.shape[0], precision=precision)
+    return get_acceleration_on(
+        position[active], position, mass, G, softening, tile_size,
+        precision
+        )
+
+
+# Default block size of the symmetric kernel
+# Small enough that the diagonal blocks, which are evaluated in full,
+# are a small share of the work
+SYMMETRIC_TILE_SIZE = 512
+
+
+# Symmetric kernel - every unordered pair is evaluated once
+# Only blocks on or above the diagonal are visited; the acceleration
+# a block produces on its target bodies is mirrored onto its source bodies
+def get_acceleration_symmetric(
+        position, mass, G, softening, tile_size=None, precision="float64"):
+    N = position.shape[0]
+    if tile_size is None:
+        tile_size = min(
+            auto_tile_size(N, precision=precision), SYMMETRIC_TILE_SIZE
+            )
+    if tile_size < 1:
+        raise ValueError("tile_size must be at least 1, got %d" % tile_size)
+
+    dtype = precision_dtype(precision)
+    position = position.astype(dtype, copy=False)
+    mass = np.reshape(mass, (-1, 1)).astype(dtype, copy=False)
+    acceleration = np.zeros((N, 3))
+
+    for target_start in range(0, N, tile_size):
+        target_stop = min(target_start + tile_size, N)
+        target = position[target_start:target_stop]
+        target_mass = mass[target_start:target_stop]
+
+        for source_start in range(target_start, N, tile_size):
+            source_stop = min(source_start + tile_size, N)
+            source = position[source_start:source_stop]
+            source_mass = mass[source_start:source_stop]
+
+            dx = source[:, 0] - target[:, 0:1]
+            dy = source[:, 1] - target[:, 1:2]
+            dz = source[:, 2] - target[:, 2:3]
+
+            # Without softening the self-term divides by zero here,
+            # it is discarded just below
+            with np.errstate(divide="ignore"):
+                inverse = (dx**2 + dy**2 + dz**2 + softening**2) ** (-1.5)
+
+            # On a diagonal block keep only the pairs above the diagonal,
+            # which drops the self-term and the mirrored lower half
+            if source_start == target_start:
+                inverse = np.triu(inverse, 1)
+
+            target_block = acceleration[target_start:target_stop]
+            source_block = acceleration[source_start:source_stop]
+            for axis, d in enumerate((dx, dy, dz)):
+                weighted = G * (d * inverse)
+                # Pull of the sources on the targets...
+                target_block[:, axis:axis + 1] += weighted_sum(
+                    weighted, source_mass
+                    )
+                # ...and the equal and opposite pull on the sources
+                source_block[:, axis:axis + 1] -= weighted_sum(
+                    weighted.T, target_mass
+                    )
+
+    return acceleration
+
+
+# Kernels which can be selected by name
+KERNELS = {
+    "loop": get_acceleration_loop,
+    "vectorized": get_acceleration_vectorized,
+    "tiled": get_acceleration_tiled,
+    "mixed": get_acceleration_mixed,
+    "symmetric": get_acceleration_symmetric,
+}
+
+
+# Calculate accelerations with the kernel chosen by name
+def get_acceleration(position, mass, G, softening, kernel="vectorized"):
+    if kernel not in KERNELS:
+        raise ValueError(
+            "Unknown pairwise kernel '%s', choose from: %s"
+            % (kernel, ", ".join(KERNELS))
+            )
+    return KERNELS[kernel](position, mass, G, softening)
@@ -0,0 +1,147 @@
+from multiprocessing import shared_memory
+import multiprocessing
+import os
+import numpy as np
+import psutil
+
+from pairwise.pairwise_kernels import auto_tile_size, get_acceleration_on
+
+
+"""
+MULTI-CORE PAIRWISE FORCE ENGINE
+
+Threads cannot speed up the pairwise force calculation because the
+GIL only lets one of them run Python code at a time. This engine uses
+a persistent pool of worker processes instead.
+
+position, mass and acceleration live in shared memory blocks which
+every worker attaches to once when the pool starts. Each force
+calculation hands every worker a range of target rows; only the row
+bounds are sent to the workers, the arrays themselves are never copied.
+
+Every worker calculates the acceleration of its rows due to all bodies
+with the tiled kernel and writes them straight into the shared
+acceleration array.
+"""
+
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Shared arrays seen by a worker process, filled in by _attach_worker
+_worker = {}
+
+
+# Runs once in every worker process when the pool starts
+# Attaches to the shared memory blocks created by the engine
+def _attach_worker(names, N, tile_size):
+    blocks = [shared_memory.SharedMemory(name=name) for name in names]
+    _worker["blocks"] = blocks
+    _worker["position"] = np.ndarray((N, 3), buffer=blocks[0].buf)
+    _worker["mass"] = np.ndarray((N, 1), buffer=blocks[1].buf)
+    _worker["acceleration"] = np.ndarray((N, 3), buffer=blocks[2].buf)
+    _worker["tile_size"] = tile_size
+
+
+# Calculates the accelerations of one range of target rows
+def _calculate_rows(task):
+    start, stop, G, softening = task
+    position = _worker["position"]
+    _worker["acceleration"][start:stop] = get_acceleration_on(
+        position[start:stop], position, _worker["mass"],
+        G, softening, _worker["tile_size"]
+        )
+
+
+class SharedMemoryForceEngine:
+    def __init__(self, number_of_bodies, workers=None, tile_size=None):
+        """
+        number_of_bodies: number of bodies in the simulation
+        workers: number of worker processes (default: number of CPUs)
+        tile_size: block size of every worker's tiled kernel
+        (default: picked from the available memory, shared by all workers)
+        position: N x 3 array in shared memory
+        mass: N x 1 array in shared memory
+        acceleration: N x 3 array in shared memory, written by the workers
+        """
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers < 1:
+            raise ValueError("workers must be at least 1, got %d" % workers)
+
+        N = number_of_bodies
+        if tile_size is None:
+            tile_size = auto_tile_size(
+                N, psutil.virtual_memory().available / workers
+                )
+
+        self.number_of_bodies = N
+        self.workers = workers
+        self.tile_size = tile_size
+
+        # Shared memory blocks for position, mass and acceleration
+        self._blocks = [
+            shared_memory.SharedMemory(create=True, size=max(1, N * 3 * 8)),
+            shared_memory.SharedMemory(create=True, size=max(1, N * 8)),
+            shared_memory.SharedMemory(create=True, size=max(1, N * 3 * 8)),
+        ]
+        self.position = np.ndarray((N, 3), buffer=self._blocks[0].buf)
+        self.mass = np.ndarray((N, 1), buffer=self._blocks[1].buf)
+        self.acceleration = np.ndarray((N, 3), buffer=self._blocks[2].buf)
+        self.position[:] = 0.0
+        self.mass[:] = 0.0
+        self.acceleration[:] = 0.0
+
+        # One contiguous range of rows per worker
+        # Every row costs the same, so equal ranges balance the work
+        bounds = np.linspace(0, N, min(workers, max(N, 1)) + 1).astype(int)
+        self._rows = [
+            (start, stop) for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+
+        self._pool = multiprocessing.Pool(
+            workers,
+            initializer=_attach_worker,
+            initargs=([block.name for block in self._blocks], N, tile_size)
+            )
+
+    # Calculate the accelerations of every body
+    # Takes the same arguments as the kernels in pairwise_kernels, so the
+    # engine can be used anywhere get_acceleration is.
+    # position and mass are copied into shared memory unless they
+    # already are the engine's own shared arrays
+    def get_acceleration(self, position, mass, G, softening):
+        if position is not self.position:
+            self.position[:] = position
+        if mass is not self.mass:
+            self.mass[:] = np.reshape(mass, (-1, 1))
+
+        self._pool.map(
+            _calculate_rows,
+            [(start, stop, G, softening) for start, stop in self._rows]
+            )
+        return self.acceleration.copy()
+
+    __call__ = get_acceleration
+
+    # Stop the workers and release the shared memory
+    def close(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+
+        # Drop the array views before the blocks they point into
+        del self.position, self.mass, self.acceleration
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
@@ -1,11 +1,7 @@
-from subprocess import Popen
 import numpy as np
 import timeit
-import math
-import psutil
-import cProfile
-import threading
-import time
+import os
+import sys
 
 
 """
@@ -42,6 +38,18 @@ Newton's Law of Universal Gravitation
 - every object feels an acceleration
 """
 
+# Allow the shared force kernels to be imported when this script
+# is launched directly from its .bat file
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+from pairwise.pairwise_multiprocess import (  # noqa: E402
+    SharedMemoryForceEngine
+    )
+from simulation.integrator import LeapfrogIntegrator  # noqa: E402
+from simulation import instrumentation  # noqa: E402
+
 
 # THE PAIRWISE ALGORITHM USED HERE IS INSPIRED BY THE WORK OF PHILIP MOCZ
 # https://github.com/pmocz/nbody-python
@@ -50,161 +58,152 @@ Newton's Law of Universal Gravitation
 # https://peps.python.org/pep-0008/
 
 
-def get_acceleration(position, mass, G, softening):
-    # Give dimensions of the array
-    # The array will represent the matrix
-    N = position.shape[0]
-
-    # Return an array of the given size, filled with zeroes
-    # Filled with zeroes for now
-    # The accelerations for each body will be inserted into this array
-    # and it will be updated
-    acceleration = np.zeros((N, 3))
-
-    # Loop through 2D Array for every body
-    for i in range(N):
-        for j in range(N):
-
-            # Particle in question's x,y and z axis
-            x = position[j, 0] - position[i, 0]
-            y = position[j, 1] - position[i, 1]
-            z = position[j, 2] - position[i, 2]
-
-            # Inverse square law
-            # Softening is the number added to avoid issues when two bodies
-            # are close to one another
-            # If not added, the acceleration can go to infinity
-            inverse = math.pow(
-                math.pow(x, 2) +
-                math.pow(y, 2) +
-                math.pow(z, 2) +
-                math.pow(softening, 2), -1.5
-                )
-
-            acceleration[i, 0] += G * (x * inverse) * mass[j]
-            acceleration[i, 1] += G * (y * inverse) * mass[j]
-            acceleration[i, 2] += G * (z * inverse) * mass[j]
-
-    return acceleration
-
 # ********************************************************************************************
 # MAIN CODE
 
-# SIMULATION PARAMETERS
-
-print("********************************************************")
-print(" ____  _                        ____            _       ")
-print("|  _ \(_)                      |  _ \          | |      ")
-print("| |_) |_ _ __   __ _ _ __ _   _| |_) | ___   __| |_   _ ")
-print("|  _ <| | '_ \ / _` | '__| | | |  _ < / _ \ / _` | | | |")
-print("| |_) | | | | | (_| | |  | |_| | |_) | (_) | (_| | |_| |")
-print("|____/|_|_| |_|\__,_|_|   \__, |____/ \___/ \__,_|\__, |")
-print("                           __/ |                   __/ |")
-print("                          |___/                   |___/ ")
-print("********************************************************\n")
-
-print("********************************************************")
-print("THREADED Pairwise Interaction")
-print("********************************************************\n")
-
-# Number of bodies
-print("*****************")
-print("Simulation bodies")
-print("*****************")
-print("Choose the number of bodies to populate the simulation with.")
-number_of_bodies = int(input("\nEnter the number of bodies: "))
-
-# Number of timesteps
-# Fixed amount of time by which the simulation advances/progresses.
-print("\n*******************")
-print("Timestep definition")
-print("*******************")
-print("This is the fixed amount of time by which the simulation advances")
-number_of_timesteps = int(input("\nEnter the number of timesteps: "))
-
-print("\nSimulating body movements...")
-print("Please wait...")
-
-# Timestep
-timestep = 0.01
-
-# Softening length
-softening = 0.1
-
-# Newton's Gravitational Constant
-G = 6.67 / 1e11
-
-# Generate Initial Conditions; set the random number generator seed
-np.random.seed(50)
-
-# Each body has a mass of 10
-# This can be changed for different gravitational effects
-mass = 100 * np.ones((number_of_bodies, 1)) / number_of_bodies
-
-# Determine positions and velocities at random
-position = np.random.randn(number_of_bodies, 3)
-velocity = np.random.randn(number_of_bodies, 3)
-
-# Convert to Center-of-Mass frame
-velocity = velocity - np.mean(mass * velocity, 0) / np.mean(mass)
-
-# Calculate initial gravitational accelerations
-acceleration = get_acceleration(position, mass, G, softening)
-
-# Create a number of threads equal to the number of timesteps.
-# Threads will be stored in this list to avoid starting and joining
-# every thread manually.
-# If threads were not stored in this way, problems could occur
-# with larger simulations that contain more bodies.
-threads = []
-
-# MAIN SIMULATION LOOP
-# Loop the function for one simulation cycle, multiplied number of timesteps
-for i in range(number_of_timesteps):
-    # Create and Start Thread
-    t1 = threading.Thread(
-        target=get_acceleration,
-        args=(position, mass, G, softening)
+# Worker processes import this script again when they start on Windows,
+# so the simulation only runs when the script is executed directly
+if __name__ == "__main__":
+    # SIMULATION PARAMETERS
+
+    print("********************************************************")
+    print(" ____  _                        ____            _       ")
+    print("|  _ \(_)                      |  _ \          | |      ")
+    print("| |_) |_ _ __   __ _ _ __ _   _| |_) | ___   __| |_   _ ")
+    print("|  _ <| | '_ \ / _` | '__| | | |  _ < / _ \ / _` | | | |")
+    print("| |_) | | | | | (_| | |  | |_| | |_) | (_) | (_| | |_| |")
+    print("|____/|_|_| |_|\__,_|_|   \__, |____/ \___/ \__,_|\__, |")
+    print("                           __/ |                   __/ |")
+    print("                          |___/                   |___/ ")
+    print("********************************************************\n")
+
+    print("********************************************************")
+    print("THREADED Pairwise Interaction")
+    print("********************************************************\n")
+
+    # Number of bodies
+    print("*****************")
+    print("Simulation bodies")
+    print("*****************")
+    print("Choose the number of bodies to populate the simulation with.")
+    number_of_bodies = int(input("\nEnter the number of bodies: "))
+
+    # Number of timesteps
+    # Fixed amount of time by which the simulation advances/progresses.
+    print("\n*******************")
+    print("Timestep definition")
+    print("*******************")
+    print("This is the fixed amount of time by which the simulation advances")
+    number_of_timesteps = int(input("\nEnter the number of timesteps: "))
+
+    # Number of worker processes
+    # The force calculation is split across a pool of worker processes,
+    # each one calculating the accelerations of its own share of the bodies
+    print("\n*****************")
+    print("Worker processes")
+    print("*****************")
+    print("Choose the number of processes to calculate the forces with.")
+    number_of_workers = input(
+        "\nEnter the number of workers (default: %d): " % os.cpu_count()
+        ).strip()
+    number_of_workers = int(number_of_workers) if number_of_workers else None
+
+    print("\nSimulating body movements...")
+    print("Please wait...")
+
+    # Timestep
+    timestep = 0.01
+
+    # Softening length
+    softening = 0.1
+
+    # Newton's Gravitational Constant
+    G = 6.67 / 1e11
+
+    # Generate Initial Conditions; set the random number generator seed
+    np.random.seed(50)
+
+    # Each body has a mass of 10
+    # This can be changed for different gravitational effects
+    mass = 100 * np.ones((number_of_bodies, 1)) / number_of_bodies
+
+    # Determine positions and velocities at random
+    position = np.random.randn(number_of_bodies, 3)
+    velocity = np.random.randn(number_of_bodies, 3)
+
+    # Convert to Center-of-Mass frame
+    velocity = velocity - np.mean(mass * velocity, 0) / np.mean(mass)
+
+    # Start the worker pool and move the bodies into its shared memory
+    # From here on position and mass are the engine's shared arrays,
+    # so the workers read them directly without any copying
+    engine = SharedMemoryForceEngine(
+        number_of_bodies, workers=number_of_workers
+        )
+    engine.position[:] = position
+    engine.mass[:] = mass
+    position = engine.position
+    mass = engine.mass
+    get_acceleration = engine.get_acceleration
+
+    # Kick-drift-kick leapfrog integrator
+    # The initial gravitational accelerations are calculated here,
+    # after that every timestep calculates the forces exactly once
+    integrator = LeapfrogIntegrator(
+        get_acceleration, position, velocity, timestep,
+        args=(mass, G, softening)
         )
 
-    threads.append(t1)
-    t1.start()
-
-    # Half timestep kick
-    velocity += (acceleration * timestep) / 2
-
-    # Full timestep drift
-    position += velocity * timestep
-
-    # Half timestep kick
-    velocity += (acceleration * timestep) / 2
-
-# Active threads
-print(f'Active Threads: {threading.active_count()}')
-print("Please wait...")
-
-# Join all threads with main thread
-for t in threads:
-    t1.join()
-
-print("\nCalculations complete...")
-print("\nPlease wait...")
-print("\n")
-
-# Time the get_acceleration() function's execution time
-result = timeit.timeit(
-    lambda: get_acceleration(position, mass, G, softening),
-    number=1)
+    # Record the timers and counters of every phase while the
+    # simulation runs
+    probe = instrumentation.enable()
+    cpu_start = instrumentation.cpu_time()
+
+    # MAIN SIMULATION LOOP
+    # Loop the function for one simulation cycle,
+    # multiplied number of timesteps
+    # The whole loop is timed so the result reflects
+    # the real cost of every step
+    result = timeit.timeit(
+        lambda: integrator.run(number_of_timesteps),
+        number=1)
+    cpu_used = instrumentation.cpu_time() - cpu_start
+    instrumentation.disable()
+
+    # Active worker processes
+    print(f'Active worker processes: {engine.workers}')
+    print("Please wait...")
+
+    print("\nCalculations complete...")
+    print("\nPlease wait...")
+    print("\n")
+
+    print(
+        "The execution time of the THREADED Pairwise simulation with",
+        number_of_bodies, "bodies is: ", result, "s"
+        )
+    print(
+        "Average time per timestep:",
+        result / max(number_of_timesteps, 1), "s",
+        "(" + str(integrator.force_evaluations), "force calculations)"
+        )
 
-print(
-    "The execution time of the THREADED Pairwise simulation with",
-    number_of_bodies, "bodies is: ", result, "s"
-    )
+    # Time spent in every phase of the timesteps
+    print("\n")
+    probe.print_summary()
+    profile_file = "pairwise_threaded_profile.prof"
+    probe.write_pstats(profile_file)
+    print(
+        "\nPhase timings written to", profile_file,
+        "- open them with: snakeviz", profile_file
+        )
 
-# Record function calls
-print("\n")
-cProfile.run("get_acceleration(position, mass, G, softening)")
+    # Stop the worker pool and release the shared memory
+    engine.close()
 
-# System CPU usage
-print("The overall system CPU usage is : ", psutil.cpu_percent())
-input("Press ENTER to exit")
+    # CPU usage of the simulation and its worker processes
+    print(
+        "CPU usage during the simulation:",
+        100 * cpu_used / max(result, 1e-9), "% of one CPU"
+        )
+    input("Press ENTER to exit")
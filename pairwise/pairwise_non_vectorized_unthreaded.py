@@ -1,10 +1,7 @@
-from subprocess import Popen
 import numpy as np
 import timeit
-import math
-import psutil
-import cProfile
-import time
+import os
+import sys
 
 """
 PAIRWISE N-BODY SIMULATION
@@ -40,6 +37,19 @@ Newton's Law of Universal Gravitation
 - every object feels an acceleration
 """
 
+# Allow the shared force kernels to be imported when this script
+# is launched directly from its .bat file
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+from pairwise.pairwise_kernels import KERNELS  # noqa: E402
+from barnes_hut.barnes_hut_octree import (  # noqa: E402
+    get_acceleration as get_acceleration_octree
+    )
+from simulation.integrator import LeapfrogIntegrator  # noqa: E402
+from simulation import instrumentation  # noqa: E402
+
 
 # THE PAIRWISE ALGORITHM USED HERE IS INSPIRED BY THE WORK OF PHILIP MOCZ
 # https://github.com/pmocz/nbody-python
@@ -48,43 +58,6 @@ Newton's Law of Universal Gravitation
 # https://peps.python.org/pep-0008/
 
 
-def get_acceleration(position, mass, G, softening):
-    # Give dimensions of the array
-    # The array will represent the matrix
-    N = position.shape[0]
-
-    # Return an array of the given size, filled with zeroes
-    # Filled with zeroes for now
-    # The accelerations for each body will be inserted into this array
-    # and it will be updated
-    acceleration = np.zeros((N, 3))
-
-    # Loop through 2D Array for every body
-    for i in range(N):
-        for j in range(N):
-
-            # Particle in question's x,y and z axis
-            x = position[j, 0] - position[i, 0]
-            y = position[j, 1] - position[i, 1]
-            z = position[j, 2] - position[i, 2]
-
-            # Inverse square law
-            # Softening is the number added to avoid issues when two bodies
-            # are close to one another
-            # If not added, the acceleration can go to infinity
-            inverse = math.pow(
-                math.pow(x, 2) +
-                math.pow(y, 2) +
-                math.pow(z, 2) +
-                math.pow(softening, 2), -1.5
-                )
-
-            acceleration[i, 0] += G * (x * inverse) * mass[j]
-            acceleration[i, 1] += G * (y * inverse) * mass[j]
-            acceleration[i, 2] += G * (z * inverse) * mass[j]
-
-    return acceleration
-
 # ********************************************************************************************
 # MAIN CODE
 
@@ -120,6 +93,24 @@ print("*******************")
 print("This is the fixed amount of time by which the simulation advances")
 number_of_timesteps = int(input("\nEnter the number of timesteps: "))
 
+# Force kernel
+# The loop kernel is the original reference implementation,
+# the vectorized kernel evaluates every pair at once with NumPy
+# The octree is the 3D Barnes-Hut engine, run on the same bodies so
+# its timings compare directly with the pairwise kernels
+kernels = dict(KERNELS, octree=get_acceleration_octree)
+print("\n************")
+print("Force kernel")
+print("************")
+print("Choose the kernel used to calculate the accelerations.")
+print("Available kernels:", ", ".join(kernels))
+kernel_name = input("\nEnter the kernel name (default: loop): ").strip()
+if kernel_name == "":
+    kernel_name = "loop"
+while kernel_name not in kernels:
+    kernel_name = input("Please enter a valid kernel name: ").strip()
+get_acceleration = kernels[kernel_name]
+
 print("\nSimulating body movements...")
 print("Please wait...")
 
@@ -148,39 +139,55 @@ velocity = np.random.randn(number_of_bodies, 3)
 # Convert to Center-of-Mass frame
 velocity -= np.mean(mass * velocity, 0) / np.mean(mass)
 
-# Calculate initial gravitational accelerations
-acceleration = get_acceleration(position, mass, G, softening)
+# Kick-drift-kick leapfrog integrator
+# The initial gravitational accelerations are calculated here,
+# after that every timestep calculates the forces exactly once
+integrator = LeapfrogIntegrator(
+    get_acceleration, position, velocity, timestep,
+    args=(mass, G, softening)
+    )
+
+# Record the timers and counters of every phase while the
+# simulation runs
+probe = instrumentation.enable()
+cpu_start = instrumentation.cpu_time()
 
 # MAIN SIMULATION LOOP
 # Loop the function for one simulation cycle, multiplied number of timesteps
-for i in range(number_of_timesteps):
-    # Half timestep kick
-    velocity += (acceleration * timestep) / 2
-
-    # Full timestep drift
-    position += velocity * timestep
-
-    # Half timestep kick
-    velocity += (acceleration * timestep) / 2
+# The whole loop is timed so the result reflects the real cost of every step
+result = timeit.timeit(
+    lambda: integrator.run(number_of_timesteps),
+    number=1)
+cpu_used = instrumentation.cpu_time() - cpu_start
+instrumentation.disable()
 
 print("\nCalculations complete...")
 print("\nPlease wait...")
 print("\n")
 
-# Time the get_acceleration() function's execution time
-result = timeit.timeit(
-    lambda: get_acceleration(position, mass, G, softening),
-    number=1)
-
 print(
     "The execution time of the UNTHREADED Pairwise simulation with",
     number_of_bodies, "bodies is: ", result, "s"
     )
+print(
+    "Average time per timestep:",
+    result / max(number_of_timesteps, 1), "s",
+    "(" + str(integrator.force_evaluations), "force calculations)"
+    )
 
-# Record function calls
+# Time spent in every phase of the timesteps
 print("\n")
-cProfile.run("get_acceleration(position, mass, G, softening)")
+probe.print_summary()
+profile_file = "pairwise_profile.prof"
+probe.write_pstats(profile_file)
+print(
+    "\nPhase timings written to", profile_file,
+    "- open them with: snakeviz", profile_file
+    )
 
-# System CPU usage
-print("The overall system CPU usage is : ", psutil.cpu_percent())
+# CPU usage of the simulation and its worker processes
+print(
+    "CPU usage during the simulation:",
+    100 * cpu_used / max(result, 1e-9), "% of one CPU"
+    )
 input("Press ENTER to exit")
@@ -0,0 +1,249 @@
+import functools
+import itertools
+import numpy as np
+
+from simulation import instrumentation
+
+
+"""
+Particle-Mesh
+
+Gravity from a grid instead of from pairs of bodies or a tree, for
+large, smooth distributions where per-pair accuracy is not needed.
+It works on the same N x 3 position and mass arrays as the pairwise
+kernels and the octree:
+
+    get_acceleration(position, mass, G, softening, grid_size=64)
+
+Every step:
+
+1. A cube of grid_size³ points is laid over the bodies, the smallest
+   one containing all of them with two grid points to spare on every
+   side
+2. Cloud-in-cell mass assignment: the mass of every body is shared
+   between the 8 grid points around it, in proportion to how close it
+   is to each of them
+3. The potential of the grid's mass is found by convolving it with the
+   softened potential of a unit mass, -1 / sqrt(r² + softening²), with
+   numpy.fft. The grid is padded with zeros to twice its size first,
+   so the convolution does not wrap around: the bodies are isolated,
+   as in every other engine, not in a periodic box. The smoothing of
+   the cloud-in-cell assignment and interpolation is divided out of
+   the transform at the same time
+4. The field is the gradient of the potential, by 4 point central
+   differences
+5. The field is interpolated back to every body from the same 8 grid
+   points its mass was shared between, so a body exerts no force on
+   itself and the forces on all the bodies add up to zero
+
+Steps 2 and 5 cost O(N) and steps 3 and 4 O(M log M) for M grid
+points, whatever the number of bodies.
+
+Forces between bodies closer than a couple of grid cells are smoothed
+out by the grid, so the grid_size is the resolution: doubling it
+halves the smallest separation resolved and costs 8 times the memory.
+The padded grid holds (2 * grid_size)³ values.
+
+The transform of the potential of a unit mass only depends on the grid
+spacing, so the spacing is rounded up to a power of 2^(1/8) and the
+last transform is kept: it is only worked out again when the bodies
+spread out (or draw in) past the next of these steps, rather than on
+every force calculation.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Default number of grid points along every side of the mesh
+mesh_grid_size = 64
+
+
+# Grid points left around the bodies on every side, as many as the
+# differences of mesh_field reach
+mesh_margin = 2
+
+# Grid spacings are rounded up to a power of 2^(1 / mesh_cell_steps),
+# so the grid is at most 9% coarser than the bodies need
+mesh_cell_steps = 8
+
+
+# Lowest corner and grid spacing of a grid_size³ grid holding the
+# smallest cube containing every body, with mesh_margin grid points to
+# spare on every side
+# Every grid point a body is shared between is then inside the grid's
+# edge points, where the gradient is a central difference as well
+def mesh_cube(position, grid_size):
+    intervals = grid_size - 2 * mesh_margin - 2
+    if position.shape[0] == 0:
+        low, size = np.zeros(3), 1.0
+    else:
+        low = position.min(axis=0)
+        size = (position.max(axis=0) - low).max()
+        # Grow the cube slightly so the furthest bodies fall inside it
+        size = size * (1.0 + 1.e-9) if size > 0 else 1.0
+    # Rounded up to one of a fixed set of spacings, see green_function
+    step = np.ceil(np.log2(size / intervals) * mesh_cell_steps)
+    cell = float(2.0 ** (step / mesh_cell_steps))
+    return low - mesh_margin * cell, cell
+
+
+# The 8 grid points around every body, as flat grid indices, and the
+# cloud-in-cell weight of every body at each of them
+# Worked out once and used both to assign the mass and to interpolate
+# the field
+def cloud_in_cell(position, origin, cell, grid_size):
+    scaled = (position - origin) / cell
+    index = np.clip(np.floor(scaled).astype(np.int64), 0, grid_size - 2)
+    fraction = scaled - index
+    base = (index[:, 0] * grid_size + index[:, 1]) * grid_size + index[:, 2]
+    # Weights of the lower and upper grid point along every axis
+    weights = (1.0 - fraction, fraction)
+    corners = []
+    for x, y, z in itertools.product((0, 1), repeat=3):
+        flat = base + (x * grid_size + y) * grid_size + z
+        weight = weights[x][:, 0] * weights[y][:, 1] * weights[z][:, 2]
+        corners.append((flat, weight))
+    return corners
+
+
+# Mass at every grid point
+def assign_mass(corners, mass, grid_size):
+    grid_mass = np.zeros(grid_size**3)
+    for flat, weight in corners:
+        grid_mass += np.bincount(
+            flat, weight * mass, minlength=grid_size**3
+            )
+    return grid_mass.reshape((grid_size, grid_size, grid_size))
+
+
+# Complementary error function, by the Chebyshev fit of Numerical
+# Recipes (relative error below 1.2e-7 everywhere)
+def erfc(x):
+    z = np.abs(x)
+    t = 1.0 / (1.0 + 0.5 * z)
+    polynomial = 0.17087277
+    for coefficient in (
+            -0.82215223, 1.48851587, -1.13520398, 0.27886807,
+            -0.18628806, 0.09678418, 0.37409196, 1.00002368,
+            -1.26551223):
+        polynomial = coefficient + t * polynomial
+    result = t * np.exp(-z * z + polynomial)
+    return np.where(x >= 0, result, 2.0 - result)
+
+
+# Potential of a unit mass at every point of the padded grid, as the
+# real FFT the mass is multiplied by
+# The distances wrap around the padded grid, so the grid point at
+# index i stands for both i and i - 2 * grid_size cells away
+# The transform is divided by the transform of the cloud-in-cell
+# window, sinc² along every axis, once for the assignment and once for
+# the interpolation
+# split: keep only the long range part of the potential,
+# -erf(r / (2 * split)) / r, which is smooth below split
+# The last transform is kept, as mesh_cube only hands out a few grid
+# spacings
+@functools.lru_cache(maxsize=1)
+def green_function(grid_size, cell, softening, split=None):
+    padded = 2 * grid_size
+    n = np.arange(padded)
+    d = np.minimum(n, padded - n) * cell
+    r2 = (
+        d[:, np.newaxis, np.newaxis]**2
+        + d[np.newaxis, :, np.newaxis]**2
+        + d[np.newaxis, np.newaxis, :]**2
+        + softening * softening
+        )
+    if split is None:
+        # Drops the grid point itself when there is no softening
+        with np.errstate(divide="ignore"):
+            potential = np.where(r2 > 0, -r2 ** -0.5, 0.0)
+    else:
+        r = np.sqrt(r2)
+        # erf(r / (2 * split)) / r tends to 1 / (sqrt(pi) * split) at 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            potential = np.where(
+                r > 0, (erfc(r / (2.0 * split)) - 1.0) / r,
+                -1.0 / (np.sqrt(np.pi) * split)
+                )
+
+    # Frequencies of the padded grid in cycles per grid cell
+    window = 1.0
+    for axis, frequency in enumerate((
+            np.fft.fftfreq(padded), np.fft.fftfreq(padded),
+            np.fft.rfftfreq(padded))):
+        shape = [1, 1, 1]
+        shape[axis] = -1
+        window = window * np.reshape(np.sinc(frequency)**2, shape)
+    return np.fft.rfftn(potential) / (window * window)
+
+
+# Potential at every grid point due to the grid's mass, per unit G
+def solve_potential(grid_mass, cell, softening, split=None):
+    grid_size = grid_mass.shape[0]
+    shape = (2 * grid_size,) * 3
+    potential = np.fft.irfftn(
+        np.fft.rfftn(grid_mass, shape)
+        * green_function(grid_size, cell, softening, split),
+        shape
+        )
+    return potential[:grid_size, :grid_size, :grid_size]
+
+
+# Acceleration at every grid point, one row of 3 per flat grid index
+# The differences wrap around at the 2 grid points along every edge,
+# which no body is shared between (see mesh_cube)
+def mesh_field(potential, cell):
+    gradient = [
+        (8.0 * (np.roll(potential, -1, axis) - np.roll(potential, 1, axis))
+         - (np.roll(potential, -2, axis) - np.roll(potential, 2, axis)))
+        / (12.0 * cell)
+        for axis in range(3)
+    ]
+    return -np.stack(gradient, axis=-1).reshape(-1, 3)
+
+
+# Accelerations of the bodies, interpolated from the grid points
+def interpolate(field, corners, number_of_bodies):
+    acceleration = np.zeros((number_of_bodies, 3))
+    for flat, weight in corners:
+        acceleration += weight[:, np.newaxis] * np.take(field, flat, axis=0)
+    return acceleration
+
+
+# Accelerations of every body on the mesh, per unit G, and the grid
+# spacing they were found with
+# split: only the long range part, with the split length given in grid
+# cells (see green_function)
+def mesh_accelerations(position, mass, softening, grid_size, split=None):
+    if grid_size < 2 * mesh_margin + 4:
+        raise ValueError(
+            "grid_size must be at least %d, got %d"
+            % (2 * mesh_margin + 4, grid_size)
+            )
+    mass = np.reshape(mass, -1)
+    origin, cell = mesh_cube(position, grid_size)
+    instrumentation.gauge("mesh cells", grid_size**3)
+
+    with instrumentation.timer("mass assignment"):
+        corners = cloud_in_cell(position, origin, cell, grid_size)
+        grid_mass = assign_mass(corners, mass, grid_size)
+    with instrumentation.timer("poisson solve"):
+        potential = solve_potential(
+            grid_mass, cell, softening, None if split is None
+            else split * cell
+            )
+        field = mesh_field(potential, cell)
+    with instrumentation.timer("interpolation"):
+        acceleration = interpolate(field, corners, position.shape[0])
+    return acceleration, cell
+
+
+# Calculate the acceleration of every body on the mesh
+# Same call as the pairwise kernels, so the mesh can stand in for them
+def get_acceleration(
+        position, mass, G, softening, grid_size=mesh_grid_size):
+    acceleration, _ = mesh_accelerations(
+        position, mass, softening, grid_size
+        )
+    return G * acceleration
@@ -0,0 +1,101 @@
+import numpy as np
+
+from barnes_hut.barnes_hut_octree import (
+    build_octree, octree_leaf_capacity, walk_accelerations_grouped
+    )
+from particle_mesh.particle_mesh import (
+    erfc, mesh_accelerations, mesh_grid_size
+    )
+from simulation import instrumentation
+
+
+"""
+TreePM
+
+The force split in two at a split length r_s, each part found by the
+method suited to it:
+
+long range, from the particle-mesh
+    - The mesh is solved with the potential -erf(r / (2 r_s)) / r, which
+      is smooth below r_s, so the grid resolves it as long as r_s is a
+      grid cell or more
+short range, from the Barnes-Hut octree
+    - The rest of the force, whose potential is -erfc(r / (2 r_s)) / r:
+      the 1 / r² force of every interaction scaled by
+      erfc(u) + 2u / sqrt(pi) exp(-u²), u = r / (2 r_s)
+    - The walk is the octree's group walk with its usual theta opening
+      criterion, but leaves out every node further than the cutoff
+      from the group, where the factor above has fallen below a
+      percent; the walk ends a few cells out instead of taking in the
+      whole tree
+    - The factor is only worked out for the pairs inside the cutoff,
+      and the groups sharing an interaction list are twice the size
+      of the octree's, as the cutoff keeps their lists short
+
+The two potentials add up to -1 / r (softened as in the pairwise
+kernels), so close bodies get the accuracy of the tree and the mesh
+only has to carry the smooth large scale field.
+
+The split length is given in grid cells and the cutoff in split
+lengths, so both follow the grid as the bodies spread out:
+
+    get_acceleration(position, mass, G, softening, theta=0.5,
+                     grid_size=64, split=1.0, cutoff=4.5)
+
+Larger split lengths move more of the force onto the tree, which is
+more accurate and slower; larger cutoffs shrink the error left by
+cutting the short range force off.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Default split length, in grid cells
+treepm_split = 1.0
+
+# Default cutoff of the short range walk, in split lengths
+treepm_cutoff = 4.5
+
+# Most bodies sharing one interaction list in the short range walk
+treepm_group_size = 64
+
+
+# Factor the 1 / r² force of an interaction is scaled by to leave the
+# short range part, given the squared softened distances
+def short_range_factor(s2, split):
+    u = np.sqrt(s2) / (2.0 * split)
+    return erfc(u) + 2.0 / np.sqrt(np.pi) * u * np.exp(-u * u)
+
+
+# Short range accelerations of every body, per unit G, from the octree
+# walk cut off at cutoff
+def short_range_accelerations(
+        position, mass, theta, softening, split, cutoff,
+        leaf_capacity=octree_leaf_capacity):
+    with instrumentation.timer("tree build"):
+        tree = build_octree(position, mass, leaf_capacity=leaf_capacity)
+    with instrumentation.timer("force walk"):
+        return walk_accelerations_grouped(
+            tree, position, mass, theta, softening, treepm_group_size,
+            cutoff=cutoff,
+            force_factor=lambda s2: short_range_factor(s2, split)
+            )
+
+
+# Calculate the acceleration of every body with the mesh and the tree
+# Same call as the octree's get_acceleration, so TreePM can stand in
+# for the pairwise kernels
+def get_acceleration(
+        position, mass, G, softening, theta=0.5, grid_size=mesh_grid_size,
+        split=treepm_split, cutoff=treepm_cutoff,
+        leaf_capacity=octree_leaf_capacity):
+    long_range, cell = mesh_accelerations(
+        position, mass, softening, grid_size, split
+        )
+    split_length = split * cell
+    short_range = short_range_accelerations(
+        position, mass, theta, softening, split_length,
+        cutoff * split_length, leaf_capacity
+        )
+    return G * (long_range + short_range)
@@ -0,0 +1,15 @@
+import sys
+
+from simulation.runner import main
+
+
+"""
+Command line entry point of the simulation runner
+
+    python -m simulation --engine octree --bodies 10000 --steps 20
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+sys.exit(main())
@@ -0,0 +1,322 @@
+import argparse
+import csv
+import datetime
+import json
+import platform
+import time
+import os
+import sys
+import numpy as np
+import psutil
+
+
+"""
+BENCHMARK SUITE
+
+Runs every engine chosen over a grid of body counts, timed step counts
+and worker counts, all through SimulationRun, so every number is
+measured the same way for every engine:
+
+1. The engine is set up on the runner's seeded initial conditions
+2. Its accelerations at the starting positions are compared against
+   direct summation (3D engines: the symmetric pairwise kernel with the
+   same softening, 2D engines: the direct sum with no softening)
+3. warmup timesteps are run untimed, so caches, tuned leaf capacities
+   and worker processes are warm
+4. Every one of the timed steps is timed on its own
+5. The high-water mark of the resident memory of the process and its
+   worker processes is read at the end of the trial, so the temporaries
+   allocated inside a step are counted:
+   - Linux: VmHWM of /proc/<pid>/status, reset at the start of every
+     trial through /proc/<pid>/clear_refs
+   - Windows: psutil's peak_wset
+   - Elsewhere: ru_maxrss of getrusage for the process itself
+   The last two cannot be reset, so there the peak also covers
+   everything run earlier in the same process
+
+Steps 1 - 5 are repeated for every trial, and the step times of every
+trial are pooled into one median and 95th percentile. The worker count
+only applies to the multiprocess engines, the others are run once for
+every body and step count.
+
+Every result row also records the date, the NumPy and Python versions
+and the machine's CPU count, so a results file can be appended to on
+every run and used to track regressions over time.
+
+Usage:
+    python benchmark.py --engines vectorized octree quadtree
+                        --bodies 1000 4000 --steps 5 --workers 1 2 4
+                        --trials 3 --output results.csv
+
+The output is written as CSV or JSON depending on the file extension,
+appending to an existing CSV file.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+# Allow the shared modules to be imported when this script is
+# launched directly
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+
+from barnes_hut.barnes_hut_flat_tree import (  # noqa: E402
+    direct_acceleration
+    )
+from pairwise.pairwise_kernels import (  # noqa: E402
+    get_acceleration_symmetric
+    )
+from simulation.runner import ENGINES, SimulationRun  # noqa: E402
+from simulation import runner  # noqa: E402
+
+
+# Engines whose work is split across worker processes
+MULTIPROCESS_ENGINES = ("pairwise-multiprocess", "quadtree-multiprocess")
+
+# Largest number of bodies the accuracy is measured for, as the direct
+# sum costs O(N²)
+max_accuracy_bodies = 20000
+
+# Columns of every result row, in order
+FIELDS = (
+    "date", "engine", "bodies", "steps", "workers", "trials", "warmup",
+    "theta", "timestep", "median_step_time", "p95_step_time",
+    "mean_step_time", "median_setup_time", "peak_rss_mb",
+    "median_error", "max_error", "numpy", "python", "cpus"
+)
+
+
+# High-water mark of the resident memory of one process in bytes
+def peak_memory(process):
+    if sys.platform.startswith("linux"):
+        with open("/proc/%d/status" % process.pid) as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    info = process.memory_info()
+    if hasattr(info, "peak_wset"):
+        return info.peak_wset
+    if process.pid == os.getpid():
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes everywhere but macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+    return info.rss
+
+
+# High-water mark of this process and its worker processes in bytes
+def peak_resident_memory(process):
+    total = peak_memory(process)
+    for child in process.children(recursive=True):
+        try:
+            total += peak_memory(child)
+        except (psutil.NoSuchProcess, OSError):
+            pass
+    return total
+
+
+# Start the high-water marks of this process and its worker processes
+# again from their current resident memory, where the platform allows
+# it (Linux)
+def reset_peak_memory(process):
+    if not sys.platform.startswith("linux"):
+        return
+    for pid in [process.pid] + [
+            child.pid for child in process.children(recursive=True)]:
+        try:
+            with open("/proc/%d/clear_refs" % pid, "w") as file:
+                file.write("5")
+        except OSError:
+            pass
+
+
+# Accelerations by direct summation for the bodies of a run
+def reference_acceleration(run):
+    if run.position.shape[1] == 3:
+        return get_acceleration_symmetric(
+            run.position, run.mass, runner.G, runner.softening
+            )
+    return direct_acceleration(run.position, run.mass, runner.G)
+
+
+# Relative acceleration error of every body of a freshly set up run
+def acceleration_error(run):
+    reference = reference_acceleration(run)
+    acceleration = run.acceleration()
+    return (
+        np.linalg.norm(acceleration - reference, axis=1)
+        / np.linalg.norm(reference, axis=1)
+        )
+
+
+# Benchmark one engine for one point of the grid
+def benchmark(
+        engine, number_of_bodies, number_of_timesteps, workers=None,
+        trials=3, warmup=1, theta=0.5, timestep=0.01, seed=50,
+        accuracy=True):
+    process = psutil.Process()
+    step_times = []
+    setup_times = []
+    peak = 0
+    error = None
+
+    for trial in range(trials):
+        reset_peak_memory(process)
+        with SimulationRun(
+                engine, number_of_bodies, timestep, theta, seed,
+                workers) as run:
+            setup_times.append(run.setup_time)
+            peak = max(peak, peak_resident_memory(process))
+
+            # The starting bodies are the same for every trial
+            # The direct sum is left out of the peak memory
+            if (accuracy and trial == 0
+                    and number_of_bodies <= max_accuracy_bodies):
+                error = acceleration_error(run)
+                reset_peak_memory(process)
+
+            run.run(warmup)
+            for _ in range(number_of_timesteps):
+                start = time.perf_counter()
+                run.run(1)
+                step_times.append(time.perf_counter() - start)
+            peak = max(peak, peak_resident_memory(process))
+
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "engine": engine,
+        "bodies": number_of_bodies,
+        "steps": number_of_timesteps,
+        "workers": workers if engine in MULTIPROCESS_ENGINES else None,
+        "trials": trials,
+        "warmup": warmup,
+        "theta": theta,
+        "timestep": timestep,
+        "median_step_time": float(np.median(step_times)),
+        "p95_step_time": float(np.percentile(step_times, 95)),
+        "mean_step_time": float(np.mean(step_times)),
+        "median_setup_time": float(np.median(setup_times)),
+        "peak_rss_mb": peak / 2**20,
+        "median_error": None if error is None else float(np.median(error)),
+        "max_error": None if error is None else float(error.max()),
+        "numpy": np.__version__,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+
+
+# Benchmark every engine over the grid of body, step and worker counts
+# Engines not split across workers are only run once for every body and
+# step count, whatever the worker counts
+def benchmark_suite(
+        engines, bodies, steps, workers=(None,), trials=3, warmup=1,
+        theta=0.5, timestep=0.01, seed=50, accuracy=True, report=None):
+    results = []
+    for engine in engines:
+        engine_workers = workers if engine in MULTIPROCESS_ENGINES else [
+            None
+        ]
+        for number_of_bodies in bodies:
+            for number_of_timesteps in steps:
+                for worker_count in engine_workers:
+                    result = benchmark(
+                        engine, number_of_bodies, number_of_timesteps,
+                        worker_count, trials, warmup, theta, timestep,
+                        seed, accuracy
+                        )
+                    if report is not None:
+                        report(result)
+                    results.append(result)
+    return results
+
+
+# Write the results as JSON, or append them to a CSV file
+def write_results(results, path):
+    if path.endswith(".json"):
+        with open(path, "w") as file:
+            json.dump(results, file, indent=2)
+        return
+
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        if new_file:
+            writer.writeheader()
+        writer.writerows(results)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the N-body engines over a grid of sizes"
+        )
+    parser.add_argument(
+        "--engines", nargs="+", default=["vectorized", "octree", "quadtree"],
+        choices=list(ENGINES), metavar="ENGINE",
+        help="engines to run, from: %s" % ", ".join(ENGINES)
+        )
+    parser.add_argument(
+        "--bodies", nargs="+", type=int, default=[1000],
+        help="body counts (default: 1000)"
+        )
+    parser.add_argument(
+        "--steps", nargs="+", type=int, default=[5],
+        help="timed timesteps of every trial (default: 5)"
+        )
+    parser.add_argument(
+        "--workers", nargs="+", type=int, default=[None],
+        help="worker counts of the multiprocess engines "
+             "(default: number of CPUs)"
+        )
+    parser.add_argument(
+        "--trials", type=int, default=3,
+        help="repeated trials of every point (default: 3)"
+        )
+    parser.add_argument(
+        "--warmup", type=int, default=1,
+        help="untimed timesteps before every trial (default: 1)"
+        )
+    parser.add_argument("--theta", type=float, default=0.5)
+    parser.add_argument("--dt", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=50)
+    parser.add_argument(
+        "--no-accuracy", action="store_true",
+        help="skip the comparison against direct summation"
+        )
+    parser.add_argument(
+        "--output", default=None,
+        help="CSV (appended to) or .json file for the results"
+        )
+    return parser.parse_args(argv)
+
+
+def print_result(result):
+    error = result["median_error"]
+    print("%-22s %7d %5d %7s %10.4f %10.4f %9.1f %10s" % (
+        result["engine"], result["bodies"], result["steps"],
+        "-" if result["workers"] is None else result["workers"],
+        result["median_step_time"], result["p95_step_time"],
+        result["peak_rss_mb"], "-" if error is None else "%.2e" % error
+        ))
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    print("%-22s %7s %5s %7s %10s %10s %9s %10s" % (
+        "engine", "bodies", "steps", "workers", "median (s)", "p95 (s)",
+        "peak (MB)", "error"
+        ))
+    results = benchmark_suite(
+        arguments.engines, arguments.bodies, arguments.steps,
+        arguments.workers, arguments.trials, arguments.warmup,
+        arguments.theta, arguments.dt, arguments.seed,
+        not arguments.no_accuracy, report=print_result
+        )
+    if arguments.output is not None:
+        write_results(results, arguments.output)
+        print("Results written to", arguments.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
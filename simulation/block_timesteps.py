@@ -0,0 +1,183 @@
+import numpy as np
+
+from simulation import instrumentation
+
+
+"""
+BLOCK TIMESTEPS
+
+Hierarchical (block) timestep kick-drift-kick leapfrog
+
+A global timestep has to be small enough for the bodies in the closest
+encounters, so in a clustered system a handful of close pairs set the
+cost of every step for every body. Here every body gets its own
+timestep instead, from a set of power of two bins:
+
+    timestep / 2**level, level = 0 .. max_level
+
+The global timestep is split into 2**max_level ticks of the smallest
+timestep. A body on level k is active every 2**(max_level - k) ticks:
+
+1. Every body is drifted to the current tick
+2. Only the active bodies get new accelerations, due to every body
+3. Active bodies get the closing half kick of their step, are moved to
+   the level their new acceleration asks for, then get the opening
+   half kick of their next step
+
+A body's level comes from
+
+    dt = sqrt(2 * accuracy * length / |acceleration|)
+
+rounded down to a power of two fraction of timestep. A body can always
+move to a smaller timestep, but only to a larger one when that level
+is in step with the current tick, so the bins stay synchronised.
+
+When every body is on level 0 this is exactly LeapfrogIntegrator.
+
+The integrator works with any function of the form
+get_acceleration_active(active, position, *args) returning the
+accelerations of the bodies active only:
+
+    BlockTimestepIntegrator(
+        pairwise_kernels.get_acceleration_active, position, velocity,
+        timestep, args=(mass, G, softening), length=softening)
+
+    BlockTimestepIntegrator(
+        barnes_hut_flat_tree.get_acceleration_active, position, velocity,
+        timestep, args=(mass, G, theta))
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+class BlockTimestepIntegrator:
+    def __init__(
+            self, get_acceleration_active, position, velocity, timestep,
+            args=(), max_level=6, accuracy=0.025, length=0.1,
+            acceleration=None):
+        """
+        get_acceleration_active: function returning the accelerations of
+        the bodies given by an index array
+        position: array of body positions, updated in place
+        velocity: array of body velocities, updated in place
+        timestep: largest timestep, taken by bodies on level 0
+        args: extra arguments passed to get_acceleration_active after
+        position
+        max_level: smallest timestep is timestep / 2**max_level
+        accuracy: timestep criterion parameter, smaller is more accurate
+        length: length scale of the timestep criterion, usually the
+        softening length
+        acceleration: accelerations at the starting positions,
+        calculated here if not given
+        level: timestep level of every body
+        force_evaluations: number of times get_acceleration_active has
+        been called
+        body_evaluations: total number of body accelerations calculated
+        steps: number of full timesteps taken
+        """
+        if max_level < 0:
+            raise ValueError(
+                "max_level must be at least 0, got %d" % max_level
+                )
+        self.get_acceleration_active = get_acceleration_active
+        self.position = position
+        self.velocity = velocity
+        self.timestep = timestep
+        self.args = tuple(args)
+        self.max_level = max_level
+        self.accuracy = accuracy
+        self.length = length
+        self.force_evaluations = 0
+        self.body_evaluations = 0
+        self.steps = 0
+
+        N = position.shape[0]
+        if acceleration is None:
+            acceleration = self.calculate_acceleration(np.arange(N))
+        self.acceleration = acceleration
+        self.level = self.wanted_level(np.arange(N))
+
+    # Accelerations of the active bodies at the current positions
+    def calculate_acceleration(self, active):
+        self.force_evaluations += 1
+        self.body_evaluations += active.size
+        instrumentation.count("active bodies", active.size)
+        with instrumentation.timer("force"):
+            return self.get_acceleration_active(
+                active, self.position, *self.args
+                )
+
+    # Level every body in active asks for from its acceleration
+    def wanted_level(self, active):
+        magnitude = np.linalg.norm(self.acceleration[active], axis=1)
+        with np.errstate(divide="ignore"):
+            dt = np.sqrt(2 * self.accuracy * self.length / magnitude)
+            level = np.ceil(np.log2(self.timestep / dt))
+        return np.clip(level, 0, self.max_level).astype(int)
+
+    # Timestep of every body in active
+    def level_timestep(self, active):
+        return self.timestep / 2.0**self.level[active]
+
+    # One full timestep: every body advances by timestep, in substeps
+    # of its own level
+    def step(self):
+        ticks = 2**self.max_level
+        tick_time = self.timestep / ticks
+        # Ticks in one timestep of every level
+        ticks_per_step = 2**(self.max_level - np.arange(self.max_level + 1))
+
+        # Opening half kick of every body, as all bins start together
+        everyone = np.arange(self.position.shape[0])
+        with instrumentation.timer("integration"):
+            self.velocity += (
+                self.acceleration
+                * self.level_timestep(everyone)[:, np.newaxis]
+                ) / 2
+
+        drift = 0
+        for tick in range(1, ticks + 1):
+            drift += 1
+            # Bodies whose timestep ends on this tick
+            active = np.flatnonzero(tick % ticks_per_step[self.level] == 0)
+            if active.size == 0:
+                continue
+
+            # Every body drifts to the current tick
+            with instrumentation.timer("integration"):
+                self.position += self.velocity * (drift * tick_time)
+            drift = 0
+
+            self.acceleration[active] = self.calculate_acceleration(active)
+
+            # Closing half kick with the old timestep
+            with instrumentation.timer("integration"):
+                half = self.level_timestep(active)[:, np.newaxis] / 2
+                self.velocity[active] += self.acceleration[active] * half
+            if tick == ticks:
+                break
+
+            # New levels: smaller timesteps are always allowed, larger
+            # ones only as far as the levels in step with this tick
+            in_step = self.max_level
+            while in_step > 0 and tick % ticks_per_step[in_step - 1] == 0:
+                in_step -= 1
+            self.level[active] = np.maximum(
+                self.wanted_level(active), in_step
+                )
+
+            # Opening half kick with the new timestep
+            with instrumentation.timer("integration"):
+                half = self.level_timestep(active)[:, np.newaxis] / 2
+                self.velocity[active] += self.acceleration[active] * half
+
+        # Every body finishes in step, so all levels may change
+        self.level = self.wanted_level(everyone)
+        self.steps += 1
+        instrumentation.end_step()
+
+    # Advance the simulation by a number of timesteps
+    def run(self, number_of_timesteps):
+        for _ in range(number_of_timesteps):
+            self.step()
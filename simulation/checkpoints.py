@@ -0,0 +1,190 @@
+import json
+import os
+import numpy as np
+
+from barnes_hut.barnes_hut_flat_tree import FlatQuadtree
+from simulation import instrumentation
+
+
+"""
+CHECKPOINTS
+
+Saves the full state of a SimulationRun so a run which is stopped, or
+whose machine goes away, can carry on from its last checkpoint and end
+up with exactly the same bodies, bit for bit, as a run which never
+stopped.
+
+A checkpoint is one .npz file holding:
+
+description
+    - The run's engine, number of bodies, timestep, theta, seed, grid
+      size, timestep counter and time taken so far, as JSON
+bodies
+    - position, velocity or momentum, mass
+    - The integrator's acceleration and force evaluation count, as the
+      leapfrog integrator reuses the last acceleration for its next
+      kick instead of calculating it again
+tree
+    - Every array of the quadtree engines' last tree, as a tree
+      refitted between timesteps (refit=True) is not the same as a tree
+      built from scratch, and the forces would differ in their last
+      digits
+rng
+    - The state of NumPy's global random number generator
+
+Checkpoints are written to a temporary file next to the checkpoint,
+flushed to disk and only then renamed over the previous checkpoint, so
+the checkpoint on disk is always complete, whenever the process stops.
+
+The worker count is not part of the state: the multiprocess engines
+give the same forces for any number of workers, so a run may be
+resumed with a different number of them.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Arrays of a FlatQuadtree, None for the ones a tree may not have
+TREE_ARRAYS = (
+    "child", "mass", "com", "corner", "side", "body", "next_body",
+    "order", "body_start", "body_count", "quadrupole", "origin"
+)
+
+# Plain values of a FlatQuadtree
+TREE_VALUES = ("leaf_capacity", "refits", "root", "count", "size")
+
+
+# Arrays and values describing a tree, keyed for the checkpoint file
+def tree_state(tree):
+    state = {}
+    for key in TREE_ARRAYS:
+        array = getattr(tree, key)
+        if array is not None:
+            state["tree_" + key] = array
+    state["tree_values"] = np.array(
+        [getattr(tree, key) for key in TREE_VALUES], dtype=float
+        )
+    return state
+
+
+# Tree rebuilt from the state of tree_state
+def restore_tree(state):
+    tree = FlatQuadtree(0)
+    for key in TREE_ARRAYS:
+        array = state.get("tree_" + key)
+        setattr(tree, key, None if array is None else array.copy())
+    for key, value in zip(TREE_VALUES, state["tree_values"].tolist()):
+        setattr(tree, key, value if key == "size" else int(value))
+    return tree
+
+
+# State of NumPy's global random number generator as arrays
+def rng_state():
+    kind, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        "rng_keys": keys,
+        "rng_values": np.array(
+            [position, has_gauss, cached_gaussian], dtype=float
+            ),
+    }
+
+
+def restore_rng(state):
+    position, has_gauss, cached_gaussian = state["rng_values"].tolist()
+    np.random.set_state((
+        "MT19937", state["rng_keys"], int(position), int(has_gauss),
+        cached_gaussian
+        ))
+
+
+# Full state of a run
+def run_state(run):
+    description = {
+        "engine": run.engine_name,
+        "bodies": run.number_of_bodies,
+        "timestep": run.timestep,
+        "theta": run.theta,
+        "seed": run.seed,
+        "grid_size": run.grid_size,
+        "steps": run.steps,
+        "run_time": run.run_time,
+    }
+    state = {"position": run.position, "mass": run.mass}
+    if run.velocity is not None:
+        state["velocity"] = run.velocity
+    if run.momentum is not None:
+        state["momentum"] = run.momentum
+    if run.integrator is not None:
+        state["acceleration"] = run.integrator.acceleration
+        description["force_evaluations"] = run.integrator.force_evaluations
+        description["integrator_steps"] = run.integrator.steps
+
+    tree = run.tree
+    if tree is None and run.force_engine is not None:
+        tree = getattr(run.force_engine, "tree", None)
+    if tree is not None:
+        state.update(tree_state(tree))
+
+    state.update(rng_state())
+    state["description"] = np.array(json.dumps(description))
+    return state
+
+
+# Write the state of a run to path, replacing the file atomically
+def save_checkpoint(run, path):
+    with instrumentation.timer("io"):
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, **run_state(run))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+
+
+# Read a checkpoint written by save_checkpoint
+# Returns the description and the arrays
+def load_checkpoint(path):
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+    description = json.loads(str(state.pop("description")))
+    return description, state
+
+
+# Put the state of a checkpoint back into a run set up with the same
+# engine, number of bodies, timestep, theta, seed and grid size
+# The arrays are copied into the run's own, which the engine's
+# integrator already points at
+def restore_run(run, description, state):
+    for key, value in (
+            ("engine", run.engine_name), ("bodies", run.number_of_bodies),
+            ("timestep", run.timestep), ("theta", run.theta),
+            ("seed", run.seed), ("grid_size", run.grid_size)):
+        if description[key] != value:
+            raise ValueError(
+                "The checkpoint was written with %s %r, the run has %r"
+                % (key, description[key], value)
+                )
+
+    run.position[:] = state["position"]
+    run.mass[:] = state["mass"]
+    if run.velocity is not None:
+        run.velocity[:] = state["velocity"]
+    if run.momentum is not None:
+        run.momentum[:] = state["momentum"]
+    if run.integrator is not None:
+        run.integrator.acceleration = state["acceleration"].copy()
+        run.integrator.force_evaluations = description["force_evaluations"]
+        run.integrator.steps = description["integrator_steps"]
+
+    if "tree_values" in state:
+        tree = restore_tree(state)
+        if run.force_engine is not None:
+            run.force_engine.tree = tree
+        else:
+            run.tree = tree
+
+    restore_rng(state)
+    run.steps = description["steps"]
+    run.run_time = description["run_time"]
+    return run
@@ -0,0 +1,292 @@
+import json
+import marshal
+import time
+import numpy as np
+import psutil
+
+
+"""
+INSTRUMENTATION
+
+Named timers and counters which the engines report to while they run,
+gathered per timestep instead of profiling the whole run a second time.
+
+The engines call the module level functions:
+
+    with instrumentation.timer("tree build"):
+        tree = build_tree(position, mass)
+    instrumentation.count("interactions", interactions)
+    instrumentation.gauge("tree depth", depth)
+    instrumentation.end_step()
+
+Nothing is recorded until an Instrumentation is enabled; until then
+every call returns straight away, and timer hands back one shared
+context manager which does nothing, so the engines pay a function call
+per phase and no more.
+
+    probe = instrumentation.enable()
+    integrator.run(100)
+    instrumentation.disable()
+    probe.write_json("run.json")
+    probe.write_pstats("run.prof")     # snakeviz run.prof
+
+Timers
+    - "tree build", "force walk", "force", "integration", "io", ...
+    - Timers may be nested, every timer knows which timer it ran inside
+    - Total time of every timer in every step
+
+Counters
+    - count adds up a value over a step, such as the interactions of
+      every body
+    - gauge keeps the largest value seen in a step, such as the depth
+      of the tree
+
+end_step closes a step. The summary gives, for every timer and
+counter, its total over the run and the mean, median, 95th percentile
+and a histogram of its per step values.
+
+write_pstats writes the timers in the format of cProfile's pstats
+files, one entry per timer with its callers taken from the nesting,
+so they can be opened with snakeviz (or pstats.Stats) directly.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Context manager returned while nothing is recorded
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+# Context manager timing one named phase
+class _Timer:
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation._stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.instrumentation._stop(self.name, elapsed)
+        return False
+
+
+class Instrumentation:
+    def __init__(self, enabled=True, bins=10):
+        """
+        enabled: record the timers and counters (everything returns
+        straight away when False)
+        bins: number of bins of every per step histogram
+        timers: per step total time of every timer, one list per name
+        counters: per step value of every counter, one list per name
+        calls: number of times every timer has run
+        steps: number of steps ended
+        """
+        self.enabled = enabled
+        self.bins = bins
+        self.timers = {}
+        self.counters = {}
+        self.calls = {}
+        self.steps = 0
+
+        # Values of the step still running
+        self._step_timers = {}
+        self._step_counters = {}
+        # Timers running at the moment, innermost last
+        self._stack = []
+        # Time spent in the timers run inside every timer
+        self._inner_time = {}
+        # Calls and time of every (outer timer, timer) pair
+        self._callers = {}
+
+    # Context manager timing the phase called name
+    def timer(self, name):
+        if not self.enabled:
+            return _no_timer
+        return _Timer(self, name)
+
+    # Record a timer which has just stopped
+    def _stop(self, name, elapsed):
+        self._stack.pop()
+        outer = self._stack[-1] if self._stack else None
+        self._step_timers[name] = self._step_timers.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if outer is not None:
+            self._inner_time[outer] = (
+                self._inner_time.get(outer, 0.0) + elapsed
+                )
+        calls, total = self._callers.get((outer, name), (0, 0.0))
+        self._callers[(outer, name)] = (calls + 1, total + elapsed)
+
+    # Add value to the counter called name for this step
+    def count(self, name, value=1):
+        if self.enabled:
+            self._step_counters[name] = (
+                self._step_counters.get(name, 0) + value
+                )
+
+    # Keep the largest value of the counter called name for this step
+    def gauge(self, name, value):
+        if self.enabled:
+            self._step_counters[name] = max(
+                self._step_counters.get(name, value), value
+                )
+
+    # Close the current step
+    # A timer or counter missing from a step is recorded as 0 for it
+    def end_step(self):
+        if not self.enabled:
+            return
+        for history, step in (
+                (self.timers, self._step_timers),
+                (self.counters, self._step_counters)):
+            for name in step:
+                if name not in history:
+                    history[name] = [0] * self.steps
+            for name, values in history.items():
+                values.append(step.get(name, 0))
+            step.clear()
+        self.steps += 1
+
+    # Total, spread and histogram of a list of per step values
+    def describe(self, values):
+        values = np.asarray(values, dtype=float)
+        counts, edges = np.histogram(values, bins=self.bins)
+        return {
+            "total": float(values.sum()),
+            "mean": float(values.mean()),
+            "median": float(np.median(values)),
+            "p95": float(np.percentile(values, 95)),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "histogram": {
+                "counts": counts.tolist(),
+                "edges": edges.tolist(),
+            },
+        }
+
+    # Summary of every timer and counter over the steps ended so far
+    def summary(self):
+        return {
+            "steps": self.steps,
+            "timers": {
+                name: dict(self.describe(values), calls=self.calls[name])
+                for name, values in self.timers.items() if values
+            },
+            "counters": {
+                name: self.describe(values)
+                for name, values in self.counters.items() if values
+            },
+        }
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+
+    # Write the timers as a pstats file
+    # Every timer is a function, its own time being the time not spent
+    # in the timers nested inside it
+    def write_pstats(self, path):
+        def key(name):
+            return ("instrumentation", 0, name)
+
+        stats = {}
+        for name, calls in self.calls.items():
+            total = sum(
+                seconds for (outer, inner), (_, seconds)
+                in self._callers.items() if inner == name
+                )
+            callers = {
+                key(outer): (count, count, seconds, seconds)
+                for (outer, inner), (count, seconds)
+                in self._callers.items()
+                if inner == name and outer is not None
+            }
+            own = total - self._inner_time.get(name, 0.0)
+            stats[key(name)] = (calls, calls, own, total, callers)
+        with open(path, "wb") as file:
+            marshal.dump(stats, file)
+
+    # Print the timers and counters as a table
+    def print_summary(self):
+        summary = self.summary()
+        print("%-24s %10s %10s %10s %10s" % (
+            "timer (s per step)", "total", "median", "p95", "max"
+            ))
+        for name, values in summary["timers"].items():
+            print("%-24s %10.4f %10.4f %10.4f %10.4f" % (
+                name, values["total"], values["median"], values["p95"],
+                values["max"]
+                ))
+        if summary["counters"]:
+            print("%-24s %10s %10s %10s %10s" % (
+                "counter (per step)", "total", "median", "p95", "max"
+                ))
+        for name, values in summary["counters"].items():
+            print("%-24s %10.4g %10.4g %10.4g %10.4g" % (
+                name, values["total"], values["median"], values["p95"],
+                values["max"]
+                ))
+
+
+# Instrumentation the engines report to, disabled until enable is called
+active = Instrumentation(enabled=False)
+_disabled = active
+
+
+# Start recording into instrumentation (a new one by default)
+def enable(instrumentation=None):
+    global active
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    active = instrumentation
+    return instrumentation
+
+
+# Stop recording
+def disable():
+    global active
+    active = _disabled
+
+
+def timer(name):
+    return active.timer(name)
+
+
+def count(name, value=1):
+    active.count(name, value)
+
+
+def gauge(name, value):
+    active.gauge(name, value)
+
+
+def end_step():
+    active.end_step()
+
+
+# CPU time used so far by this process and its worker processes, in
+# seconds, to compare against the wall time of a run
+def cpu_time():
+    process = psutil.Process()
+    used = process.cpu_times()
+    total = used.user + used.system
+    for child in process.children(recursive=True):
+        try:
+            used = child.cpu_times()
+        except psutil.NoSuchProcess:
+            continue
+        total += used.user + used.system
+    return total
@@ -0,0 +1,89 @@
+from simulation import instrumentation
+
+
+"""
+INTEGRATORS
+
+Kick-drift-kick leapfrog
+
+1. Half timestep kick with the acceleration at the start of the step
+2. Full timestep drift of the positions
+3. Calculate the accelerations at the new positions
+4. Half timestep kick with the new acceleration
+
+The acceleration calculated in step 3 is the acceleration at the start
+of the next step, so every step costs exactly one force calculation.
+
+The integrator works with any function of the form
+get_acceleration(position, *args), so the same integrator drives
+the pairwise kernels, the multi-core pairwise engine and the
+Barnes-Hut quadtree:
+
+    LeapfrogIntegrator(
+        get_acceleration_vectorized, position, velocity, timestep,
+        args=(mass, G, softening))
+
+    LeapfrogIntegrator(
+        barnes_hut_quadtree.get_acceleration, position, velocity, timestep,
+        args=(mass, G, theta))
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+class LeapfrogIntegrator:
+    def __init__(
+            self, get_acceleration, position, velocity, timestep,
+            args=(), acceleration=None):
+        """
+        get_acceleration: function returning the accelerations of the bodies
+        position: array of body positions, updated in place
+        velocity: array of body velocities, updated in place
+        timestep: change in time between simulation cycles
+        args: extra arguments passed to get_acceleration after position
+        acceleration: accelerations at the starting positions, calculated
+        here if not given
+        force_evaluations: number of times get_acceleration has been called
+        """
+        self.get_acceleration = get_acceleration
+        self.position = position
+        self.velocity = velocity
+        self.timestep = timestep
+        self.args = tuple(args)
+        self.force_evaluations = 0
+        self.steps = 0
+
+        if acceleration is None:
+            acceleration = self.calculate_acceleration()
+        self.acceleration = acceleration
+
+    # Accelerations at the current positions
+    def calculate_acceleration(self):
+        self.force_evaluations += 1
+        with instrumentation.timer("force"):
+            return self.get_acceleration(self.position, *self.args)
+
+    # One kick-drift-kick cycle
+    def step(self):
+        with instrumentation.timer("integration"):
+            # Half timestep kick
+            self.velocity += (self.acceleration * self.timestep) / 2
+
+            # Full timestep drift
+            self.position += self.velocity * self.timestep
+
+        # Forces at the new positions, reused by the next step's first kick
+        self.acceleration = self.calculate_acceleration()
+
+        with instrumentation.timer("integration"):
+            # Half timestep kick
+            self.velocity += (self.acceleration * self.timestep) / 2
+
+        self.steps += 1
+        instrumentation.end_step()
+
+    # Advance the simulation by a number of timesteps
+    def run(self, number_of_timesteps):
+        for _ in range(number_of_timesteps):
+            self.step()
@@ -0,0 +1,583 @@
+import argparse
+import json
+import time
+import numpy as np
+
+from barnes_hut import barnes_hut_fmm, barnes_hut_octree
+from barnes_hut import barnes_hut_flat_tree
+from barnes_hut.barnes_hut_flat_tree import single_timestep_cycle
+from barnes_hut.barnes_hut_multiprocess import SharedMemoryTreeEngine
+from pairwise.pairwise_kernels import KERNELS
+from pairwise.pairwise_multiprocess import SharedMemoryForceEngine
+from particle_mesh import particle_mesh, particle_mesh_treepm
+from simulation import instrumentation
+from simulation.checkpoints import (
+    load_checkpoint, restore_run, save_checkpoint
+    )
+from simulation.integrator import LeapfrogIntegrator
+from simulation.snapshots import SnapshotWriter
+
+
+"""
+SIMULATION RUNNER
+
+Runs any engine for a number of timesteps without asking anything on
+stdin, so runs can be scripted and swept.
+
+As a library:
+
+    from simulation.runner import run_simulation
+    result = run_simulation("octree", 10000, 20, theta=0.7)
+    result["run_time"]
+
+From the command line, printing the same result as JSON:
+
+    python -m simulation --engine octree --bodies 10000 --steps 20
+    python main.py --engine quadtree --bodies 5000 --steps 10 --theta 0.7
+
+The engines start from the same initial conditions as the interactive
+scripts:
+
+pairwise kernels, pairwise-multiprocess, octree, particle-mesh, treepm
+    - 3D, bodies of mass 100 / N with normally distributed positions
+      and velocities in the center of mass frame, softening 0.1
+    - Integrated with LeapfrogIntegrator
+
+quadtree, quadtree-multiprocess, fmm
+    - 2D, bodies of random mass 0 - 10 spread over the unit square with
+      random momentums
+    - The quadtree engines use the Barnes-Hut scripts' own timestep
+      (rebuilding the tree every timestep) with the same walk, body by
+      body through a tree of one body per leaf, so quadtree-multiprocess
+      with one worker runs what quadtree runs. The FMM engine is
+      integrated with LeapfrogIntegrator
+
+Every run reports the time taken to set the engine up (including the
+first force calculation and starting any worker processes) separately
+from the time taken by the timesteps themselves.
+
+With --snapshots FILE the bodies are streamed to a snapshot file every
+--snapshot-every timesteps (see simulation/snapshots.py).
+
+With --checkpoint FILE the full state of the run is saved to FILE every
+--checkpoint-every timesteps and when the run ends (see
+simulation/checkpoints.py). --restart carries a run on from FILE, with
+the engine, bodies, timestep, theta, seed and grid size it was saved
+with, until it has run --steps timesteps in total; the result is bit
+for bit the same as running all of them in one go:
+
+    python -m simulation --engine quadtree --steps 1000 --checkpoint run.npz
+    python -m simulation --steps 1000 --checkpoint run.npz --restart
+
+A snapshot file opened on a restarted run starts again from the
+restored step, it is not appended to.
+
+With --instrument the result also holds the per timestep summary of
+the engine's timers and counters (see simulation/instrumentation.py),
+and --pstats writes the timers to a file snakeviz can open.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# Newton's Gravitational Constant, as in the interactive scripts
+G = 6.67 / 1e11
+
+# Softening length of the 3D engines
+softening = 0.1
+
+
+# Bodies of the 3D engines
+def pairwise_bodies(number_of_bodies, seed):
+    random = np.random.RandomState(seed)
+    mass = 100 * np.ones((number_of_bodies, 1)) / number_of_bodies
+    position = random.randn(number_of_bodies, 3)
+    velocity = random.randn(number_of_bodies, 3)
+    velocity -= np.mean(mass * velocity, 0) / np.mean(mass)
+    return position, velocity, mass
+
+
+# Bodies of the 2D engines
+def quadtree_bodies(number_of_bodies, seed):
+    random = np.random.RandomState(seed)
+    mass = random.random_sample(number_of_bodies) * 10
+    x = random.random_sample(number_of_bodies)
+    y = random.random_sample(number_of_bodies)
+    momentum_x = random.random_sample(number_of_bodies) - 0.5
+    momentum_y = random.random_sample(number_of_bodies) - 0.5
+    position = np.column_stack((x, y))
+    momentum = np.column_stack((momentum_x, momentum_y))
+    return position, momentum, mass
+
+
+# Every engine below sets itself up on a SimulationRun, storing its
+# bodies and its get_acceleration function on it, and returns the
+# function advancing the simulation by a number of timesteps
+
+
+# Leapfrog integration of the run's bodies with get_acceleration
+def leapfrog(run, get_acceleration, args):
+    run.get_acceleration = get_acceleration
+    run.force_args = args
+    run.integrator = LeapfrogIntegrator(
+        get_acceleration, run.position, run.velocity, run.timestep,
+        args=args
+        )
+    return run.integrator.run
+
+
+# One of the pairwise kernels
+def pairwise_engine(kernel):
+    def setup(run):
+        run.position, run.velocity, run.mass = pairwise_bodies(
+            run.number_of_bodies, run.seed
+            )
+        return leapfrog(run, kernel, (run.mass, G, softening))
+    return setup
+
+
+# The tiled kernel split across a pool of worker processes
+def pairwise_multiprocess_engine(run):
+    run.position, run.velocity, run.mass = pairwise_bodies(
+        run.number_of_bodies, run.seed
+        )
+    run.force_engine = SharedMemoryForceEngine(
+        run.number_of_bodies, workers=run.workers
+        )
+    return leapfrog(
+        run, run.force_engine.get_acceleration, (run.mass, G, softening)
+        )
+
+
+# The 3D Barnes-Hut octree
+def octree_engine(run):
+    run.position, run.velocity, run.mass = pairwise_bodies(
+        run.number_of_bodies, run.seed
+        )
+    return leapfrog(
+        run, barnes_hut_octree.get_acceleration,
+        (run.mass, G, softening, run.theta)
+        )
+
+
+# The flat quadtree, rebuilt every timestep
+def quadtree_engine(run):
+    run.position, run.momentum, run.mass = quadtree_bodies(
+        run.number_of_bodies, run.seed
+        )
+    run.get_acceleration = barnes_hut_flat_tree.get_acceleration
+    run.force_args = (run.mass, G, run.theta)
+
+    def advance(number_of_timesteps):
+        for _ in range(number_of_timesteps):
+            run.tree = single_timestep_cycle(
+                run.position, run.momentum, run.mass, run.theta, G,
+                run.timestep, tree=run.tree
+                )
+    return advance
+
+
+# The flat quadtree with its walk split across a pool of worker
+# processes
+def quadtree_multiprocess_engine(run):
+    run.position, run.momentum, run.mass = quadtree_bodies(
+        run.number_of_bodies, run.seed
+        )
+    run.force_engine = SharedMemoryTreeEngine(
+        run.number_of_bodies, workers=run.workers
+        )
+    run.get_acceleration = run.force_engine.get_acceleration
+    run.force_args = (run.mass, G, run.theta)
+
+    def advance(number_of_timesteps):
+        for _ in range(number_of_timesteps):
+            run.force_engine.step(
+                run.position, run.momentum, run.mass, run.theta, G,
+                run.timestep
+                )
+    return advance
+
+
+# Forces from a grid of grid_size³ points with FFTs
+def particle_mesh_engine(run):
+    run.position, run.velocity, run.mass = pairwise_bodies(
+        run.number_of_bodies, run.seed
+        )
+    return leapfrog(
+        run, particle_mesh.get_acceleration,
+        (run.mass, G, softening, run.grid_size)
+        )
+
+
+# Long range forces from the grid, short range forces from the octree
+def treepm_engine(run):
+    run.position, run.velocity, run.mass = pairwise_bodies(
+        run.number_of_bodies, run.seed
+        )
+    return leapfrog(
+        run, particle_mesh_treepm.get_acceleration,
+        (run.mass, G, softening, run.theta, run.grid_size)
+        )
+
+
+# The dual tree fast multipole method
+def fmm_engine(run):
+    run.position, momentum, run.mass = quadtree_bodies(
+        run.number_of_bodies, run.seed
+        )
+    run.velocity = momentum / run.mass[:, np.newaxis]
+    return leapfrog(
+        run, barnes_hut_fmm.get_acceleration, (run.mass, G, run.theta)
+        )
+
+
+# Engines which can be selected by name
+ENGINES = {name: pairwise_engine(kernel) for name, kernel in KERNELS.items()}
+ENGINES.update({
+    "pairwise-multiprocess": pairwise_multiprocess_engine,
+    "octree": octree_engine,
+    "quadtree": quadtree_engine,
+    "quadtree-multiprocess": quadtree_multiprocess_engine,
+    "fmm": fmm_engine,
+    "particle-mesh": particle_mesh_engine,
+    "treepm": treepm_engine,
+})
+
+
+class SimulationRun:
+    def __init__(
+            self, engine, number_of_bodies, timestep=0.01, theta=0.5,
+            seed=50, workers=None, instrumentation=None,
+            grid_size=particle_mesh.mesh_grid_size):
+        """
+        engine: name of the engine, one of ENGINES
+        number_of_bodies: number of bodies in the simulation
+        timestep: change in time between simulation cycles
+        theta: opening angle of the tree engines
+        seed: seed of the initial conditions
+        workers: number of worker processes of the multiprocess engines
+        (default: number of CPUs)
+        instrumentation: Instrumentation recording the timesteps run
+        (nothing is recorded by default)
+        grid_size: grid points along every side of the grid of the
+        particle-mesh and TreePM engines
+        position, mass: the bodies, set up by the engine
+        velocity: velocities of the bodies integrated by a
+        LeapfrogIntegrator (None otherwise)
+        momentum: momentums of the bodies integrated by the quadtree
+        engines (None otherwise)
+        integrator: LeapfrogIntegrator of the engine (None when the
+        engine integrates the bodies itself)
+        force_engine: multiprocess force engine (None for the others)
+        get_acceleration, force_args: the engine's force calculation
+        and the arguments it takes after the positions
+        tree: tree kept between timesteps by the quadtree engine
+        snapshots: SnapshotWriter the bodies are written to (None until
+        open_snapshots is called)
+        checkpoint_path: file the run is checkpointed to (None until
+        enable_checkpoints is called)
+        checkpoint_every: timesteps between checkpoints
+        setup_time: time taken to set the engine up
+        run_time: time taken by the timesteps run so far
+        steps: number of timesteps run so far
+        """
+        if engine not in ENGINES:
+            raise ValueError(
+                "Unknown engine '%s', choose from: %s"
+                % (engine, ", ".join(ENGINES))
+                )
+        if number_of_bodies < 1:
+            raise ValueError(
+                "number_of_bodies must be at least 1, got %d"
+                % number_of_bodies
+                )
+        self.engine_name = engine
+        self.number_of_bodies = number_of_bodies
+        self.timestep = timestep
+        self.theta = theta
+        self.seed = seed
+        self.workers = workers
+        self.instrumentation = instrumentation
+        self.grid_size = grid_size
+        self.position = None
+        self.velocity = None
+        self.momentum = None
+        self.mass = None
+        self.integrator = None
+        self.force_engine = None
+        self.get_acceleration = None
+        self.force_args = ()
+        self.tree = None
+        self.snapshots = None
+        self.checkpoint_path = None
+        self.checkpoint_every = 1
+        self.run_time = 0.0
+        self.steps = 0
+
+        start = time.perf_counter()
+        self._advance = ENGINES[engine](self)
+        self.setup_time = time.perf_counter() - start
+
+    # Advance the simulation by a number of timesteps
+    def run(self, number_of_timesteps):
+        if number_of_timesteps < 0:
+            raise ValueError(
+                "number_of_timesteps must be at least 0, got %d"
+                % number_of_timesteps
+                )
+        if self.instrumentation is not None:
+            instrumentation.enable(self.instrumentation)
+        try:
+            start = time.perf_counter()
+            if self.snapshots is None and self.checkpoint_path is None:
+                self._advance(number_of_timesteps)
+                self.steps += number_of_timesteps
+            else:
+                # One timestep at a time, so every due step is written
+                for _ in range(number_of_timesteps):
+                    self._advance(1)
+                    self.steps += 1
+                    if self.snapshots is not None:
+                        self.snapshots.record(
+                            self.steps, self.position, self.velocities()
+                            )
+                    if (self.checkpoint_path is not None
+                            and self.steps % self.checkpoint_every == 0):
+                        self.save_checkpoint()
+            self.run_time += time.perf_counter() - start
+        finally:
+            if self.instrumentation is not None:
+                instrumentation.disable()
+
+    # Velocities of the bodies, from their momentums for the engines
+    # integrating momentums
+    def velocities(self):
+        if self.velocity is not None:
+            return self.velocity
+        return self.momentum / self.mass[:, np.newaxis]
+
+    # Stream the bodies to a snapshot file every `every` timesteps from
+    # now on, starting with the current state
+    def open_snapshots(self, path, every=1, dtype=np.float64, frames=16):
+        self.snapshots = SnapshotWriter(
+            path, self.number_of_bodies, self.position.shape[1],
+            self.timestep, self.engine_name, dtype=dtype, every=every,
+            frames=frames
+            )
+        self.snapshots.record(self.steps, self.position, self.velocities())
+        return self.snapshots
+
+    # Checkpoint the run to path every `every` timesteps from now on
+    def enable_checkpoints(self, path, every=1):
+        if every < 1:
+            raise ValueError("every must be at least 1, got %d" % every)
+        self.checkpoint_path = path
+        self.checkpoint_every = every
+
+    # Save the full state of the run, to checkpoint_path by default
+    def save_checkpoint(self, path=None):
+        save_checkpoint(self, self.checkpoint_path if path is None else path)
+
+    # Carry the run on from a checkpoint saved with the same engine,
+    # bodies, timestep, theta, seed and grid size
+    def restore_checkpoint(self, path):
+        description, state = load_checkpoint(path)
+        restore_run(self, description, state)
+
+    # Accelerations of the bodies at their current positions, with the
+    # engine's own force calculation
+    def acceleration(self):
+        return self.get_acceleration(self.position, *self.force_args)
+
+    # Parameters and timings of the run as a JSON friendly dictionary
+    def result(self):
+        result = {
+            "engine": self.engine_name,
+            "bodies": self.number_of_bodies,
+            "steps": self.steps,
+            "timestep": self.timestep,
+            "theta": self.theta,
+            "seed": self.seed,
+            "workers": self.workers,
+            "grid_size": self.grid_size,
+            "setup_time": self.setup_time,
+            "run_time": self.run_time,
+            "time_per_step": self.run_time / max(self.steps, 1),
+        }
+        if self.integrator is not None:
+            result["force_evaluations"] = self.integrator.force_evaluations
+        if isinstance(self.force_engine, SharedMemoryTreeEngine):
+            result["phase_times"] = dict(self.force_engine.timings)
+        if self.checkpoint_path is not None:
+            result["checkpoint"] = self.checkpoint_path
+        if self.snapshots is not None:
+            self.snapshots.flush()
+            result["snapshot_frames"] = self.snapshots.count
+        if self.instrumentation is not None:
+            result["instrumentation"] = self.instrumentation.summary()
+        return result
+
+    # Stop any worker processes and finish the snapshot file
+    def close(self):
+        if self.force_engine is not None:
+            self.force_engine.close()
+        if self.snapshots is not None:
+            self.snapshots.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# Set up an engine, run it for a number of timesteps and return the
+# result of SimulationRun.result
+# With restart the run is carried on from checkpoint_path instead, with
+# the engine, bodies, timestep, theta, seed and grid size saved in it,
+# until number_of_timesteps have been run in total
+def run_simulation(
+        engine, number_of_bodies, number_of_timesteps, timestep=0.01,
+        theta=0.5, seed=50, workers=None, instrumentation=None,
+        snapshot_path=None, snapshot_every=1, snapshot_dtype=np.float64,
+        checkpoint_path=None, checkpoint_every=10, restart=False,
+        grid_size=particle_mesh.mesh_grid_size):
+    if number_of_timesteps < 0:
+        raise ValueError(
+            "number_of_timesteps must be at least 0, got %d"
+            % number_of_timesteps
+            )
+    state = None
+    if restart:
+        if checkpoint_path is None:
+            raise ValueError("A restart needs a checkpoint file")
+        description, state = load_checkpoint(checkpoint_path)
+        engine = description["engine"]
+        number_of_bodies = description["bodies"]
+        timestep = description["timestep"]
+        theta = description["theta"]
+        seed = description["seed"]
+        grid_size = description["grid_size"]
+
+    with SimulationRun(
+            engine, number_of_bodies, timestep, theta, seed,
+            workers, instrumentation, grid_size) as run:
+        if state is not None:
+            restore_run(run, description, state)
+        if checkpoint_path is not None:
+            run.enable_checkpoints(checkpoint_path, checkpoint_every)
+        if snapshot_path is not None:
+            run.open_snapshots(snapshot_path, snapshot_every, snapshot_dtype)
+        run.run(max(number_of_timesteps - run.steps, 0))
+        if checkpoint_path is not None:
+            run.save_checkpoint()
+        return run.result()
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m simulation",
+        description="Run an N-body engine and print its timings as JSON"
+        )
+    parser.add_argument(
+        "--engine", default="vectorized", choices=list(ENGINES),
+        help="force engine (default: vectorized)"
+        )
+    parser.add_argument(
+        "-n", "--bodies", type=int, default=1000,
+        help="number of bodies (default: 1000)"
+        )
+    parser.add_argument(
+        "--steps", type=int, default=10,
+        help="number of timesteps (default: 10)"
+        )
+    parser.add_argument(
+        "--theta", type=float, default=0.5,
+        help="opening angle of the tree engines (default: 0.5)"
+        )
+    parser.add_argument(
+        "--dt", type=float, default=0.01,
+        help="timestep (default: 0.01)"
+        )
+    parser.add_argument(
+        "--seed", type=int, default=50,
+        help="seed of the initial conditions (default: 50)"
+        )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="worker processes of the multiprocess engines "
+             "(default: number of CPUs)"
+        )
+    parser.add_argument(
+        "--grid", type=int, default=particle_mesh.mesh_grid_size,
+        metavar="POINTS",
+        help="grid points along every side of the particle-mesh and "
+             "TreePM grid "
+             "(default: %d)" % particle_mesh.mesh_grid_size
+        )
+    parser.add_argument(
+        "--snapshots", default=None, metavar="FILE",
+        help="stream the bodies to a snapshot file"
+        )
+    parser.add_argument(
+        "--snapshot-every", type=int, default=1, metavar="STEPS",
+        help="timesteps between snapshots (default: 1)"
+        )
+    parser.add_argument(
+        "--snapshot-dtype", default="float64",
+        choices=["float64", "float32"],
+        help="floating point type of the snapshots (default: float64)"
+        )
+    parser.add_argument(
+        "--checkpoint", default=None, metavar="FILE",
+        help="save the full state of the run to a checkpoint file"
+        )
+    parser.add_argument(
+        "--checkpoint-every", type=int, default=10, metavar="STEPS",
+        help="timesteps between checkpoints (default: 10)"
+        )
+    parser.add_argument(
+        "--restart", action="store_true",
+        help="carry the run on from the checkpoint file until --steps "
+             "timesteps have been run in total"
+        )
+    parser.add_argument(
+        "--instrument", action="store_true",
+        help="add per timestep timers and counters to the output"
+        )
+    parser.add_argument(
+        "--pstats", default=None, metavar="FILE",
+        help="write the timers to a pstats file snakeviz can open"
+        )
+    return parser.parse_args(argv)
+
+
+# Command line entry point, returns the exit status
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    probe = None
+    if arguments.instrument or arguments.pstats is not None:
+        probe = instrumentation.Instrumentation()
+    try:
+        result = run_simulation(
+            arguments.engine, arguments.bodies, arguments.steps,
+            timestep=arguments.dt, theta=arguments.theta,
+            seed=arguments.seed, workers=arguments.workers,
+            instrumentation=probe, snapshot_path=arguments.snapshots,
+            snapshot_every=arguments.snapshot_every,
+            snapshot_dtype=np.dtype(arguments.snapshot_dtype),
+            checkpoint_path=arguments.checkpoint,
+            checkpoint_every=arguments.checkpoint_every,
+            restart=arguments.restart, grid_size=arguments.grid
+            )
+    except (ValueError, OSError) as error:
+        print(json.dumps({"error": str(error)}))
+        return 1
+    if arguments.pstats is not None:
+        probe.write_pstats(arguments.pstats)
+    if not arguments.instrument:
+        result.pop("instrumentation", None)
+    print(json.dumps(result))
+    return 0
+
@@ -0,0 +1,273 @@
+import json
+import queue
+import threading
+import numpy as np
+
+from simulation import instrumentation
+
+
+"""
+SNAPSHOTS
+
+Streams the position and velocity of every body to a binary trajectory
+file as the simulation runs, so intermediate frames can be looked at
+without running the simulation again.
+
+File layout:
+
+header (HEADER_SIZE bytes)
+    - MAGIC, then the number of frames written as a little endian
+      int64, then the description of the file as JSON, padded with
+      spaces:
+      bodies, dimensions, dtype, timestep, engine, every, fields
+frames
+    - One record per frame, back to back:
+      step (int64), time (float64), then one bodies x dimensions array
+      of dtype for every field (position, velocity)
+
+SnapshotWriter
+    - Preallocates room for a number of frames with np.memmap and grows
+      the file when it fills up
+    - Only writes every `every` steps
+    - The frame is copied on the calling thread (the simulation updates
+      its arrays in place) and written into the file by a background
+      thread, so the write overlaps with the next force calculation
+    - The frame count in the header is only updated once a frame is
+      fully written, so a reader never sees half a frame
+
+SnapshotReader
+    - Maps the file read only; every frame, and every field of a frame,
+      is a view into the mapped file, nothing is copied
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# First bytes of every snapshot file
+MAGIC = b"BBSNAP01"
+
+# Size of the header in bytes, the frames start right after it
+HEADER_SIZE = 512
+
+# Byte offset of the frame count inside the header
+COUNT_OFFSET = len(MAGIC)
+
+# Fields stored in every frame
+FIELDS = ("position", "velocity")
+
+
+# Structured type of one frame record
+def frame_dtype(number_of_bodies, dimensions, dtype, fields=FIELDS):
+    return np.dtype(
+        [("step", "<i8"), ("time", "<f8")]
+        + [(field, np.dtype(dtype).newbyteorder("<"),
+            (number_of_bodies, dimensions)) for field in fields]
+        )
+
+
+# Read the description and frame count from the header of a file
+def read_header(path):
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+        raise ValueError("%s is not a snapshot file" % path)
+    count = int(np.frombuffer(header, "<i8", 1, COUNT_OFFSET)[0])
+    description = json.loads(header[COUNT_OFFSET + 8:].decode().strip())
+    return description, count
+
+
+class SnapshotWriter:
+    def __init__(
+            self, path, number_of_bodies, dimensions, timestep, engine="",
+            dtype=np.float64, every=1, frames=16, queue_size=4):
+        """
+        path: file to write, replaced if it exists
+        number_of_bodies: number of bodies in every frame
+        dimensions: 2 or 3
+        timestep: change in time between simulation steps
+        engine: name of the engine, stored in the header
+        dtype: floating point type the frames are stored in
+        every: only steps which are a multiple of every are written
+        frames: number of frames room is made for up front, the file
+        grows when they are used up
+        queue_size: most frames waiting for the background thread, a
+        write blocks once this many are waiting
+        count: number of frames written to the file so far
+        """
+        if every < 1:
+            raise ValueError("every must be at least 1, got %d" % every)
+        self.path = path
+        self.number_of_bodies = number_of_bodies
+        self.dimensions = dimensions
+        self.timestep = timestep
+        self.every = every
+        self.description = {
+            "bodies": number_of_bodies,
+            "dimensions": dimensions,
+            "dtype": np.dtype(dtype).str,
+            "timestep": timestep,
+            "engine": engine,
+            "every": every,
+            "fields": list(FIELDS),
+        }
+        self.dtype = frame_dtype(number_of_bodies, dimensions, dtype)
+        self.count = 0
+
+        text = json.dumps(self.description).encode()
+        if COUNT_OFFSET + 8 + len(text) > HEADER_SIZE:
+            raise ValueError("The snapshot header does not fit")
+        header = bytearray(b" " * HEADER_SIZE)
+        header[:COUNT_OFFSET] = MAGIC
+        header[COUNT_OFFSET:COUNT_OFFSET + 8] = np.int64(0).tobytes()
+        header[COUNT_OFFSET + 8:COUNT_OFFSET + 8 + len(text)] = text
+        with open(path, "wb") as file:
+            file.write(header)
+
+        self._header = np.memmap(path, np.uint8, "r+", 0, HEADER_SIZE)
+        self._frames = None
+        self._map(max(1, frames))
+
+        self._error = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._write_frames)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Map room for a number of frames, growing the file as needed
+    # The old mapping is dropped first, as a mapped file cannot be
+    # resized on every platform
+    def _map(self, frames):
+        if self._frames is not None:
+            self._frames.flush()
+            self._frames = None
+        with open(self.path, "r+b") as file:
+            file.truncate(HEADER_SIZE + frames * self.dtype.itemsize)
+        self._frames = np.memmap(
+            self.path, self.dtype, "r+", HEADER_SIZE, (frames,)
+            )
+
+    # Background thread: write every queued frame into the file
+    def _write_frames(self):
+        while True:
+            frame = self._queue.get()
+            try:
+                if frame is None:
+                    return
+                if self._error is None:
+                    self._store(*frame)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _store(self, step, time, arrays):
+        if self.count == self._frames.shape[0]:
+            self._map(2 * self.count)
+        record = self._frames[self.count]
+        record["step"] = step
+        record["time"] = time
+        for field, array in zip(FIELDS, arrays):
+            record[field] = array
+        self.count += 1
+        # Publish the frame only once it is complete
+        self._header[COUNT_OFFSET:COUNT_OFFSET + 8] = np.frombuffer(
+            np.int64(self.count).tobytes(), np.uint8
+            )
+
+    # Queue a frame for writing, whatever the step
+    # position and velocity are copied here, so the simulation can
+    # carry on updating them straight away
+    def write(self, step, position, velocity):
+        if self._error is not None:
+            raise self._error
+        with instrumentation.timer("io"):
+            arrays = tuple(
+                np.array(array, dtype=self.dtype[field].base, copy=True)
+                for field, array in zip(FIELDS, (position, velocity))
+                )
+            self._queue.put((step, step * self.timestep, arrays))
+
+    # Queue a frame for writing if step is due, returns whether it was
+    def record(self, step, position, velocity):
+        if step % self.every:
+            return False
+        self.write(step, position, velocity)
+        return True
+
+    # Wait until every queued frame is in the file
+    def flush(self):
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+        self._frames.flush()
+        self._header.flush()
+
+    # Write the remaining frames, trim the unused room and close the file
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._frames.flush()
+        self._header.flush()
+        del self._frames, self._header
+        with open(self.path, "r+b") as file:
+            file.truncate(HEADER_SIZE + self.count * self.dtype.itemsize)
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SnapshotReader:
+    def __init__(self, path):
+        """
+        path: snapshot file to read, may still be being written
+        description: the header's description of the file
+        frames: every complete frame as a read only structured array
+        mapped from the file
+        """
+        self.path = path
+        self.description, count = read_header(path)
+        self.dtype = frame_dtype(
+            self.description["bodies"], self.description["dimensions"],
+            self.description["dtype"], self.description["fields"]
+            )
+        self.frames = None
+        self.refresh(count)
+
+    # Map every frame written so far, for files still being written
+    def refresh(self, count=None):
+        if count is None:
+            count = read_header(self.path)[1]
+        self.frames = np.memmap(
+            self.path, self.dtype, "r", HEADER_SIZE, (count,)
+            )
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    # Frame i as a record of step, time, position and velocity
+    def __getitem__(self, i):
+        return self.frames[i]
+
+    # Step numbers and times of every frame
+    def steps(self):
+        return self.frames["step"]
+
+    def times(self):
+        return self.frames["time"]
+
+    # Positions of every body in frame i, a view into the file
+    def position(self, i):
+        return self.frames["position"][i]
+
+    # Velocities of every body in frame i, a view into the file
+    def velocity(self, i):
+        return self.frames["velocity"][i]
@@ -0,0 +1,106 @@
+import unittest
+from copy import deepcopy
+import numpy as np
+
+from barnes_hut.barnes_hut_quadtree import add_body, node
+
+
+"""
+Checks the quadtree built by add_body, which splits leaves with
+node.split_node, against the same tree built the original way, with
+the leaf deep copied into the new internal node.
+"""
+
+# THIS CODE FOLLOWS THE PRINCIPLES SET OUT BY PEP8
+# https://peps.python.org/pep-0008/
+
+
+# add_body as it was before split_node, deep copying the split leaf
+def add_body_deepcopy(body, current):
+    new_node = body if current is None else None
+    min_quad_size = 1.e-5
+    if current is not None and current.side > min_quad_size:
+        if current.subnode is None:
+            new_node = deepcopy(current)
+            new_node.subnode = [None for i in range(4)]
+            quad = current.quadrant_next_node()
+            new_node.subnode[quad] = current
+        else:
+            new_node = current
+
+        new_node.com_array = (
+            new_node.com_array * new_node.mass + body.com_array * body.mass
+            ) / (new_node.mass + body.mass)
+        new_node.mass += body.mass
+        quad = body.quadrant_next_node()
+        new_node.subnode[quad] = add_body_deepcopy(
+            body, new_node.subnode[quad]
+            )
+    return new_node
+
+
+# Quadtree of random bodies in the unit square, built with insert
+def build(insert, number_of_bodies, seed):
+    random = np.random.RandomState(seed)
+    position = random.random_sample((number_of_bodies, 2))
+    mass = random.random_sample(number_of_bodies) * 10
+    root = None
+    for (x, y), m in zip(position, mass):
+        body = node(x, y, 0.0, 0.0, m)
+        body.quadrant_reposition()
+        root = insert(body, root)
+    return root
+
+
+class QuadtreeInsertionTest(unittest.TestCase):
+    # Same shape, and the same mass and center of mass in every node
+    def assertTreesMatch(self, tree, reference):
+        stack = [(tree, reference)]
+        nodes = 0
+        while stack:
+            first, second = stack.pop()
+            if first is None or second is None:
+                self.assertIs(first, second)
+                continue
+            nodes += 1
+            self.assertEqual(first.subnode is None, second.subnode is None)
+            self.assertAlmostEqual(first.mass, second.mass, places=9)
+            np.testing.assert_allclose(
+                first.com_array, second.com_array, rtol=1.e-12
+                )
+            self.assertEqual(first.side, second.side)
+            if first.subnode is not None:
+                stack.extend(zip(first.subnode, second.subnode))
+        return nodes
+
+    def test_matches_deepcopy_build(self):
+        for number_of_bodies in (1, 2, 50, 2000):
+            tree = build(add_body, number_of_bodies, 50)
+            reference = build(add_body_deepcopy, number_of_bodies, 50)
+            nodes = self.assertTreesMatch(tree, reference)
+            self.assertGreaterEqual(nodes, number_of_bodies)
+
+    def test_split_node_shares_nothing_with_the_leaf(self):
+        leaf = node(0.25, 0.75, 1.0, -1.0, 3.0)
+        leaf.quadrant_reposition()
+        internal = leaf.split_node()
+        self.assertEqual(internal.mass, leaf.mass)
+        self.assertEqual(internal.side, leaf.side)
+        np.testing.assert_array_equal(internal.com_array, leaf.com_array)
+        self.assertIsNot(internal.com_array, leaf.com_array)
+        self.assertEqual(internal.subnode, [None, None, None, None])
+
+    def test_root_mass_and_center_of_mass(self):
+        random = np.random.RandomState(7)
+        position = random.random_sample((500, 2))
+        mass = random.random_sample(500) * 10
+        root = build(add_body, 500, 7)
+        self.assertAlmostEqual(root.mass, mass.sum(), places=9)
+        np.testing.assert_allclose(
+            root.com_array, (mass[:, np.newaxis] * position).sum(axis=0)
+            / mass.sum(), rtol=1.e-12
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()